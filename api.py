@@ -6,11 +6,9 @@ Python wrapper for the SBA (U.S. Small Business Administration) API.
 SBA API Documentation: http://www.sba.gov/api/
 """
 
-try:
-    import json
-except ImportError:  # pragma: no cover
-    # For older versions of Python.
-    import simplejson as json
+import copy
+import io
+import time
 
 try:
     from urllib import urlencode
@@ -25,26 +23,457 @@ except ImportError:  # pragma: no cover
     from urllib.parse import quote
 
 try:
-    from urllib2 import urlopen
+    from urllib2 import HTTPError, Request, urlopen
 except ImportError:  # pragma: no cover
     # For Python 3.
-    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+from bulk import DEFAULT_WORKERS, fan_out
+from cache import MISSING, Revalidation, response_validators
+import decoding
+from endpoints import (County, Choice, Combination, Domain, InvalidParameter,
+                       Text, ZipCode, parameters)
+from planner import GeodataPlanner, SitesPlanner
+from transport import decompressed
+import hedging
+import projection
+import records
+from singleflight import SingleFlight
+from site_index import SiteIndex
+from streaming import iter_json_array
+
+# Two letter postal codes for the 54 states and territories the SBA APIs
+# cover.
+STATES = ('al', 'ak', 'az', 'ar', 'ca', 'co', 'ct', 'de', 'dc', 'fl', 'ga',
+          'hi', 'id', 'il', 'in', 'ia', 'ks', 'ky', 'la', 'me', 'md', 'ma',
+          'mi', 'mn', 'ms', 'mo', 'mt', 'ne', 'nv', 'nh', 'nj', 'nm', 'ny',
+          'nc', 'nd', 'oh', 'ok', 'or', 'pa', 'ri', 'sc', 'sd', 'tn', 'tx',
+          'ut', 'vt', 'va', 'wa', 'wv', 'wi', 'wy', 'gu', 'pr', 'vi')
+
+# Standard values accepted by Licenses_And_Permits and Loans_And_Grants, as
+# listed in their method documentation.
+BUSINESS_TYPES = ('general business licenses', 'auto dealership',
+                  'barber shop', 'beauty salon', 'child care services',
+                  'construction contractor', 'debt collection agency',
+                  'electrician', 'massage', 'therapist', 'plumber',
+                  'restaurant', 'insurance requirements',
+                  'new hire reporting requirements', 'state tax registration',
+                  'workplace poster requirements')
+LICENSE_CATEGORIES = ('doing business as', 'entity filing',
+                      'employer requirements', 'states licenses',
+                      'tax registration')
+INDUSTRIES = ('agriculture', 'child care', 'environmental management',
+              'health care', 'manufacturing', 'technology', 'tourism')
+SPECIALTIES = ('general_purpose', 'development', 'exporting', 'contractor',
+               'green', 'military', 'minority', 'woman', 'disabled', 'rural',
+               'disaster')
+
+# Parameter domains of the wrapper methods, see endpoints.py.
+STATE = Choice(STATES)
+BUSINESS_TYPE = Choice(BUSINESS_TYPES, {
+    'general business license': 'general business licenses'})
+LICENSE_CATEGORY = Choice(LICENSE_CATEGORIES)
+INDUSTRY = Choice(INDUSTRIES)
+SPECIALTY = Combination(SPECIALTIES)
 
 
 class SBA_API(object):
     """WRapper for SBA APIs."""
 
+    # Root URL the wrappers' base URLs are built on when they are created,
+    # e.g. a gateway.Gateway shared by every process on a host:
+    # SBA_API.api_root = 'http://127.0.0.1:8421'
+    api_root = 'http://api.sba.gov'
+    # Shared by every wrapper class unless overridden on a subclass or an
+    # instance, e.g. SBA_API.transport = transport.ConnectionPool()
+    transport = None
+    # Optional response cache shared the same way, e.g.
+    # SBA_API.cache = cache.MemoryCache(ttl=3600)
+    cache = None
+    # Concurrent calls for the same URL share one download; set to None to
+    # disable. Coalesced callers receive the same result object.
+    coalesce = SingleFlight()
+    # Optional local snapshot consulted before the network, e.g.
+    # SBA_API.mirror = mirror.Mirror('sba-mirror.db')
+    mirror = None
+    # Optional throttle.RateLimiter and throttle.AdaptiveConcurrency applied
+    # to every network request, including those made by bulk helpers.
+    rate_limiter = None
+    concurrency = None
+    # Seconds a call may take, retries included (see also hedging.deadline),
+    # how many times a failed download is retried with jittered backoff,
+    # and the latency percentile after which a duplicate request is hedged.
+    timeout = None
+    retries = 0
+    backoff = 0.1
+    hedge = None
+    latencies = hedging.LatencyWindow()
+    # Optional metrics.Metrics recording per endpoint and method timings.
+    metrics = None
+    # Compressed encodings requested from the server; bodies are inflated
+    # as they download. Set to None to ask for uncompressed responses.
+    accept_encoding = 'gzip, deflate'
+    # Optional planner answering some calls from other cached responses,
+    # see planner.py.
+    planner = None
+    # Normalize wrapper method arguments and raise InvalidParameter for
+    # values outside their documented domain before any request is made.
+    validate = True
+    # Force a decoding backend ('orjson', 'ujson', 'simplejson' or 'json')
+    # instead of the fastest one installed, decoding.DEFAULT.
+    json_backend = None
+    # Decode JSON objects into compact records.Record instances instead of
+    # dicts, e.g. City_And_County_Web_Data.typed = True
+    typed = False
+    # Keep only these fields of each record, e.g.
+    # City_And_County_Web_Data.fields = ('name', 'url'); wrapper methods
+    # also take a fields argument overriding it. See projection.py.
+    fields = None
+    # Optional warmup.QueryLog appending every wrapper call made through
+    # call_api, to replay into a cold cache with warmup.py.
+    query_log = None
+    # Runs the calls of the bulk helpers such as
+    # Licenses_And_Permits.by_business_type_states; async_api replaces it
+    # with an awaitable version.
+    fan_out = staticmethod(fan_out)
+
     def __init__(self):
         """Base URLs should have no '/' at the end"""
-        self.base_url = 'http://api.sba.gov'
+        self.base_url = self.api_root
 
-    def call_api(self, directory):
+    def build_url(self, directory):
         url_list = [self.base_url]
         # Use urllib.quote to replace spaces with %20
         url_list.append('/%s.json' % quote(str(directory)))
-        url = ''.join(url_list)
-        data = urlopen(url).read()
-        return json.loads(data)
+        return ''.join(url_list)
+
+    def family(self):
+        """Endpoint family of this wrapper, e.g. 'loans_grants'."""
+        return self.base_url.rsplit('/', 1)[-1]
+
+    def url_for(self, method, *args):
+        """
+        Return the URL a wrapper method would request, without calling it.
+
+        >>> api.Loans_And_Grants().url_for('state', 'ia')
+        'http://api.sba.gov/loans_grants/state_financing_for/ia.json'
+        """
+        recorder = copy.copy(self)
+        recorder.call_api = lambda directory, *call: recorder.build_url(
+            directory)
+        return getattr(recorder, method)(*args)
+
+    def fetch(self, url, span=None, revalidation=None):
+        """Return the raw response body for url, from the mirror when it has
+        a copy, otherwise downloaded, retrying within the deadline. With a
+        cache.Revalidation the download is conditional."""
+        if self.mirror is not None:
+            data = self.mirror.get(url)
+            if data is not None:
+                return data
+        end = hedging.deadline_after(self.timeout)
+        attempt = 0
+        while True:
+            try:
+                return self.request(url, end, span, revalidation)
+            except Exception as error:
+                attempt += 1
+                if attempt > self.retries or not hedging.retryable(error):
+                    raise
+                delay = hedging.backoff_delay(attempt, self.backoff)
+                if end is not None and time.time() + delay >= end:
+                    raise
+                time.sleep(delay)
+
+    def request(self, url, end=None, span=None, revalidation=None):
+        """Make one download attempt that must finish by the absolute time
+        end. When hedging, a second attempt is started if the first is
+        slow; each attempt is throttled and records its own revalidation
+        and timings, and the winner's are copied to revalidation and
+        span."""
+        if self.hedge is None:
+            return self.throttled_download(url, end, span, revalidation)
+        delay = self.latencies.percentile(self.base_url, self.hedge)
+
+        def attempt():
+            own_span = own_revalidation = None
+            if span is not None:
+                own_span = copy.copy(span)
+                own_span.phases = {}
+            if revalidation is not None:
+                own_revalidation = copy.copy(revalidation)
+            data = self.throttled_download(url, end, own_span,
+                                           own_revalidation)
+            return data, own_span, own_revalidation
+
+        data, own_span, own_revalidation = hedging.hedged(
+            attempt, delay, hedging.remaining(end))
+        if span is not None:
+            span.phases.update(own_span.phases)
+        if revalidation is not None:
+            revalidation.validators = own_revalidation.validators
+            revalidation.not_modified = own_revalidation.not_modified
+        return data
+
+    def throttled_download(self, url, end, span=None, revalidation=None):
+        """Download url once the rate limiter and concurrency limit allow,
+        recording its latency. Waiting for either counts against end."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(hedging.remaining(end))
+        if self.concurrency is not None:
+            with self.concurrency.slot(hedging.remaining(end)):
+                return self.timed_download(url, end, span, revalidation)
+        return self.timed_download(url, end, span, revalidation)
+
+    def timed_download(self, url, end, span=None, revalidation=None):
+        started = time.time()
+        data = self.download(url, hedging.remaining(end), span, revalidation)
+        self.latencies.record(self.base_url, time.time() - started)
+        return data
+
+    def download(self, url, timeout=None, span=None, revalidation=None):
+        """Download url over the network and return the raw body, recording
+        phase timings on span when given. With a cache.Revalidation, its
+        conditional headers are sent and the response's validators and 304
+        status are recorded on it."""
+        conditional = revalidation is not None and bool(revalidation.headers)
+        headers = self.request_headers()
+        if conditional:
+            headers.update(revalidation.headers)
+        if self.transport is not None:
+            response = self.transport.urlopen(url, headers=headers,
+                                              timeout=timeout, span=span)
+            data = response.read()
+        else:
+            started = time.time()
+            request = Request(url, headers=headers)
+            try:
+                if timeout is None:
+                    response = urlopen(request)
+                else:
+                    response = urlopen(request, timeout=timeout)
+            except HTTPError as error:
+                # urlopen raises for 304 Not Modified.
+                if error.code != 304 or not conditional:
+                    raise
+                response = error
+            first_byte = time.time()
+            data = decompressed(response).read()
+            if span is not None:
+                span.record('first_byte', first_byte - started)
+                span.record('transfer', time.time() - first_byte)
+        if revalidation is not None:
+            revalidation.not_modified = (conditional and
+                                         response.getcode() == 304)
+            revalidation.validators = response_validators(response)
+        return data
+
+    def request_headers(self):
+        """Headers sent with every request."""
+        headers = {}
+        if self.accept_encoding:
+            headers['Accept-Encoding'] = self.accept_encoding
+        return headers
+
+    def open(self, url, timeout=None):
+        """Request url and return the response without reading its body,
+        or a file of the mirrored body when the mirror has it. timeout
+        bounds each blocking socket operation, SBA_API.timeout (or the
+        hedging.deadline in effect) by default."""
+        if self.mirror is not None:
+            data = self.mirror.get(url)
+            if data is not None:
+                return io.BytesIO(data)
+        if timeout is None:
+            timeout = hedging.remaining(hedging.deadline_after(self.timeout))
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(timeout)
+        headers = self.request_headers()
+        if self.transport is not None:
+            return self.transport.open(url, headers=headers, timeout=timeout)
+        request = Request(url, headers=headers)
+        if timeout is None:
+            return decompressed(urlopen(request))
+        return decompressed(urlopen(request, timeout=timeout))
+
+    def stream_api(self, directory, timeout=None):
+        """
+        Like call_api for endpoints returning a JSON array, but yields one
+        element at a time while the body downloads. Streamed calls bypass
+        the cache and request coalescing. timeout is passed to open.
+        """
+        response = self.open(self.build_url(directory), timeout)
+        try:
+            for record in self.iter_records(response):
+                yield record
+        finally:
+            response.close()
+
+    def iter_records(self, fileobj):
+        """Decode the JSON array read from fileobj one element at a time,
+        typed and projected like the values call_api returns."""
+        decoder = records.decoder() if self.typed else None
+        fields = projection.normalize(self.fields)
+        for record in iter_json_array(fileobj, decoder=decoder):
+            if fields is not None:
+                record = projection.project_record(record, fields,
+                                                   self.typed)
+            yield record
+
+    def decode(self, data, fields=None):
+        """Decode a raw JSON response body, bytes or str, projecting each
+        record onto fields when given."""
+        if fields is not None:
+            return projection.loads(data, fields, self.typed)
+        if self.typed:
+            return records.loads(data, self.json_backend)
+        return decoding.loads(data, self.json_backend)
+
+    def decoder(self, fields=None):
+        """One argument decode function for fields, for caches."""
+        if fields is None:
+            return self.decode
+        return lambda data: self.decode(data, fields)
+
+    def project(self, value, fields):
+        """Project a fully decoded value onto fields."""
+        if value is MISSING:
+            return value
+        return projection.project(value, fields, self.typed)
+
+    def cached(self, url, fields=None):
+        """Return the cached value for url projected onto fields, or
+        MISSING. Caches storing raw bodies decode them projected."""
+        if fields is not None and self.cache.stores_bodies:
+            return self.cache.get(url, self.decoder(fields))
+        return self.project(self.cache.get(url, self.decode), fields)
+
+    def result(self, value):
+        """Return a value found without calling the API the way call_api
+        returns its values; the async wrappers make it awaitable."""
+        return value
+
+    def stored(self, directory):
+        """
+        Return the whole decoded response for directory when it is
+        available without a request, from the cache or the mirror, or
+        MISSING. Planners answer calls from these; a mirrored response is
+        added to the cache so it is decoded once.
+        """
+        url = self.build_url(directory)
+        if self.cache is not None:
+            # A probe, not a lookup of the caller's: leave the counters be.
+            value = self.cache.peek(url, self.decode)
+            if value is not MISSING:
+                return value
+        if self.mirror is not None:
+            try:
+                data = self.mirror.get(url)
+            except LookupError:
+                # An offline mirror without it.
+                data = None
+            if data is not None:
+                value = self.decode(data)
+                if self.cache is not None:
+                    self.cache.set(url, data, value)
+                return value
+        return MISSING
+
+    def unprojected(self):
+        """This wrapper without a field projection, for planners that
+        need whole records."""
+        if self.fields is None:
+            return self
+        client = copy.copy(self)
+        client.fields = None
+        return client
+
+    def load(self, url, method=None, fields=None):
+        """Download and decode url, storing the result in the cache. A stale
+        cached copy with validators is revalidated instead of downloaded
+        again when upstream answers 304 Not Modified. The result is
+        projected onto fields; it is decoded projected unless the cache
+        keeps whole decoded values."""
+        whole = fields is None or (self.cache is not None and
+                                   not self.cache.stores_bodies)
+        decode = self.decode if whole else self.decoder(fields)
+        revalidation = None
+        if self.cache is not None:
+            revalidation = Revalidation(self.cache.validators(url))
+        span = None
+        if self.metrics is not None:
+            span = self.metrics.start(self.family(), method, url)
+        try:
+            data = self.fetch(url, span, revalidation)
+            value = MISSING
+            if revalidation is not None and revalidation.not_modified:
+                value = self.cache.refresh(url, decode)
+                if value is MISSING:
+                    # Evicted since the request was sent; fetch it in full.
+                    revalidation = Revalidation()
+                    data = self.fetch(url, span, revalidation)
+                elif self.metrics is not None:
+                    self.metrics.increment(self.family(), method,
+                                           'not_modified')
+            if value is MISSING:
+                started = time.time()
+                value = decode(data)
+                if span is not None:
+                    span.record('decode', time.time() - started)
+            if span is not None:
+                span.bytes = len(data)
+        except Exception as error:
+            if span is not None:
+                span.finish(error)
+            raise
+        if span is not None:
+            span.finish()
+        if self.cache is not None and not revalidation.not_modified:
+            self.cache.set(url, data, value, revalidation.validators)
+        if whole:
+            return self.project(value, fields)
+        return value
+
+    def log_call(self, method, args):
+        """Append a wrapper method call to query_log. Calls made on behalf
+        of a planner or gateway, which pass no method, are not logged."""
+        if self.query_log is not None and method is not None:
+            self.query_log.record(type(self).__name__, method, list(args))
+
+    def call_api(self, directory, method=None, args=()):
+        """
+        Return the decoded response for directory, from the cache, the
+        planner, the mirror or a request, in that order.
+
+        @param method [String] Name of the wrapper method making the call,
+        used to label metrics and the query log.
+        @param args [List] That method's normalized arguments.
+        """
+        url = self.build_url(directory)
+        self.log_call(method, args)
+        fields = projection.normalize(self.fields)
+        if self.cache is not None:
+            value = self.cached(url, fields)
+            if value is not MISSING:
+                if self.metrics is not None:
+                    self.metrics.increment(self.family(), method,
+                                           'cache_hits')
+                return value
+        # A mirrored copy of url itself beats one derived by the planner.
+        if self.planner is not None and (self.mirror is None or
+                                         url not in self.mirror):
+            value = self.planner.answer(self.unprojected(), directory)
+            if value is not MISSING:
+                if self.metrics is not None:
+                    self.metrics.increment(self.family(), method, 'planned')
+                return self.project(value, fields)
+        if self.coalesce is not None:
+            # Callers with different projections must not share results.
+            key = url if fields is None else (url, fields)
+            return self.coalesce.do(key, lambda: self.load(url, method,
+                                                           fields))
+        return self.load(url, method, fields)
 
 
 class Licenses_And_Permits(SBA_API):
@@ -53,8 +482,9 @@ class Licenses_And_Permits(SBA_API):
     """
 
     def __init__(self):
-        self.base_url = 'http://api.sba.gov/license_permit'
+        self.base_url = self.api_root + '/license_permit'
 
+    @parameters(category=LICENSE_CATEGORY)
     def by_category(self, category):
         """
         Returns results for a matching license or permit category for each 54
@@ -69,8 +499,9 @@ class Licenses_And_Permits(SBA_API):
         >>> api.Licenses_And_Permits().by_category('doing business as')
         """
         url = 'by_category/%s' % category
-        return self.call_api(url)
+        return self.call_api(url, 'by_category', [category])
 
+    @parameters(state=STATE)
     def by_state(self, state):
         """
         Returns all business licenses for all business types required to
@@ -84,8 +515,9 @@ class Licenses_And_Permits(SBA_API):
         >>> api.Licenses_And_Permits().by_state('ca')
         """
         url = 'all_by_state/%s' % state
-        return self.call_api(url)
+        return self.call_api(url, 'by_state', [state])
 
+    @parameters(business_type=BUSINESS_TYPE)
     def by_business_type(self, business_type):
         """
         Returns business licenses and permits required for a specific type of
@@ -103,12 +535,13 @@ class Licenses_And_Permits(SBA_API):
 
         @see http://www.sba.gov/content/business-licenses-permits-api-business-type-method
 
-        >>> api.Licenses_And_Permits().by_business_type('general business license')
+        >>> api.Licenses_And_Permits().by_business_type('general business licenses')
 
         """
         url = 'by_business_type/%s' % business_type
-        return self.call_api(url)
+        return self.call_api(url, 'by_business_type', [business_type])
 
+    @parameters(business=BUSINESS_TYPE, state=STATE)
     def by_business_type_state(self, business, state):
         """
         Returns business licenses and permits required for a specific type of
@@ -132,8 +565,10 @@ class Licenses_And_Permits(SBA_API):
                 'child care services', 'va')
         """
         url = 'state_only/%s/%s' % (business, state)
-        return self.call_api(url)
+        return self.call_api(url, 'by_business_type_state', [business, state])
 
+    @parameters(business=BUSINESS_TYPE, state=STATE,
+                county=County())
     def by_business_type_state_county(self, business, state, county):
         """
         Returns business licenses and permits required for a specific type of
@@ -160,8 +595,10 @@ class Licenses_And_Permits(SBA_API):
                 'child care services', 'ca', 'los angeles county')
         """
         url = 'state_and_county/%s/%s/%s' % (business, state, county)
-        return self.call_api(url)
+        return self.call_api(url, 'by_business_type_state_county',
+                             [business, state, county])
 
+    @parameters(business=BUSINESS_TYPE, state=STATE, city=Text())
     def by_business_type_state_city(self, business, state, city):
         """
         Returns business licenses and permits required for a specific type of
@@ -186,8 +623,10 @@ class Licenses_And_Permits(SBA_API):
                 'restaurant', 'ny', 'albany')
         """
         url = 'state_and_city/%s/%s/%s' % (business, state, city)
-        return self.call_api(url)
+        return self.call_api(url, 'by_business_type_state_city',
+                             [business, state, city])
 
+    @parameters(business=BUSINESS_TYPE, zipcode=ZipCode())
     def by_business_type_zipcode(self, business, zipcode):
         """
         Returns business licenses and permits required for a specific type of
@@ -210,7 +649,63 @@ class Licenses_And_Permits(SBA_API):
                 '49684')
         """
         url = 'by_zip/%s/%s' % (business, str(zipcode))
-        return self.call_api(url)
+        return self.call_api(url, 'by_business_type_zipcode',
+                             [business, zipcode])
+
+    @parameters(business=BUSINESS_TYPE)
+    def by_business_type_states(self, business, states=None,
+                                max_workers=DEFAULT_WORKERS, ordered=False):
+        """
+        Runs by_business_type_state concurrently for many states and yields a
+        bulk.BulkResult(key=state, value, error) for each one. A failing state
+        sets error instead of aborting the batch.
+
+        @param business [String] One of the by_business_type_state values.
+        @param states [List] Two letter postal codes, all 54 by default.
+        @param max_workers [Integer] Most requests in flight at once.
+        @param ordered [Boolean] Yield in input order rather than completion
+        order.
+
+        >>> for result in api.Licenses_And_Permits().by_business_type_states(
+                'restaurant'):
+        ...     print(result.key, result.error or result.value)
+        """
+        if states is None:
+            states = STATES
+        return self.fan_out(lambda state: self.by_business_type_state(
+            business, state), states, max_workers, ordered)
+
+    @parameters(business=BUSINESS_TYPE)
+    def by_business_type_counties(self, business, counties,
+                                  max_workers=DEFAULT_WORKERS, ordered=False):
+        """
+        Runs by_business_type_state_county concurrently and yields a
+        bulk.BulkResult(key=(state, county), value, error) for each one.
+
+        @param business [String] One of the by_business_type_state values.
+        @param counties [List] (state, county) pairs.
+
+        >>> api.Licenses_And_Permits().by_business_type_counties('restaurant',
+                [('ca', 'orange county'), ('wa', 'king county')])
+        """
+        return self.fan_out(lambda key: self.by_business_type_state_county(
+            business, key[0], key[1]), counties, max_workers, ordered)
+
+    @parameters(business=BUSINESS_TYPE)
+    def by_business_type_cities(self, business, cities,
+                                max_workers=DEFAULT_WORKERS, ordered=False):
+        """
+        Runs by_business_type_state_city concurrently and yields a
+        bulk.BulkResult(key=(state, city), value, error) for each one.
+
+        @param business [String] One of the by_business_type_state values.
+        @param cities [List] (state, city) pairs.
+
+        >>> api.Licenses_And_Permits().by_business_type_cities('restaurant',
+                [('ny', 'albany'), ('tx', 'dallas')])
+        """
+        return self.fan_out(lambda key: self.by_business_type_state_city(
+            business, key[0], key[1]), cities, max_workers, ordered)
 
 
 class Loans_And_Grants(SBA_API):
@@ -218,9 +713,15 @@ class Loans_And_Grants(SBA_API):
     http://www.sba.gov/about-sba-services/7615
     """
 
+    # Set to planner.LoansPlanner() to compose federal_and_state and the
+    # industry/specialty searches from cached federal(), state(),
+    # by_industry and by_speciality results.
+    planner = None
+
     def __init__(self):
-        self.base_url = 'http://api.sba.gov/loans_grants'
+        self.base_url = self.api_root + '/loans_grants'
 
+    @parameters()
     def federal(self):
         """
         Returns financing programs available from Federal government agencies
@@ -230,8 +731,9 @@ class Loans_And_Grants(SBA_API):
 
         >>> api.Loans_And_Grants().federal()
         """
-        return self.call_api('federal')
+        return self.call_api('federal', 'federal')
 
+    @parameters(state=STATE)
     def state(self, state):
         """
         Returns all small business financing programs sponsored by state
@@ -244,8 +746,9 @@ class Loans_And_Grants(SBA_API):
         >>> api.Loans_And_Grants().state('ia')
         """
         url = 'state_financing_for/%s' % state
-        return self.call_api(url)
+        return self.call_api(url, 'state', [state])
 
+    @parameters(state=STATE)
     def federal_and_state(self, state):
         """
         Returns all small business financing programs sponsored by federal
@@ -255,12 +758,16 @@ class Loans_And_Grants(SBA_API):
         @param state [String] input the two leter postal code for the state
         abbreviation
 
+        With a planner.LoansPlanner set, this is composed from the cached
+        federal() and state(state) results when both are available.
+
         @see http://www.sba.gov/content/loans-grants-search-api-federal-and-state-specific-method
         >>>  api.Loans_And_Grants().federal_and_state('me')
         """
         url = 'federal_and_state_financing_for/%s' % state
-        return self.call_api(url)
+        return self.call_api(url, 'federal_and_state', [state])
 
+    @parameters(industry=INDUSTRY)
     def by_industry(self, industry):
         """
         Returns all small business financing programs for a specific industry
@@ -275,8 +782,9 @@ class Loans_And_Grants(SBA_API):
         >>> api.Loans_And_Grants().by_industry('manufacturing')
         """
         url = 'nil/for_profit/%s/nil' % industry
-        return self.call_api(url)
+        return self.call_api(url, 'by_industry', [industry])
 
+    @parameters(specialty=SPECIALTY)
     def by_speciality(self, specialty):
         """
         Returns small business special financing programs for certain business owner
@@ -294,8 +802,9 @@ class Loans_And_Grants(SBA_API):
         >>> api.Loans_And_Grants().by_speciality('woman-general_purpose')
         """
         url = 'nil/for_profit/nil/%s' % specialty
-        return self.call_api(url)
+        return self.call_api(url, 'by_speciality', [specialty])
 
+    @parameters(industry=INDUSTRY, specialty=SPECIALTY)
     def by_industry_specialty(self, industry, specialty):
         """
         Returns financing programs for specific industries AND specific business
@@ -316,8 +825,10 @@ class Loans_And_Grants(SBA_API):
                 'woman-minority')
         """
         url = 'nil/for_profit/%s/%s' % (industry, specialty)
-        return self.call_api(url)
+        return self.call_api(url, 'by_industry_specialty',
+                             [industry, specialty])
 
+    @parameters(state=STATE, industry=INDUSTRY)
     def by_state_industry(self, state, industry):
         """
         Returns all small business financing programs for a specific industry
@@ -333,8 +844,9 @@ class Loans_And_Grants(SBA_API):
         >>> api.Loans_And_Grants().by_state_industry('me', 'manufacturing')
         """
         url = '%s/for_profit/%s/nil' % (state, industry)
-        return self.call_api(url)
+        return self.call_api(url, 'by_state_industry', [state, industry])
 
+    @parameters(state=STATE, specialty=SPECIALTY)
     def by_state_specialty(self, state, specialty):
         """
         Returns state programs for specific business groups or specialized
@@ -355,8 +867,10 @@ class Loans_And_Grants(SBA_API):
                 'woman-minority')
         """
         url = '%s/for_profit/nil/%s' % (state, specialty)
-        return self.call_api(url)
+        return self.call_api(url, 'by_state_specialty', [state, specialty])
 
+    @parameters(state=STATE, industry=INDUSTRY,
+                specialty=SPECIALTY)
     def by_state_industry_specialty(self, state, industry, specialty):
         """
         Returns state programs by industry and specific business groups or
@@ -379,7 +893,8 @@ class Loans_And_Grants(SBA_API):
                 'manufacturing', 'development-woman')
         """
         url = '%s/for_profit/%s/%s' % (state, industry, specialty)
-        return self.call_api(url)
+        return self.call_api(url, 'by_state_industry_specialty',
+                             [state, industry, specialty])
 
 
 class Recommended_Sites(SBA_API):
@@ -387,9 +902,54 @@ class Recommended_Sites(SBA_API):
     http://www.sba.gov/about-sba-services/7630
     """
 
+    # When set to a site_index.SiteIndex, by_keyword, by_category,
+    # by_master_term and by_domain are answered from it locally. Otherwise
+    # the planner answers them from a cached or mirrored all_sites.
+    index = None
+    planner = SitesPlanner()
+
     def __init__(self):
-        self.base_url = 'http://api.sba.gov/rec_sites'
+        self.base_url = self.api_root + '/rec_sites'
+
+    def load_index(self):
+        """
+        Download all_sites once and index it for every Recommended_Sites
+        instance.
+
+        >>> api.Recommended_Sites().load_index()
+        """
+        Recommended_Sites.index = SiteIndex(self.unprojected().all_sites())
+        return Recommended_Sites.index
+
+    def indexed(self, sites):
+        """Return sites found in the index like call_api would, projected
+        onto this wrapper's fields."""
+        return self.result(self.project(sites,
+                                        projection.normalize(self.fields)))
+
+    @parameters()
+    def search(self, query, limit=10):
+        """
+        Returns recommended sites ranked for a free text query, matching the
+        last word as a prefix. Loads the index on first use.
 
+        >>> api.Recommended_Sites().search('export lo', fields='title,url')
+        """
+        index = self.index or self.load_index()
+        return self.indexed(index.search(query, limit))
+
+    @parameters()
+    def suggest(self, prefix, limit=10):
+        """
+        Returns keywords starting with prefix. Loads the index on first use.
+        Keywords are strings, so a fields projection leaves them as they are.
+
+        >>> api.Recommended_Sites().suggest('cont')
+        """
+        index = self.index or self.load_index()
+        return index.prefix(prefix, 'keyword', limit)
+
+    @parameters()
     def all_sites(self):
         """
         Returns all recommended sites for all keywords and phrases.
@@ -398,8 +958,9 @@ class Recommended_Sites(SBA_API):
 
         >>> api.Recommended_Sites().all_sites()
         """
-        return self.call_api('all_sites/keywords')
+        return self.call_api('all_sites/keywords', 'all_sites')
 
+    @parameters(keyword=Text())
     def by_keyword(self, keyword):
         """
         Returns all recommended sites for a specific keyword.
@@ -410,9 +971,12 @@ class Recommended_Sites(SBA_API):
 
         >>> api.Recommended_Sites().by_keyword('contracting')
         """
+        if self.index is not None:
+            return self.indexed(self.index.by_keyword(keyword))
         url = 'keywords/%s' % keyword
-        return self.call_api(url)
+        return self.call_api(url, 'by_keyword', [keyword])
 
+    @parameters(category=Text())
     def by_category(self, category):
         """
         Returns all recommended sites for a specific category.
@@ -423,9 +987,12 @@ class Recommended_Sites(SBA_API):
 
         >>> api.Recommended_Sites().by_category('managing a business')
         """
+        if self.index is not None:
+            return self.indexed(self.index.by_category(category))
         url = 'category/%s' % category
-        return self.call_api(url)
+        return self.call_api(url, 'by_category', [category])
 
+    @parameters(term=Text())
     def by_master_term(self, term):
         """
         Returns all recommended sites assigned a specific master term.
@@ -437,9 +1004,12 @@ class Recommended_Sites(SBA_API):
 
         >>> api.Recommended_Sites().by_master_term('export')
         """
+        if self.index is not None:
+            return self.indexed(self.index.by_master_term(term))
         url = 'keywords/master_term/%s' % term
-        return self.call_api(url)
+        return self.call_api(url, 'by_master_term', [term])
 
+    @parameters(domain=Domain())
     def by_domain(self, domain):
         """
         Returns all recommended sites belonging to a specific domain
@@ -450,8 +1020,22 @@ class Recommended_Sites(SBA_API):
 
         >>> api.Recommended_Sites().by_domain('irs')
         """
+        if self.index is not None:
+            return self.indexed(self.index.by_domain(domain))
         url = 'keywords/domain/%s' % domain
-        return self.call_api(url)
+        return self.call_api(url, 'by_domain', [domain])
+
+
+def _state_scope(show_county, show_city):
+    """
+    Return the part of a state-wide geodata method name selecting cities,
+    counties or both. Both is the default when neither flag is set.
+    """
+    if show_county and not show_city:
+        return 'county'
+    if show_city and not show_county:
+        return 'city'
+    return 'city_county'
 
 
 class City_And_County_Web_Data(SBA_API):
@@ -459,9 +1043,14 @@ class City_And_County_Web_Data(SBA_API):
     http://www.sba.gov/about-sba-services/7617
     """
 
+    # City and county queries are answered from cached state-wide responses
+    # when there are any.
+    planner = GeodataPlanner()
+
     def __init__(self):
-        self.base_url = 'http://api.sba.gov/geodata'
+        self.base_url = self.api_root + '/geodata'
 
+    @parameters(state=STATE)
     def all_urls_by_state(self, state, show_county, show_city):
         """
         Returns city and county geographic data from GNIS and all associated
@@ -480,16 +1069,27 @@ class City_And_County_Web_Data(SBA_API):
         >>> api.City_And_County_Web_Data().all_urls_by_state('mi', True, False)
         >>> api.City_And_County_Web_Data().all_urls_by_state('tx', False, True)
         """
-        if show_county and show_city:
-            url = 'city_county_links_for_state_of/%s' % state
-        elif not show_county and show_city:
-            url = 'city_links_for_state_of/%s' % state
-        elif show_county and not show_city:
-            url = 'county_links_for_state_of/%s' % state
-        else:
-            url = 'city_county_links_for_state_of/%s' % state
-        return self.call_api(url)
+        url = '%s_links_for_state_of/%s' % (
+            _state_scope(show_county, show_city), state)
+        return self.call_api(url, 'all_urls_by_state',
+                             [state, show_county, show_city])
+
+    @parameters(state=STATE)
+    def iter_all_urls_by_state(self, state, show_county, show_city):
+        """
+        Streaming version of all_urls_by_state: yields one city or county
+        record at a time as the response downloads, so memory stays flat
+        however large the state.
 
+        >>> geodata = api.City_And_County_Web_Data()
+        >>> for record in geodata.iter_all_urls_by_state('tx', True, True):
+        ...     print(record['name'], record['url'])
+        """
+        url = '%s_links_for_state_of/%s' % (
+            _state_scope(show_county, show_city), state)
+        return self.stream_api(url)
+
+    @parameters(state=STATE, county=County())
     def all_urls_by_county(self, state, county):
         """
         Returns All County URLS in a State
@@ -503,8 +1103,9 @@ class City_And_County_Web_Data(SBA_API):
                 'orange county')
         """
         url = 'all_links_for_county_of/%s/%s' % (county, state)
-        return self.call_api(url)
+        return self.call_api(url, 'all_urls_by_county', [state, county])
 
+    @parameters(state=STATE, city=Text())
     def all_urls_by_city(self, state, city):
         """
         Returns All City URLS in a State
@@ -517,8 +1118,9 @@ class City_And_County_Web_Data(SBA_API):
         >>> api.City_And_County_Web_Data().all_urls_by_city('tx', 'dallas')
         """
         url = 'all_links_for_city_of/%s/%s' % (city, state)
-        return self.call_api(url)
+        return self.call_api(url, 'all_urls_by_city', [state, city])
 
+    @parameters(state=STATE)
     def primary_urls_by_state(self, state, show_county, show_city):
         """
         Returns only primary URLS. A primary URL is the official government
@@ -538,16 +1140,12 @@ class City_And_County_Web_Data(SBA_API):
         >>> api.City_And_County_Web_Data().primary_urls_by_state('mi', True, False)
         >>> api.City_And_County_Web_Data().primary_urls_by_state('tx', False, True)
         """
-        if show_county and show_city:
-            url = 'primary_city_county_links_for_state_of/%s' % state
-        elif show_county and not show_city:
-            url = 'primary_county_links_for_state_of/%s' % state
-        elif not show_county and show_city:
-            url = 'primary_city_links_for_state_of/%s' % state
-        else:
-            url = 'primary_city_county_links_for_state_of/%s' % state
-        return self.call_api(url)
+        url = 'primary_%s_links_for_state_of/%s' % (
+            _state_scope(show_county, show_city), state)
+        return self.call_api(url, 'primary_urls_by_state',
+                             [state, show_county, show_city])
 
+    @parameters(state=STATE, county=County())
     def primary_urls_by_county(self, state, county):
         """Returns the primary URL for a specific County
 
@@ -560,8 +1158,9 @@ class City_And_County_Web_Data(SBA_API):
                 'king county')
         """
         url = 'primary_links_for_county_of/%s/%s' % (county, state)
-        return self.call_api(url)
+        return self.call_api(url, 'primary_urls_by_county', [state, county])
 
+    @parameters(state=STATE, city=Text())
     def primary_url_for_city(self, state, city):
         """Returns the primary URL for a specific city
 
@@ -573,8 +1172,9 @@ class City_And_County_Web_Data(SBA_API):
         >>> api.City_And_County_Web_Data().primary_url_for_city('tx', 'dallas')
         """
         url = 'primary_links_for_city_of/%s/%s' % (city, state)
-        return self.call_api(url)
+        return self.call_api(url, 'primary_url_for_city', [state, city])
 
+    @parameters(state=STATE)
     def all_data_by_state(self, state, show_county, show_city):
         """
         Returns data for city and counties, including those that do not
@@ -592,16 +1192,26 @@ class City_And_County_Web_Data(SBA_API):
         >>> api.City_And_County_Web_Data().all_data_by_state('mi', True, False)
         >>> api.City_And_County_Web_Data().all_data_by_state('tx', False, True)
         """
-        if show_county and show_city:
-            url = 'city_county_data_for_state_of/%s' % state
-        elif show_county and not show_city:
-            url = 'county_data_for_state_of/%s' % state
-        elif not show_county and show_city:
-            url = 'city_data_for_state_of/%s' % state
-        else:
-            url = 'city_county_data_for_state_of/%s' % state
-        return self.call_api(url)
+        url = '%s_data_for_state_of/%s' % (
+            _state_scope(show_county, show_city), state)
+        return self.call_api(url, 'all_data_by_state',
+                             [state, show_county, show_city])
+
+    @parameters(state=STATE)
+    def iter_all_data_by_state(self, state, show_county, show_city):
+        """
+        Streaming version of all_data_by_state: yields one city or county
+        record at a time as the response downloads.
+
+        >>> geodata = api.City_And_County_Web_Data()
+        >>> for record in geodata.iter_all_data_by_state('ca', True, True):
+        ...     print(record['full_county_name'])
+        """
+        url = '%s_data_for_state_of/%s' % (
+            _state_scope(show_county, show_city), state)
+        return self.stream_api(url)
 
+    @parameters(state=STATE, city=Text())
     def all_data_by_city(self, state, city):
         """
         Returns Data for a specific City
@@ -614,8 +1224,9 @@ class City_And_County_Web_Data(SBA_API):
         >>> api.City_And_County_Web_Data().all_data_by_city('wa', 'seattle')
         """
         url = 'all_data_for_city_of/%s/%s' % (city, state)
-        return self.call_api(url)
+        return self.call_api(url, 'all_data_by_city', [state, city])
 
+    @parameters(state=STATE, county=County())
     def all_data_by_county(self, state, county):
         """
         Returns Data for a specific County
@@ -629,4 +1240,4 @@ class City_And_County_Web_Data(SBA_API):
                'frederick county')
         """
         url = 'all_data_for_county_of/%s/%s' % (county, state)
-        return self.call_api(url)
+        return self.call_api(url, 'all_data_by_county', [state, county])
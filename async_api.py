@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+"""
+asyncio versions of the SBA API wrappers, using only the standard library.
+
+Every wrapper method returns an awaitable and builds exactly the same URL
+as its blocking counterpart in api.py. The bulk helpers, such as
+Licenses_And_Permits.by_business_type_states, return asynchronous
+iterators of bulk.BulkResult instead.
+
+>>> import asyncio, async_api
+>>> async def lookups():
+...     loans = async_api.Loans_And_Grants()
+...     return await asyncio.gather(loans.federal(), loans.state('ca'))
+>>> asyncio.run(lookups())
+"""
+
+import asyncio
+import io
+import weakref
+from collections import deque
+from itertools import islice
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+
+import api
+from bulk import DEFAULT_WORKERS, BulkResult
+from cache import MISSING
+from cache import Revalidation, response_validators
+from endpoints import parameters
+import projection
+from site_index import SiteIndex
+from transport import (MAX_REDIRECTS, REDIRECT_STATUSES, Response,
+                       decompress)
+
+# One default pool per running event loop, used when no transport is set.
+_default_pools = weakref.WeakKeyDictionary()
+
+
+class AsyncConnectionPool(object):
+    """Keep-alive HTTP/1.1 connections for a single event loop, per host.
+
+    @param maxsize [Integer] Idle connections kept per host.
+    @param idle_timeout [Number] Seconds an idle connection may be reused.
+    @param timeout [Number] Seconds allowed for one request, or None.
+    """
+
+    def __init__(self, maxsize=10, idle_timeout=60, timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+
+    async def _connect(self, scheme, host, port):
+        return await asyncio.open_connection(host, port,
+                                             ssl=(scheme == 'https') or None)
+
+    def _get(self, key):
+        loop = asyncio.get_running_loop()
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer, released = idle.pop()
+            if (loop.time() - released <= self.idle_timeout and
+                    not reader.at_eof() and not writer.is_closing()):
+                return reader, writer
+            writer.close()
+        return None
+
+    def _put(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer, asyncio.get_running_loop().time()))
+        else:
+            writer.close()
+
+    async def urlopen(self, url, headers=None, timeout=None):
+        """Perform a GET request for url and return an api-style Response,
+        following redirects. Raises HTTPError for other statuses but 2xx and
+        304."""
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(self._follow(url, headers or {}),
+                                      timeout)
+
+    async def _follow(self, url, headers):
+        for redirect in range(MAX_REDIRECTS + 1):
+            response = await self._request(url, headers)
+            location = response.headers.get('Location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            url = urljoin(url, location)
+        if response.status >= 300 and response.status != 304:
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, None)
+        return response
+
+    async def _request(self, url, headers):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parts.netloc,
+                 'Connection: keep-alive']
+        lines.extend('%s: %s' % item for item in headers.items())
+        message = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        connection = self._get(key)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = await self._connect(parts.scheme,
+                                                 parts.hostname, port)
+            reader, writer = connection
+            try:
+                writer.write(message)
+                await writer.drain()
+                status, reason, response_headers, body, keep_alive = (
+                    await _read_response(reader))
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                connection, reused = None, False
+            except BaseException:
+                writer.close()
+                raise
+        if keep_alive:
+            self._put(key, reader, writer)
+        else:
+            writer.close()
+        body = decompress(body, response_headers.get('Content-Encoding'))
+        return Response(url, status, reason, response_headers, body)
+
+    def clear(self):
+        """Close every idle connection held by the pool."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for reader, writer, released in connections:
+                writer.close()
+
+
+def default_pool():
+    """Return the AsyncConnectionPool for the running event loop."""
+    loop = asyncio.get_running_loop()
+    pool = _default_pools.get(loop)
+    if pool is None:
+        pool = _default_pools[loop] = AsyncConnectionPool()
+    return pool
+
+
+async def _read_response(reader):
+    """Read one HTTP/1.1 response, returning its parts and keep-alive."""
+    status_line = await reader.readuntil(b'\r\n')
+    version, status, reason = (
+        status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+    headers = {}
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        if line == b'\r\n':
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().title()] = value.strip()
+    if status.startswith('1') or status in ('204', '304'):
+        # These responses never have a body.
+        body = b''
+        keep_alive = True
+    elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if not size:
+                while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+        keep_alive = True
+    elif 'Content-Length' in headers:
+        body = await reader.readexactly(int(headers['Content-Length']))
+        keep_alive = True
+    else:
+        body = await reader.read()
+        keep_alive = False
+    if headers.get('Connection', '').lower() == 'close' or \
+            version == 'HTTP/1.0':
+        keep_alive = False
+    return int(status), reason, headers, body, keep_alive
+
+
+async def fan_out(function, keys, max_workers=DEFAULT_WORKERS,
+                  ordered=False):
+    """
+    Await function(key) for every key, at most max_workers at a time, and
+    yield a bulk.BulkResult per key, like bulk.fan_out. Exceptions are
+    captured in the result instead of aborting the batch.
+
+    @param ordered [Boolean] Yield in the order of keys instead of in
+    completion order.
+
+    >>> async for result in async_api.fan_out(loans.state, ['ca', 'tx']):
+    ...     print(result.key, result.error or len(result.value))
+    """
+    keys = iter(keys)
+
+    async def call(key):
+        try:
+            return BulkResult(key, await function(key), None)
+        except Exception as error:
+            return BulkResult(key, None, error)
+
+    def start(count):
+        return [asyncio.ensure_future(call(key))
+                for key in islice(keys, count)]
+
+    # keys are read as calls finish, so at most max_workers tasks exist at
+    # once however many keys there are.
+    pending = ()
+    try:
+        if ordered:
+            pending = deque(start(max_workers))
+            while pending:
+                result = await pending[0]
+                pending.popleft()
+                yield result
+                pending.extend(start(1))
+        else:
+            pending = set(start(max_workers))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+                    pending.update(start(1))
+    finally:
+        # The caller stopped iterating early.
+        for task in pending:
+            task.cancel()
+
+
+class AsyncSingleFlight(object):
+    """Coalesce concurrent identical awaitables on the running event loop:
+    while function() runs as a task for a key, other tasks calling do with
+    the same key await the same outcome. Cancelling any caller, the first
+    one included, leaves the task running for the others."""
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+
+    async def do(self, key, function):
+        key = (asyncio.get_running_loop(), key)
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = self._calls[key] = asyncio.ensure_future(function())
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Every caller may be gone; don't warn about an unretrieved
+            # error.
+            task.exception()
+
+
+class SBA_API(api.SBA_API):
+    """Awaitable SBA API base. Mixed in ahead of the blocking wrappers so
+    their URL construction is reused unchanged."""
+
+    # Shared by every async wrapper class, like api.SBA_API.transport. An
+    # AsyncConnectionPool only works on the event loop that first uses it;
+    # when unset, each running loop gets its own default pool. The cache,
+    # mirror and rate_limiter are inherited from api.SBA_API; the blocking
+    # AdaptiveConcurrency is not used here.
+    transport = None
+    coalesce = AsyncSingleFlight()
+    fan_out = staticmethod(fan_out)
+
+    async def call_api(self, directory, method=None, args=()):
+        url = self.build_url(directory)
+        self.log_call(method, args)
+        fields = projection.normalize(self.fields)
+        if self.cache is not None:
+            value = self.cached(url, fields)
+            if value is not MISSING:
+                return value
+        if self.planner is not None and (self.mirror is None or
+                                         url not in self.mirror):
+            # Fetching a state-wide response instead would block.
+            value = self.planner.answer(self.unprojected(), directory,
+                                        upgrade=False)
+            if value is not MISSING:
+                return self.project(value, fields)
+        if self.coalesce is not None:
+            key = url if fields is None else (url, fields)
+            return await self.coalesce.do(key,
+                                          lambda: self.load(url, fields))
+        return await self.load(url, fields)
+
+    async def result(self, value):
+        return value
+
+    async def open(self, url):
+        """Request url and return the response, read to the end, or the
+        mirrored body when the mirror has it."""
+        if self.mirror is not None:
+            data = self.mirror.get(url)
+            if data is not None:
+                return Response(url, 200, 'OK', {}, data)
+        if self.rate_limiter is not None:
+            await asyncio.sleep(self.rate_limiter.reserve())
+        transport = self.transport
+        if transport is None:
+            transport = default_pool()
+        return await transport.urlopen(url, headers=self.request_headers(),
+                                       timeout=self.timeout)
+
+    async def stream_api(self, directory):
+        """
+        Like call_api for endpoints returning a JSON array, but an
+        asynchronous iterator over its elements, which are decoded one at a
+        time. The async transport reads the whole body first, so memory is
+        not flat as with api.SBA_API.stream_api. Streamed calls bypass the
+        cache and request coalescing.
+        """
+        response = await self.open(self.build_url(directory))
+        for record in self.iter_records(io.BytesIO(response.read())):
+            yield record
+
+    async def load(self, url, fields=None):
+        whole = fields is None or (self.cache is not None and
+                                   not self.cache.stores_bodies)
+        decode = self.decode if whole else self.decoder(fields)
+        revalidation = Revalidation()
+        if self.cache is not None:
+            revalidation = Revalidation(self.cache.validators(url))
+        data = None
+        if self.mirror is not None:
+            data = self.mirror.get(url)
+        if data is None:
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            transport = self.transport
+            if transport is None:
+                transport = default_pool()
+            headers = self.request_headers()
+            headers.update(revalidation.headers)
+            response = await transport.urlopen(url, headers=headers,
+                                               timeout=self.timeout)
+            data = response.read()
+            revalidation.validators = response_validators(response)
+            if revalidation.headers and response.getcode() == 304:
+                value = self.cache.refresh(url, decode)
+                if value is not MISSING:
+                    return self.project(value, fields) if whole else value
+                response = await transport.urlopen(
+                    url, headers=self.request_headers(), timeout=self.timeout)
+                data = response.read()
+                revalidation.validators = response_validators(response)
+        value = decode(data)
+        if self.cache is not None:
+            self.cache.set(url, data, value, revalidation.validators)
+        if whole:
+            return self.project(value, fields)
+        return value
+
+
+class Licenses_And_Permits(SBA_API, api.Licenses_And_Permits):
+    """Awaitable version of api.Licenses_And_Permits."""
+
+
+class Loans_And_Grants(SBA_API, api.Loans_And_Grants):
+    """Awaitable version of api.Loans_And_Grants."""
+
+
+class Recommended_Sites(SBA_API, api.Recommended_Sites):
+    """Awaitable version of api.Recommended_Sites, with an index of its
+    own."""
+
+    index = None
+
+    async def load_index(self):
+        Recommended_Sites.index = SiteIndex(
+            await self.unprojected().all_sites())
+        return Recommended_Sites.index
+
+    @parameters()
+    async def search(self, query, limit=10):
+        index = self.index or await self.load_index()
+        return self.project(index.search(query, limit),
+                            projection.normalize(self.fields))
+
+    @parameters()
+    async def suggest(self, prefix, limit=10):
+        index = self.index or await self.load_index()
+        return index.prefix(prefix, 'keyword', limit)
+
+
+class City_And_County_Web_Data(SBA_API, api.City_And_County_Web_Data):
+    """Awaitable version of api.City_And_County_Web_Data. The iter_all_*
+    methods return asynchronous iterators over the records."""
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for the SBA API wrappers against a local stub server.
+
+The stub server answers every endpoint family with fixture payloads shaped
+like real api.sba.gov responses, including a multi-megabyte
+all_data_by_state response for Texas, so results do not depend on the
+network. Each scenario is measured for throughput and p50/p99 latency at
+several concurrency levels, over the sequential (urlopen), pooled
+(transport.ConnectionPool) and async (async_api) transports, with a cold
+and a warm cache.
+
+    $ python benchmark.py --output bench_results.json
+    $ python benchmark.py --quick
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:  # pragma: no cover
+    sys.exit('benchmark.py needs Python 3.7 or later')
+
+import api
+import async_api
+import cache
+import decoding
+import metrics
+import transport
+
+# Cities generated per state for the geodata fixtures; Texas and California
+# get the largest responses, as they do upstream.
+CITIES_PER_STATE = {'tx': 12000, 'ca': 9000}
+DEFAULT_CITIES = 400
+
+SCENARIOS = (
+    ('licenses.by_business_type_state', api.Licenses_And_Permits,
+     'by_business_type_state', ('restaurant', 'ca')),
+    ('licenses.by_state', api.Licenses_And_Permits, 'by_state', ('ny',)),
+    ('loans.federal', api.Loans_And_Grants, 'federal', ()),
+    ('loans.by_state_industry_specialty', api.Loans_And_Grants,
+     'by_state_industry_specialty', ('me', 'manufacturing', 'woman')),
+    ('rec_sites.all_sites', api.Recommended_Sites, 'all_sites', ()),
+    ('geodata.all_urls_by_city', api.City_And_County_Web_Data,
+     'all_urls_by_city', ('tx', 'dallas')),
+    ('geodata.all_data_by_state.tx', api.City_And_County_Web_Data,
+     'all_data_by_state', ('tx', True, True)),
+)
+
+
+def _words(rng, count):
+    vocabulary = ('business', 'license', 'permit', 'county', 'state', 'tax',
+                  'registration', 'small', 'loan', 'program', 'office',
+                  'department', 'commerce', 'development', 'city', 'service')
+    return ' '.join(rng.choice(vocabulary) for i in range(count))
+
+
+def geodata_records(state, count=None, seed=0):
+    """City and county records shaped like the geodata API's."""
+    rng = random.Random('%s-%s' % (state, seed))
+    count = count or CITIES_PER_STATE.get(state, DEFAULT_CITIES)
+    counties = ['%s County' % _words(rng, 1).title() for i in range(60)]
+    records = []
+    for index in range(count):
+        is_county = index % 20 == 0
+        county = counties[index % len(counties)]
+        name = county if is_county else '%s %d' % (
+            _words(rng, 1).title(), index)
+        records.append({
+            'county_name': county.replace(' County', ''),
+            'description': _words(rng, 6),
+            'feature_class': 'Civil' if is_county else 'Populated Place',
+            'feature_id': str(100000 + index),
+            'fips_class': 'H1' if is_county else 'C1',
+            'fips_county_cd': str(index % 254),
+            'full_county_name': county,
+            'link_title': None if index % 3 else '%s home page' % name,
+            'url': None if index % 3 else 'http://www.%s.%s.us/' % (
+                name.lower().replace(' ', ''), state),
+            'name': name,
+            'primary_latitude': '%.7f' % rng.uniform(26, 36),
+            'primary_longitude': '%.7f' % rng.uniform(-106, -93),
+            'state_abbreviation': state.upper(),
+            'state_name': 'State of %s' % state.upper(),
+        })
+    return records
+
+
+def license_records(state, count=40, seed=0):
+    rng = random.Random('license-%s-%s' % (state, seed))
+    return [{
+        'title': _words(rng, 4).title(),
+        'description': _words(rng, 30),
+        'url': 'http://www.%s.gov/licensing/%d' % (state, index),
+        'state': state.upper(),
+        'resource_group_description': rng.choice(api.LICENSE_CATEGORIES),
+        'business_type': rng.choice(api.BUSINESS_TYPES),
+        'county': None, 'city': None,
+    } for index in range(count)]
+
+
+def loan_records(state, count=60, seed=0):
+    rng = random.Random('loan-%s-%s' % (state, seed))
+    return [{
+        'title': _words(rng, 5).title(),
+        'agency': _words(rng, 3).title(),
+        'description': _words(rng, 40),
+        'url': 'http://www.%s.gov/programs/%d' % (state, index),
+        'state_name': state.upper(),
+        'industry': rng.choice(api.INDUSTRIES),
+        'specialty': rng.choice(api.SPECIALTIES),
+        'is_general_purpose': index % 2 == 0,
+        'loan_type': rng.choice(('Loan', 'Grant', 'Tax Credit')),
+    } for index in range(count)]
+
+
+def site_records(count=600, seed=0):
+    rng = random.Random('sites-%s' % seed)
+    return [{
+        'title': _words(rng, 4).title(),
+        'url': 'http://www.site%d.gov/' % index,
+        'description': _words(rng, 20),
+        'category': rng.choice(('managing a business', 'starting a business',
+                                'growing a business')),
+        'master_term': _words(rng, 1),
+        'keywords': ', '.join(_words(rng, 5).split()),
+    } for index in range(count)]
+
+
+def fixture(path):
+    """Return the fixture payload for a request path like
+    /geodata/city_county_data_for_state_of/tx.json."""
+    parts = path.strip('/').rsplit('.json', 1)[0].split('/')
+    family, rest = parts[0], parts[1:]
+    state = next((part for part in reversed(rest) if part in api.STATES),
+                 'ca')
+    if family == 'geodata':
+        records = geodata_records(state)
+        if re.match(r'(all|primary)_(data|links)_for_(city|county)_of',
+                    rest[0]):
+            name = rest[1].lower()
+            return [record for record in records
+                    if name in (record['name'].lower(),
+                                record['full_county_name'].lower())][:5] or \
+                records[:3]
+        return records
+    if family == 'license_permit':
+        return license_records(state, 600 if rest[0] == 'all_by_state'
+                               else 40)
+    if family == 'loans_grants':
+        return loan_records(state, 200 if rest[0] == 'federal' else 60)
+    if family == 'rec_sites':
+        return site_records()
+    return []
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body together, like a production server; otherwise
+    # Nagle and delayed ACKs add ~40ms to every kept-alive response.
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+    payloads = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+        key = (self.path, gzipped)
+        with self.lock:
+            body = self.payloads.get(key)
+            if body is None:
+                body = json.dumps(fixture(self.path)).encode('utf-8')
+                if gzipped:
+                    body = gzip.compress(body, 6)
+                self.payloads[key] = body
+        etag = '"%08x"' % (zlib.crc32(body) & 0xffffffff)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(port=0):
+    """Start the stub server in a daemon thread and return it."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), FixtureHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def client(wrapper, server):
+    """Instance of wrapper pointed at the stub server."""
+    instance = wrapper()
+    host = 'http://127.0.0.1:%d' % server.server_port
+    instance.base_url = instance.base_url.replace('http://api.sba.gov', host)
+    return instance
+
+
+def summarize(latencies, elapsed):
+    histogram = metrics.Histogram()
+    for latency in latencies:
+        histogram.record(latency)
+    return {'requests': len(latencies),
+            'throughput': len(latencies) / elapsed if elapsed else None,
+            'p50': histogram.percentile(50), 'p99': histogram.percentile(99),
+            'mean': histogram.mean(), 'max': histogram.max}
+
+
+def run_threaded(instance, method, args, requests, concurrency):
+    def one(i):
+        started = time.time()
+        getattr(instance, method)(*args)
+        return time.time() - started
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(requests)))
+    return summarize(latencies, time.time() - started)
+
+
+def run_async(wrapper, method, args, requests, concurrency, server):
+    async def main():
+        instance = client(wrapper, server)
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with limit:
+                started = time.time()
+                await getattr(instance, method)(*args)
+                return time.time() - started
+
+        started = time.time()
+        latencies = await asyncio.gather(*[one() for i in range(requests)])
+        elapsed = time.time() - started
+        async_api.default_pool().clear()
+        return summarize(latencies, elapsed)
+    return asyncio.run(main())
+
+
+ASYNC_WRAPPERS = {
+    api.Licenses_And_Permits: async_api.Licenses_And_Permits,
+    api.Loans_And_Grants: async_api.Loans_And_Grants,
+    api.Recommended_Sites: async_api.Recommended_Sites,
+    api.City_And_County_Web_Data: async_api.City_And_County_Web_Data,
+}
+
+
+def configure(transport_name, cached):
+    """Set the shared SBA_API settings for one run."""
+    if api.SBA_API.transport is not None:
+        api.SBA_API.transport.clear()
+    api.SBA_API.transport = None
+    api.SBA_API.cache = cache.MemoryCache() if cached else None
+    api.SBA_API.coalesce = None
+    async_api.SBA_API.coalesce = None
+    if transport_name == 'pooled':
+        api.SBA_API.transport = transport.ConnectionPool(maxsize=64)
+
+
+def run(requests=50, concurrency=(1, 4, 16), scenarios=SCENARIOS,
+        transports=('sequential', 'pooled', 'async'), server=None):
+    """Run every scenario and return a list of result dicts."""
+    server = server or start_server()
+    results = []
+    saved = (api.SBA_API.transport, api.SBA_API.cache, api.SBA_API.coalesce,
+             async_api.SBA_API.coalesce)
+    try:
+        for label, wrapper, method, args in scenarios:
+            instance = client(wrapper, server)
+            size = len(instance.fetch(instance.url_for(method, *args)))
+            for transport_name in transports:
+                for cached in (False, True):
+                    if cached and transport_name == 'async':
+                        continue
+                    for workers in concurrency:
+                        configure(transport_name, cached)
+                        count = requests
+                        if cached:
+                            # Warm the cache first; the timed calls all hit.
+                            getattr(instance, method)(*args)
+                        if size > 1024 * 1024 and not cached:
+                            count = max(workers, requests // 10)
+                        if transport_name == 'async':
+                            summary = run_async(ASYNC_WRAPPERS[wrapper],
+                                                method, args, count, workers,
+                                                server)
+                        else:
+                            summary = run_threaded(instance, method, args,
+                                                   count, workers)
+                        summary.update({
+                            'scenario': label, 'transport': transport_name,
+                            'cache': 'warm' if cached else 'cold',
+                            'concurrency': workers, 'payload_bytes': size})
+                        results.append(summary)
+    finally:
+        (api.SBA_API.transport, api.SBA_API.cache, api.SBA_API.coalesce,
+         async_api.SBA_API.coalesce) = saved
+    return results
+
+
+def format_row(result):
+    return ('%-36s %-10s %-4s c=%-3d %10.1f/s p50=%8.2fms p99=%8.2fms '
+            '%9d bytes' % (result['scenario'], result['transport'],
+                           result['cache'], result['concurrency'],
+                           result['throughput'], result['p50'] * 1000,
+                           result['p99'] * 1000, result['payload_bytes']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=50,
+                        help='calls per scenario and concurrency level')
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='comma separated concurrency levels')
+    parser.add_argument('--transport', action='append',
+                        choices=('sequential', 'pooled', 'async'),
+                        help='transports to measure (default: all)')
+    parser.add_argument('--quick', action='store_true',
+                        help='few requests at concurrency 1 and 4 only')
+    parser.add_argument('--json-backend', action='append',
+                        choices=decoding.BACKENDS,
+                        help='JSON decoders to compare (default: %s)' %
+                        decoding.DEFAULT)
+    parser.add_argument('--output', help='write JSON results to this file')
+    options = parser.parse_args(argv)
+    requests = 10 if options.quick else options.requests
+    concurrency = (1, 4) if options.quick else tuple(
+        int(level) for level in options.concurrency.split(','))
+    results = []
+    saved = api.SBA_API.json_backend
+    try:
+        for backend in options.json_backend or [decoding.DEFAULT]:
+            api.SBA_API.json_backend = backend
+            print('JSON backend: %s' % backend)
+            for result in run(requests, concurrency,
+                              transports=options.transport or
+                              ('sequential', 'pooled', 'async')):
+                result['json_backend'] = backend
+                results.append(result)
+                print(format_row(result))
+    finally:
+        api.SBA_API.json_backend = saved
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({'created': time.time(), 'python': sys.version,
+                       'results': results}, output, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Run many wrapper calls concurrently on a bounded thread pool.
+
+>>> import bulk
+>>> for result in bulk.fan_out(loans.state, ['ca', 'tx', 'ny']):
+...     print(result.key, result.error or len(result.value))
+"""
+
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+# key is the item the call was made for, value its result, and error the
+# exception it raised (value is None when error is set).
+BulkResult = namedtuple('BulkResult', 'key value error')
+
+DEFAULT_WORKERS = 8
+
+
+def _call(function, key):
+    try:
+        return BulkResult(key, function(key), None)
+    except Exception as error:
+        return BulkResult(key, None, error)
+
+
+def fan_out(function, keys, max_workers=DEFAULT_WORKERS, ordered=False,
+            window=None):
+    """
+    Call function(key) for every key on at most max_workers threads and
+    yield a BulkResult per key. Exceptions are captured in the result instead
+    of aborting the batch.
+
+    @param ordered [Boolean] Yield in the order of keys instead of in
+    completion order.
+    @param window [Integer] Most calls started but not yet yielded, twice
+    max_workers by default. keys are read as calls are started, so only
+    that many results are held at once however many keys there are, and a
+    slow consumer holds back the calls.
+
+    max_workers is an upper bound: when SBA_API.concurrency is set, workers
+    wait for its adaptive limit before each request.
+    """
+    if window is None:
+        window = 2 * max_workers
+    keys = iter(keys)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+
+        def submit(count):
+            return [pool.submit(_call, function, key)
+                    for key in islice(keys, count)]
+
+        # A call replaces each result once it has been consumed.
+        if ordered:
+            pending = deque(submit(window))
+            while pending:
+                yield pending.popleft().result()
+                pending.extend(submit(1))
+        else:
+            pending = set(submit(window))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                    pending.update(submit(1))
@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+
+"""
+Response caches for SBA_API.call_api, keyed on the fully quoted URL.
+
+>>> import api, cache
+>>> api.SBA_API.cache = cache.MemoryCache(ttl=3600, max_entries=5000,
+...                                       ttls={'geodata': 86400})
+
+A WALCache is shared by every process opening the same file, e.g. the
+workers of one gunicorn server, and survives restarts:
+
+>>> api.SBA_API.cache = cache.WALCache('/var/cache/sba.db', ttl=3600,
+...                                    max_bytes=256 * 1024 * 1024)
+
+Entries keep the ETag and Last-Modified validators of their response. Once
+such an entry expires, call_api revalidates it with a conditional request,
+and a 304 Not Modified response only renews its TTL.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import decoding
+
+# Returned by Cache.get when a URL is not cached or has expired.
+MISSING = object()
+
+# Response headers kept with a cached body, and the conditional request
+# headers they are sent back as.
+VALIDATORS = (('ETag', 'If-None-Match'),
+              ('Last-Modified', 'If-Modified-Since'))
+
+
+def response_validators(response):
+    """Return the validators of an urlopen style response as a dict, or
+    None when it has neither an ETag nor a Last-Modified header."""
+    try:
+        headers = response.info()
+    except AttributeError:
+        return None
+    validators = {}
+    for name, header in VALIDATORS:
+        value = None
+        if headers is not None:
+            # The async transport title-cases header names ('Etag').
+            value = headers.get(name) or headers.get(name.title())
+        if isinstance(value, str):
+            validators[name] = value
+    return validators or None
+
+
+def conditional_headers(validators):
+    """Request headers revalidating a response with validators."""
+    return dict((header, validators[name]) for name, header in VALIDATORS
+                if name in (validators or {}))
+
+
+class Revalidation(object):
+    """State of one conditional download: the request headers to send and,
+    once it is made, the response's validators and whether it was a 304."""
+
+    def __init__(self, validators=None):
+        self.headers = conditional_headers(validators)
+        self.validators = None
+        self.not_modified = False
+
+
+class Cache(object):
+    """Base class holding TTL policy, size limits and counters.
+
+    @param ttl [Number] Seconds an entry stays fresh, or None for no expiry.
+    @param ttls [Dict] Per-endpoint TTLs keyed by a path prefix below the
+    host, e.g. {'geodata': 86400, 'loans_grants/federal': 3600}. The longest
+    matching prefix wins, falling back to ttl.
+    @param max_entries [Integer] Most entries kept, or None for no limit.
+    @param max_bytes [Integer] Most response bytes kept, or None for no limit.
+    Least recently used entries are evicted first.
+    """
+
+    # True for backends storing raw bodies and decoding them on each hit
+    # with the decode function passed to get.
+    stores_bodies = False
+
+    def __init__(self, ttl=None, ttls=None, max_entries=None, max_bytes=None):
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self._lock = threading.RLock()
+
+    def ttl_for(self, url):
+        """Return the TTL in seconds that applies to url."""
+        path = urlsplit(url).path.lstrip('/')
+        best = None
+        for prefix in self.ttls:
+            if path.startswith(prefix) and (best is None or
+                                            len(prefix) > len(best)):
+                best = prefix
+        if best is None:
+            return self.ttl
+        return self.ttls[best]
+
+    def expiry_for(self, url):
+        ttl = self.ttl_for(url)
+        if ttl is None:
+            return None
+        return time.time() + ttl
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'revalidations': self.revalidations}
+
+    def get(self, url, decode=None):
+        """Return the cached value for url, or MISSING. Backends storing raw
+        bodies decode them with decode (decoding.loads by default). Expired
+        entries with validators are kept for revalidation."""
+        raise NotImplementedError
+
+    def peek(self, url, decode=None):
+        """Like get, but without counting a hit or miss or touching the
+        entry's recency; for lookups that are not the caller's own, such
+        as a planner probing for pieces."""
+        raise NotImplementedError
+
+    def set(self, url, body, value, validators=None):
+        """Store value, decoded from the raw response body, under url along
+        with the response's validators, if any."""
+        raise NotImplementedError
+
+    def validators(self, url):
+        """Return the validators stored for url, fresh or not, or None."""
+        raise NotImplementedError
+
+    def refresh(self, url, decode=None):
+        """Renew the TTL of url's entry after a 304 Not Modified response
+        and return its value, or MISSING if it has been evicted since."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(Cache):
+    """In-process LRU cache of decoded responses. Cached values are shared
+    between callers and should be treated as read-only."""
+
+    def __init__(self, *args, **kwargs):
+        super(MemoryCache, self).__init__(*args, **kwargs)
+        self._entries = OrderedDict()
+        self.size = 0
+
+    def get(self, url, decode=None):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                value, size, expires, validators = entry
+                if expires is None or expires > time.time():
+                    self._entries.move_to_end(url)
+                    self.hits += 1
+                    return value
+                if validators is None:
+                    self._remove(url)
+            self.misses += 1
+            return MISSING
+
+    def peek(self, url, decode=None):
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is not None and (entry[2] is None or entry[2] > time.time()):
+            return entry[0]
+        return MISSING
+
+    def set(self, url, body, value, validators=None):
+        size = len(body)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if url in self._entries:
+                self._remove(url)
+            self._entries[url] = (value, size, self.expiry_for(url),
+                                  validators)
+            self.size += size
+            while ((self.max_entries is not None and
+                    len(self._entries) > self.max_entries) or
+                   (self.max_bytes is not None and
+                    self.size > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def validators(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            return None if entry is None else entry[3]
+
+    def refresh(self, url, decode=None):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return MISSING
+            value, size, expires, validators = entry
+            self._entries[url] = (value, size, self.expiry_for(url),
+                                  validators)
+            self._entries.move_to_end(url)
+            self.revalidations += 1
+            return value
+
+    def _remove(self, url):
+        value, size, expires, validators = self._entries.pop(url)
+        self.size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache(Cache):
+    """On-disk cache of raw response bodies in a SQLite database, decoded
+    again on each hit, including after a revalidation.
+
+    @param path [String] Database file, created if it does not exist.
+    @param access_resolution [Number] Hits update an entry's access time
+    only when it is older than this many seconds, so reads rarely write;
+    LRU eviction is accurate to this resolution.
+    """
+
+    stores_bodies = True
+
+    def __init__(self, path, *args, **kwargs):
+        self.access_resolution = kwargs.pop('access_resolution', 60)
+        super(SQLiteCache, self).__init__(*args, **kwargs)
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'url TEXT PRIMARY KEY, body BLOB, size INTEGER, '
+                         'expires REAL, accessed REAL, validators TEXT)')
+        try:
+            # Databases created before validators were stored.
+            self._db.execute('ALTER TABLE responses '
+                             'ADD COLUMN validators TEXT')
+        except sqlite3.OperationalError:
+            pass
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                         'ON responses (accessed)')
+        self._db.commit()
+
+    def get(self, url, decode=None):
+        with self._lock:
+            row = self._db.execute('SELECT body, expires, accessed, '
+                                   'validators FROM responses '
+                                   'WHERE url = ?', (url,)).fetchone()
+            now = time.time()
+            body = None
+            if row is not None:
+                stored, expires, accessed, validators = row
+                if expires is None or expires > now:
+                    if now - accessed > self.access_resolution:
+                        self._db.execute('UPDATE responses SET accessed = ? '
+                                         'WHERE url = ?', (now, url))
+                        self._db.commit()
+                    self.hits += 1
+                    body = stored
+                elif validators is None:
+                    self._db.execute('DELETE FROM responses WHERE url = ?',
+                                     (url,))
+                    self._db.commit()
+            if body is None:
+                self.misses += 1
+                return MISSING
+        # Decoding a large body does not hold up other threads' lookups.
+        return (decode or decoding.loads)(body)
+
+    def peek(self, url, decode=None):
+        with self._lock:
+            row = self._db.execute('SELECT body, expires FROM responses '
+                                   'WHERE url = ?', (url,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return MISSING
+        return (decode or decoding.loads)(row[0])
+
+    def set(self, url, body, value, validators=None):
+        size = len(body)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if validators is not None:
+            validators = json.dumps(validators)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses '
+                             '(url, body, size, expires, accessed, '
+                             'validators) VALUES (?, ?, ?, ?, ?, ?)',
+                             (url, sqlite3.Binary(body), size,
+                              self.expiry_for(url), time.time(), validators))
+            self._evict()
+            self._db.commit()
+
+    def validators(self, url):
+        with self._lock:
+            row = self._db.execute('SELECT validators FROM responses '
+                                   'WHERE url = ?', (url,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def refresh(self, url, decode=None):
+        with self._lock:
+            row = self._db.execute('SELECT body FROM responses '
+                                   'WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                return MISSING
+            self._db.execute('UPDATE responses SET expires = ?, '
+                             'accessed = ? WHERE url = ?',
+                             (self.expiry_for(url), time.time(), url))
+            self._db.commit()
+            self.revalidations += 1
+        return (decode or decoding.loads)(row[0])
+
+    def _evict(self):
+        count, total = self._db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) '
+            'FROM responses').fetchone()
+        rows = self._db.execute('SELECT url, size FROM responses '
+                                'ORDER BY accessed')
+        doomed = []
+        for url, size in rows:
+            if not ((self.max_entries is not None and
+                     count > self.max_entries) or
+                    (self.max_bytes is not None and total > self.max_bytes)):
+                break
+            doomed.append((url,))
+            count -= 1
+            total -= size
+        self._db.executemany('DELETE FROM responses WHERE url = ?', doomed)
+        self.evictions += len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+class _ThreadConnection(object):
+    """Holds one thread's WALCache connection in its thread-local data, so
+    the connection can be closed once the thread exits."""
+
+    def __init__(self, db):
+        self.db = db
+
+
+class WALCache(Cache):
+    """On-disk cache of compressed raw response bodies in a SQLite database
+    in WAL mode, shared by every thread and process that opens the same
+    file: readers do not block each other or the single writer, and entries
+    survive restarts. A background thread deletes expired entries that
+    cannot be revalidated, checkpoints the WAL and returns free pages to the
+    file system.
+
+    max_bytes bounds the compressed size.
+
+    @param path [String] Database file, created if it does not exist.
+    @param level [Integer] zlib compression level of stored bodies.
+    @param access_resolution [Number] Hits update an entry's access time
+    only when it is older than this many seconds, so reads rarely write;
+    LRU eviction is accurate to this resolution.
+    @param vacuum_interval [Number] Seconds between background vacuums, or
+    None to only vacuum when vacuum() is called.
+    @param busy_timeout [Number] Seconds to wait for another writer.
+    """
+
+    stores_bodies = True
+
+    def __init__(self, path, *args, **kwargs):
+        self.level = kwargs.pop('level', 6)
+        self.access_resolution = kwargs.pop('access_resolution', 60)
+        vacuum_interval = kwargs.pop('vacuum_interval', 300)
+        self.busy_timeout = kwargs.pop('busy_timeout', 30)
+        super(WALCache, self).__init__(*args, **kwargs)
+        self.path = path
+        self.vacuums = 0
+        self._local = threading.local()
+        # Closes each live thread's connection; finalizers of threads that
+        # have exited are dropped as new connections are made.
+        self._closers = []
+        self._closed = threading.Event()
+        db = self._connection()
+        # auto_vacuum only takes effect before the first table is created.
+        db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS compressed_responses ('
+                   'url TEXT PRIMARY KEY, body BLOB, compressed INTEGER, '
+                   'size INTEGER, expires REAL, accessed REAL, '
+                   'validators TEXT)')
+        db.execute('CREATE INDEX IF NOT EXISTS compressed_accessed '
+                   'ON compressed_responses (accessed)')
+        self._vacuumer = None
+        if vacuum_interval is not None:
+            self._vacuumer = threading.Thread(target=self._vacuum_loop,
+                                              args=(vacuum_interval,))
+            self._vacuumer.daemon = True
+            self._vacuumer.start()
+
+    def _connection(self):
+        """This thread's connection; SQLite connections are not shared
+        between threads so that reads run concurrently. It is closed when
+        the thread exits, or by close()."""
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA synchronous = NORMAL')
+            holder = self._local.holder = _ThreadConnection(db)
+            with self._lock:
+                self._closers = [closer for closer in self._closers
+                                 if closer.alive]
+                self._closers.append(weakref.finalize(holder, db.close))
+        return holder.db
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @staticmethod
+    def _body(blob, compressed):
+        return zlib.decompress(blob) if compressed else bytes(blob)
+
+    def get(self, url, decode=None):
+        db = self._connection()
+        row = db.execute('SELECT body, compressed, expires, accessed, '
+                         'validators FROM compressed_responses '
+                         'WHERE url = ?', (url,)).fetchone()
+        now = time.time()
+        if row is not None:
+            blob, compressed, expires, accessed, validators = row
+            if expires is None or expires > now:
+                if now - accessed > self.access_resolution:
+                    db.execute('UPDATE compressed_responses SET accessed = ? '
+                               'WHERE url = ?', (now, url))
+                self._count('hits')
+                return (decode or decoding.loads)(
+                    self._body(blob, compressed))
+            if validators is None:
+                db.execute('DELETE FROM compressed_responses WHERE url = ? '
+                           'AND expires = ?', (url, expires))
+        self._count('misses')
+        return MISSING
+
+    def peek(self, url, decode=None):
+        row = self._connection().execute(
+            'SELECT body, compressed, expires FROM compressed_responses '
+            'WHERE url = ?', (url,)).fetchone()
+        if row is None or (row[2] is not None and row[2] <= time.time()):
+            return MISSING
+        return (decode or decoding.loads)(self._body(row[0], row[1]))
+
+    def set(self, url, body, value, validators=None):
+        blob = zlib.compress(body, self.level)
+        compressed = len(blob) < len(body)
+        if not compressed:
+            blob = body
+        size = len(blob)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if validators is not None:
+            validators = json.dumps(validators)
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT OR REPLACE INTO compressed_responses '
+                       '(url, body, compressed, size, expires, accessed, '
+                       'validators) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (url, sqlite3.Binary(blob), int(compressed), size,
+                        self.expiry_for(url), time.time(), validators))
+            self._evict(db)
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def validators(self, url):
+        row = self._connection().execute(
+            'SELECT validators FROM compressed_responses WHERE url = ?',
+            (url,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def refresh(self, url, decode=None):
+        db = self._connection()
+        now = time.time()
+        updated = db.execute('UPDATE compressed_responses SET expires = ?, '
+                             'accessed = ? WHERE url = ?',
+                             (self.expiry_for(url), now, url)).rowcount
+        if not updated:
+            return MISSING
+        row = db.execute('SELECT body, compressed FROM compressed_responses '
+                         'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return MISSING
+        self._count('revalidations')
+        return (decode or decoding.loads)(self._body(*row))
+
+    def _evict(self, db):
+        if self.max_entries is None and self.max_bytes is None:
+            return
+        count, total = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) '
+            'FROM compressed_responses').fetchone()
+        doomed = []
+        for url, size in db.execute('SELECT url, size FROM '
+                                    'compressed_responses ORDER BY accessed'):
+            if not ((self.max_entries is not None and
+                     count > self.max_entries) or
+                    (self.max_bytes is not None and total > self.max_bytes)):
+                break
+            doomed.append((url,))
+            count -= 1
+            total -= size
+        db.executemany('DELETE FROM compressed_responses WHERE url = ?',
+                       doomed)
+        with self._lock:
+            self.evictions += len(doomed)
+
+    def vacuum(self):
+        """Delete expired entries without validators, checkpoint the WAL
+        into the database and release free pages."""
+        db = self._connection()
+        db.execute('DELETE FROM compressed_responses WHERE expires < ? '
+                   'AND validators IS NULL', (time.time(),))
+        db.execute('PRAGMA incremental_vacuum')
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._count('vacuums')
+
+    def _vacuum_loop(self, interval):
+        while not self._closed.wait(interval):
+            try:
+                self.vacuum()
+            except sqlite3.Error:
+                # Busy or closing; try again next interval.
+                pass
+
+    def clear(self):
+        self._connection().execute('DELETE FROM compressed_responses')
+
+    def close(self):
+        self._closed.set()
+        if self._vacuumer is not None:
+            self._vacuumer.join()
+        with self._lock:
+            closers, self._closers = self._closers, []
+        for closer in closers:
+            closer()
+        self._local = threading.local()
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM compressed_responses').fetchone()[0]
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+Multi-process crawler for Loans_And_Grants.by_state_industry_specialty.
+
+Every state, industry and specialty combination (about 4,000 calls) is
+fetched and decoded on a pool of worker processes, so decoding is not bound
+to one core. The parent writes each raw response, with its records pickled
+by the worker, to one SQLite store, so reading the results back does not
+decode JSON again. Combinations already in the store are skipped, so an
+interrupted crawl resumes where it stopped.
+
+>>> import crawler
+>>> crawl = crawler.Crawler('sba-programs.db')
+>>> crawl.run(processes=8)
+Summary(fetched=4158, skipped=0, failures=[])
+>>> len(crawl.programs())
+
+From the command line:
+
+    $ python crawler.py sba-programs.db --processes 8
+"""
+
+import argparse
+import itertools
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import api
+import decoding
+from planner import merge
+from transport import ConnectionPool
+
+# fetched and skipped count combinations downloaded by this run and already
+# in the store; failures holds (combination, error message) pairs, which a
+# later run retries.
+Summary = namedtuple('Summary', 'fetched skipped failures')
+
+# The wrapper instance of each worker process, set up by _initialize.
+_client = None
+
+
+def combinations(states=api.STATES, industries=api.INDUSTRIES,
+                 specialties=api.SPECIALTIES):
+    """Yield every (state, industry, specialty) combination."""
+    return itertools.product(states, industries, specialties)
+
+
+def _initialize(root, timeout, retries):
+    """Set up a worker process: one kept-alive connection, no cache."""
+    global _client
+    api.SBA_API.cache = None
+    api.SBA_API.mirror = None
+    api.SBA_API.coalesce = None
+    api.SBA_API.query_log = None
+    api.SBA_API.transport = ConnectionPool(maxsize=1)
+    if root is not None:
+        api.SBA_API.api_root = root
+    _client = api.Loans_And_Grants()
+    _client.timeout = timeout
+    _client.retries = retries
+
+
+def _fetch(combination):
+    """
+    Fetch and decode one combination in a worker process. Returns
+    (combination, url, body, pickled records, program count, error
+    message); exceptions are returned as text since they may not pickle.
+    """
+    try:
+        url = _client.url_for('by_state_industry_specialty', *combination)
+        body = _client.fetch(url)
+        value = _client.decode(body)
+    except Exception as error:
+        return combination, None, None, None, None, '%s: %s' % (
+            type(error).__name__, error)
+    count = len(value) if isinstance(value, list) else 0
+    return (combination, url, body,
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL), count, None)
+
+
+class Crawler(object):
+    """SQLite store of by_state_industry_specialty responses, filled by a
+    process pool.
+
+    @param path [String] Database file, created if needed.
+    @param root [String] Root URL to crawl instead of SBA_API.api_root,
+    e.g. a gateway.Gateway.
+    """
+
+    def __init__(self, path, root=None):
+        self.path = path
+        self.root = root.rstrip('/') if root else root
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'state TEXT, industry TEXT, specialty TEXT, '
+                         'url TEXT, body BLOB, programs INTEGER, '
+                         'fetched REAL, records BLOB, '
+                         'PRIMARY KEY (state, industry, specialty))')
+        try:
+            # Stores created before the workers' records were kept.
+            self._db.execute('ALTER TABLE responses ADD COLUMN records BLOB')
+        except sqlite3.OperationalError:
+            pass
+        self._db.commit()
+
+    def done(self):
+        """Set of the combinations already in the store."""
+        with self._lock:
+            return set(self._db.execute(
+                'SELECT state, industry, specialty FROM responses'))
+
+    def add(self, combination, url, body, records, count):
+        """Store a combination's raw response body and its records as
+        pickled by _fetch."""
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO responses '
+                             '(state, industry, specialty, url, body, '
+                             'records, programs, fetched) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             tuple(combination) + (
+                                 url, sqlite3.Binary(body),
+                                 sqlite3.Binary(records), count,
+                                 time.time()))
+            self._db.commit()
+
+    def run(self, space=None, processes=None, timeout=30, retries=2,
+            progress=None):
+        """
+        Fetch every combination of space (combinations() by default) not
+        already stored, on processes worker processes (one per core by
+        default), and return a Summary.
+
+        @param timeout [Number] Seconds each call may take, retries included.
+        @param retries [Integer] Retries of a failed download.
+        @param progress [Function] Called as progress(done, total) after
+        each combination fetched by this run.
+        """
+        space = [tuple(combination) for combination in
+                 (combinations() if space is None else space)]
+        done = self.done()
+        todo = [combination for combination in space
+                if combination not in done]
+        fetched = 0
+        failures = []
+        if todo:
+            with ProcessPoolExecutor(
+                    max_workers=processes or os.cpu_count() or 1,
+                    initializer=_initialize,
+                    initargs=(self.root, timeout, retries)) as pool:
+                futures = [pool.submit(_fetch, combination)
+                           for combination in todo]
+                for count, future in enumerate(as_completed(futures)):
+                    (combination, url, body, records, programs,
+                     error) = future.result()
+                    if error is None:
+                        self.add(combination, url, body, records, programs)
+                        fetched += 1
+                    else:
+                        failures.append((combination, error))
+                    if progress is not None:
+                        progress(count + 1, len(todo))
+        return Summary(fetched, len(space) - len(todo), failures)
+
+    def results(self):
+        """Yield (state, industry, specialty, decoded response) for every
+        stored combination, unpickling the records decoded by the workers."""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT state, industry, specialty, body, records '
+                'FROM responses '
+                'ORDER BY state, industry, specialty').fetchall()
+        for state, industry, specialty, body, records in rows:
+            if records is None:
+                value = decoding.loads(body)
+            else:
+                value = pickle.loads(records)
+            yield state, industry, specialty, value
+
+    def programs(self):
+        """Every stored program once, de-duplicated by URL."""
+        return merge(*(value for state, industry, specialty, value
+                       in self.results() if isinstance(value, list)))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('store', help='SQLite database to fill or resume')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--states', help='comma separated states '
+                        '(default: all)')
+    parser.add_argument('--root', default=None,
+                        help='root URL to crawl (default: %s)' %
+                        api.SBA_API.api_root)
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds per call, retries included')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='retries of a failed download')
+    options = parser.parse_args(argv)
+    states = api.STATES
+    if options.states:
+        states = tuple(state.strip().lower()
+                       for state in options.states.split(','))
+    started = time.time()
+
+    def progress(done, total):
+        sys.stderr.write('\r%d/%d %.1f/s' % (
+            done, total, done / max(time.time() - started, 1e-9)))
+
+    crawl = Crawler(options.store, options.root)
+    try:
+        summary = crawl.run(combinations(states), options.processes,
+                            options.timeout, options.retries, progress)
+    finally:
+        crawl.close()
+    sys.stderr.write('\nfetched %d, skipped %d, failed %d\n' % (
+        summary.fetched, summary.skipped, len(summary.failures)))
+    for combination, error in summary.failures:
+        sys.stderr.write('failed: %s: %s\n' % ('/'.join(combination), error))
+    return 1 if summary.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+JSON decoder backends for SBA API responses.
+
+The fastest installed backend is chosen at import time: orjson, ujson,
+simplejson with its C speedups, then the standard library json module.
+Every backend decodes str, bytes, bytearray and memoryview input. Set the
+SBA_JSON_BACKEND environment variable, or SBA_API.json_backend, to force one,
+e.g. to benchmark them against each other.
+
+>>> import api, decoding
+>>> decoding.DEFAULT
+'orjson'
+>>> decoding.available()
+['orjson', 'json']
+>>> api.SBA_API.json_backend = 'json'
+"""
+
+import os
+
+# In order of preference.
+BACKENDS = ('orjson', 'ujson', 'simplejson', 'json')
+
+
+def _orjson():
+    import orjson
+    # Decodes bytes, bytearray and memoryview without a str copy.
+    return orjson.loads
+
+
+def _ujson():
+    import ujson
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return ujson.loads(data)
+    return loads
+
+
+def _simplejson():
+    import simplejson
+    from simplejson import _speedups  # noqa: F401, only worth it with C
+
+    def loads(data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode('utf-8')
+        return simplejson.loads(data)
+    return loads
+
+
+def _json():
+    import json
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+    return loads
+
+
+_importers = {'orjson': _orjson, 'ujson': _ujson,
+              'simplejson': _simplejson, 'json': _json}
+_loaders = {}
+
+
+def get(name):
+    """Return the loads function of the named backend. Raises ValueError
+    for an unknown name and ImportError if it is not installed."""
+    loads = _loaders.get(name)
+    if loads is None:
+        if name not in _importers:
+            raise ValueError('Unknown JSON backend %r, expected one of %s' %
+                             (name, ', '.join(BACKENDS)))
+        loads = _loaders[name] = _importers[name]()
+    return loads
+
+
+def available():
+    """Names of the installed backends, in order of preference."""
+    names = []
+    for name in BACKENDS:
+        try:
+            get(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def _default():
+    name = os.environ.get('SBA_JSON_BACKEND')
+    if name:
+        get(name)
+        return name
+    return available()[0]
+
+
+# Backend used when SBA_API.json_backend is None.
+DEFAULT = _default()
+_default_loads = get(DEFAULT)
+
+
+def loads(data, backend=None):
+    """Decode a JSON document with the named backend, or DEFAULT."""
+    if backend is None:
+        return _default_loads(data)
+    return get(backend)(data)
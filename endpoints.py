@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Declarative parameter domains for the SBA API wrapper methods.
+
+Each wrapper method declares the domain of its parameters with the
+parameters decorator. Arguments are normalized (case, whitespace, county
+suffixes...) before the URL is built, so equivalent queries share one URL
+and cache key, and invalid values raise InvalidParameter locally instead of
+costing a round trip.
+
+>>> import api, endpoints
+>>> api.Licenses_And_Permits().url_for('by_business_type_state',
+...                                    ' Restaurant ', 'CA')
+'http://api.sba.gov/license_permit/state_only/restaurant/ca.json'
+>>> api.Licenses_And_Permits().by_state('xx')
+InvalidParameter: Licenses_And_Permits.by_state: invalid state 'xx' ...
+>>> endpoints.REGISTRY['Loans_And_Grants.by_state_industry'].describe()
+{'state': 'one of al, ak, ...', 'industry': 'one of agriculture, ...'}
+"""
+
+import copy
+import difflib
+import functools
+import re
+
+import projection
+
+# Wrapper method qualified name, e.g. 'Loans_And_Grants.state', to its
+# Endpoint.
+REGISTRY = {}
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+class InvalidParameter(ValueError):
+    """Raised before any request is made when an argument is outside its
+    parameter's domain."""
+
+    def __init__(self, method, name, value, reason):
+        self.method = method
+        self.name = name
+        self.value = value
+        self.reason = reason
+        super(InvalidParameter, self).__init__(
+            '%s: invalid %s %r, %s' % (method, name, value, reason))
+
+
+def clean(value):
+    """Lower case text with surrounding and repeated whitespace removed."""
+    if not isinstance(value, str):
+        raise ValueError('expected a string')
+    value = _WHITESPACE.sub(' ', value).strip().lower()
+    if not value:
+        raise ValueError('expected a non-empty string')
+    return value
+
+
+class Text(object):
+    """Free text such as a keyword or city name."""
+
+    def normalize(self, value, arguments):
+        return clean(value)
+
+    def describe(self):
+        return 'any non-empty text'
+
+
+class Choice(Text):
+    """One of a fixed set of values, with optional aliases mapping other
+    spellings onto them.
+
+    @param values [Tuple] The allowed values, lower case.
+    @param aliases [Dict] Alternative spelling to allowed value.
+    """
+
+    def __init__(self, values, aliases=None):
+        self.values = tuple(values)
+        self.aliases = aliases or {}
+        self._allowed = frozenset(self.values)
+
+    def normalize(self, value, arguments):
+        value = clean(value)
+        value = self.aliases.get(value, value)
+        if value not in self._allowed:
+            close = difflib.get_close_matches(value, self.values, 1)
+            if close:
+                raise ValueError('did you mean %r?' % close[0])
+            raise ValueError('expected %s' % self.describe())
+        return value
+
+    def describe(self):
+        return 'one of %s' % ', '.join(self.values)
+
+
+class Combination(Choice):
+    """One or more allowed values joined with '-', e.g. 'woman-rural'.
+    Spaces inside a value are read as underscores."""
+
+    def normalize(self, value, arguments):
+        parts = [super(Combination, self).normalize(
+            clean(part).replace(' ', '_'), arguments)
+            for part in clean(value).split('-')]
+        return '-'.join(parts)
+
+    def describe(self):
+        return "'-' separated values from %s" % ', '.join(self.values)
+
+
+class ZipCode(object):
+    """Five digit zip code, given as a string or an integer. ZIP+4 codes
+    are cut down to their first five digits."""
+
+    _pattern = re.compile(r'^(\d{5})(-\d{4})?$')
+
+    def normalize(self, value, arguments):
+        if isinstance(value, int) and not isinstance(value, bool):
+            value = '%05d' % value
+        match = self._pattern.match(str(value).strip())
+        if match is None:
+            raise ValueError('expected %s' % self.describe())
+        return match.group(1)
+
+    def describe(self):
+        return 'a five digit zip code'
+
+
+class County(Text):
+    """County name, with the suffix the SBA APIs expect appended when it is
+    missing: 'Orange' and 'Orange  County' both become 'orange county', and
+    Louisiana's counties are parishes. Alaska's boroughs and census areas
+    have no single suffix and are left alone.
+
+    @param state [String] Name of the state parameter of the same method.
+    """
+
+    SUFFIXES = ('county', 'parish', 'borough', 'census area', 'municipality',
+                'city')
+
+    def __init__(self, state='state'):
+        self.state = state
+
+    def normalize(self, value, arguments):
+        value = clean(value)
+        if value.endswith(' co.') or value.endswith(' co'):
+            value = value.rsplit(' ', 1)[0] + ' county'
+        if any(value == suffix or value.endswith(' ' + suffix)
+               for suffix in self.SUFFIXES):
+            return value
+        state = arguments.get(self.state)
+        if state == 'ak':
+            return value
+        return '%s %s' % (value, 'parish' if state == 'la' else 'county')
+
+    def describe(self):
+        return "a county name, e.g. 'orange county'"
+
+
+class Domain(Text):
+    """Web domain name without the www or top level domain, e.g. 'irs' for
+    www.irs.gov."""
+
+    def normalize(self, value, arguments):
+        value = clean(value)
+        value = re.sub(r'^[a-z]+://', '', value).split('/', 1)[0]
+        if value.startswith('www.'):
+            value = value[4:]
+        name = value.rsplit('.', 1)[0] if '.' in value else value
+        if not name:
+            raise ValueError('expected %s' % self.describe())
+        return name
+
+    def describe(self):
+        return "a domain name without www or its suffix, e.g. 'irs'"
+
+
+class Endpoint(object):
+    """A wrapper method and the domains of its parameters."""
+
+    def __init__(self, name, parameters, domains):
+        self.name = name
+        self.parameters = parameters
+        self.domains = domains
+        self._checks = [(position, parameter, domains[parameter])
+                        for position, parameter in enumerate(parameters)
+                        if parameter in domains]
+
+    def normalize(self, args, kwargs):
+        """Return args and kwargs with every declared parameter normalized.
+        Raises InvalidParameter."""
+        args = list(args)
+        arguments = {}
+        for position, name, domain in self._checks:
+            if position < len(args):
+                container, key = args, position
+            elif name in kwargs:
+                container, key = kwargs, name
+            else:
+                continue
+            value = container[key]
+            try:
+                container[key] = arguments[name] = domain.normalize(
+                    value, arguments)
+            except ValueError as error:
+                raise InvalidParameter(self.name, name, value, str(error))
+        return args, kwargs
+
+    def describe(self):
+        return dict((name, domain.describe())
+                    for name, domain in self.domains.items())
+
+
+def parameters(**domains):
+    """
+    Declare the domains of a wrapper method's parameters, by name.
+    Arguments are normalized in the order of the method's signature, so a
+    County domain sees the already normalized state. Checking is skipped
+    when the wrapper's validate setting is False.
+
+    The decorated method also takes a fields keyword argument, the field
+    projection applied to its result (see projection.py).
+    """
+    def decorate(function):
+        code = function.__code__
+        names = code.co_varnames[1:code.co_argcount]
+        unknown = set(domains) - set(names)
+        if unknown:
+            raise TypeError('%s has no parameters %s' % (
+                function.__name__, ', '.join(sorted(unknown))))
+        qualname = getattr(function, '__qualname__', function.__name__)
+        endpoint = REGISTRY[qualname] = Endpoint(qualname, names, domains)
+
+        @functools.wraps(function)
+        def validated(self, *args, **kwargs):
+            fields = kwargs.pop('fields', None)
+            if fields is not None:
+                try:
+                    fields = projection.normalize(fields)
+                except ValueError as error:
+                    raise InvalidParameter(qualname, 'fields', fields,
+                                           str(error))
+                # A projected copy, so calls made through it (bulk helpers
+                # calling single state methods) project too.
+                self = copy.copy(self)
+                self.fields = fields
+            if self.validate:
+                args, kwargs = endpoint.normalize(args, kwargs)
+            return function(self, *args, **kwargs)
+        validated.endpoint = endpoint
+        return validated
+    return decorate
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Local caching gateway shared by many worker processes (Python 3 only).
+
+The gateway is an HTTP server speaking the same /<family>/<path>.json URL
+scheme as api.sba.gov. It keeps one cache for every process on the host,
+revalidates expired entries upstream with their ETag/Last-Modified, and
+coalesces concurrent requests for the same URL into one upstream download.
+Point the wrappers at it with a single setting:
+
+    $ python gateway.py --port 8421 --cache sba-gateway.db --ttl 3600
+
+>>> import api
+>>> api.SBA_API.api_root = 'http://127.0.0.1:8421'
+>>> api.Loans_And_Grants().federal()
+
+or run it inside an existing process:
+
+>>> import gateway
+>>> server = gateway.Gateway(cache.MemoryCache(ttl=3600), port=0).start()
+>>> api.SBA_API.api_root = server.url
+"""
+
+import argparse
+import json
+import re
+import sys
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import api
+from cache import MemoryCache, SQLiteCache
+from singleflight import SingleFlight
+from transport import ConnectionPool
+
+DEFAULT_PORT = 8421
+
+# /loans_grants/state_financing_for/ia.json
+_PATH = re.compile(r'^/([a-z_]+)/(.+)\.json$')
+
+
+class Upstream(api.SBA_API):
+    """SBA_API client whose values are the raw response bodies, so the
+    gateway's cache and coalescing hand back bytes to serve as they are."""
+
+    planner = None
+    query_log = None
+    validate = False
+    fields = None
+
+    def __init__(self, root):
+        self.base_url = root
+
+    def decode(self, data, fields=None):
+        return bytes(data)
+
+
+def etag(body):
+    """Entity tag the gateway serves body with."""
+    return '"%x-%08x"' % (len(body), zlib.crc32(body) & 0xffffffff)
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        gateway = self.server.gateway
+        if self.path == '/_gateway/stats':
+            return self.reply(200, json.dumps(gateway.stats()).encode(
+                'utf-8'))
+        match = _PATH.match(self.path.split('?', 1)[0])
+        if match is None:
+            return self.reply(404, b'{"error": "not an SBA API path"}')
+        try:
+            body = gateway.get(unquote(match.group(1)),
+                               unquote(match.group(2)))
+        except api.HTTPError as error:
+            return self.reply(error.code, error.read() or b'')
+        except Exception as error:
+            return self.reply(502, json.dumps(
+                {'error': '%s: %s' % (type(error).__name__, error)}).encode(
+                'utf-8'))
+        tag = etag(body)
+        if self.headers.get('If-None-Match') == tag:
+            return self.reply(304, None, tag)
+        self.reply(200, body, tag)
+
+    def reply(self, status, body, tag=None):
+        self.send_response(status)
+        if tag is not None:
+            self.send_header('ETag', tag)
+        if body is None:
+            self.end_headers()
+            return
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Gateway(object):
+    """Caching HTTP gateway in front of the SBA APIs.
+
+    @param cache [Cache] Shared response cache, a MemoryCache with a one
+    hour TTL by default.
+    @param upstream [String] Root URL proxied to.
+    @param host [String] Interface to listen on.
+    @param port [Integer] Port to listen on, 0 for any free port.
+    @param maxsize [Integer] Most kept-alive upstream connections per host.
+    """
+
+    def __init__(self, cache=None, upstream='http://api.sba.gov',
+                 host='127.0.0.1', port=DEFAULT_PORT, maxsize=16):
+        self.upstream = Upstream(upstream.rstrip('/'))
+        self.upstream.cache = cache if cache is not None else \
+            MemoryCache(ttl=3600)
+        self.upstream.coalesce = SingleFlight()
+        self.upstream.transport = ConnectionPool(maxsize=maxsize)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), GatewayHandler)
+        self.server.daemon_threads = True
+        self.server.gateway = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """Root URL to set as SBA_API.api_root."""
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def get(self, family, directory):
+        """Return the raw body for /family/directory.json, from the cache
+        or from one coalesced upstream download."""
+        with self._lock:
+            self.requests += 1
+        return self.upstream.call_api('%s/%s' % (family, directory))
+
+    def stats(self):
+        stats = dict(self.upstream.cache.stats())
+        stats['requests'] = self.requests
+        stats['coalesced'] = self.upstream.coalesce.coalesced
+        return stats
+
+    def start(self):
+        """Serve on a daemon thread and return self."""
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def close(self):
+        if self._thread is not None:
+            self.server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server.server_close()
+        self.upstream.transport.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='interface to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='port to listen on')
+    parser.add_argument('--upstream', default='http://api.sba.gov',
+                        help='root URL to proxy to')
+    parser.add_argument('--cache', help='SQLite cache database '
+                        '(default: in memory)')
+    parser.add_argument('--ttl', type=float, default=3600,
+                        help='seconds entries stay fresh')
+    options = parser.parse_args(argv)
+    if options.cache:
+        cache = SQLiteCache(options.cache, ttl=options.ttl)
+    else:
+        cache = MemoryCache(ttl=options.ttl)
+    gateway = Gateway(cache, options.upstream, options.host, options.port)
+    sys.stderr.write('serving %s on %s\n' % (options.upstream, gateway.url))
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
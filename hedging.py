@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Deadlines, jittered retry backoff and hedged requests for call_api.
+
+>>> import api, hedging
+>>> api.SBA_API.timeout = 10          # per client deadline, seconds
+>>> api.SBA_API.retries = 2
+>>> api.SBA_API.hedge = 0.95          # hedge after the p95 latency
+>>> with hedging.deadline(2.5):       # per call deadline
+...     api.Loans_And_Grants().federal()
+"""
+
+import random
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+from urllib.error import HTTPError
+
+# Latency samples needed before hedging starts.
+MIN_SAMPLES = 20
+# Worker threads running duplicate requests; first attempts run on the
+# calling thread.
+HEDGE_WORKERS = 32
+
+_local = threading.local()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+@contextmanager
+def deadline(seconds):
+    """Limit every SBA call made by this thread inside the block to finish
+    within seconds of entering it, retries included."""
+    previous = getattr(_local, 'deadline', None)
+    end = time.time() + seconds
+    if previous is not None:
+        end = min(end, previous)
+    _local.deadline = end
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def deadline_after(timeout):
+    """Return the absolute deadline for a call starting now, the earlier of
+    the enclosing deadline() block and timeout seconds from now, or None."""
+    end = getattr(_local, 'deadline', None)
+    if timeout is not None:
+        end = time.time() + timeout if end is None else min(
+            end, time.time() + timeout)
+    return end
+
+
+def remaining(end):
+    """Seconds left before end (None means no deadline). Raises
+    socket.timeout once it has passed."""
+    if end is None:
+        return None
+    left = end - time.time()
+    if left <= 0:
+        raise socket.timeout('SBA API deadline exceeded')
+    return left
+
+
+def retryable(error):
+    """Network errors, timeouts, 429 and 5xx responses are worth retrying;
+    other HTTP errors are not."""
+    if isinstance(error, HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (IOError, OSError))
+
+
+def backoff_delay(attempt, base, cap=30):
+    """Full jitter exponential backoff before retry number attempt."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class LatencyWindow(object):
+    """Recent request latencies per key, for choosing the hedge delay."""
+
+    def __init__(self, size=200):
+        self.size = size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.size)
+            samples.append(seconds)
+
+    def percentile(self, key, fraction):
+        """Return the fraction (0-1) latency percentile for key, or None
+        before MIN_SAMPLES have been recorded."""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+        return _executor
+
+
+def hedged(function, delay, timeout=None):
+    """
+    Call function() on this thread; if it has not returned after delay
+    seconds, start a second call on a worker thread. Returns the result of
+    whichever call succeeded first once this thread's call has ended, so a
+    slow first call is bounded by its own socket timeouts; a duplicate still
+    running then is left to finish in the background. If this thread's call
+    fails, the duplicate is waited for, at most timeout seconds.
+    """
+    if delay is None:
+        return function()
+    end = None if timeout is None else time.time() + timeout
+    lock = threading.Lock()
+    duplicates = []
+    settled = [False]
+
+    def start_duplicate():
+        with lock:
+            if not settled[0]:
+                duplicates.append(_pool().submit(function))
+
+    timer = threading.Timer(delay, start_duplicate)
+    timer.daemon = True
+    timer.start()
+    try:
+        result = function()
+    except Exception as error:
+        first_error = error
+    else:
+        first_error = None
+    finally:
+        timer.cancel()
+        with lock:
+            settled[0] = True
+    duplicate = duplicates[0] if duplicates else None
+    if first_error is None:
+        if (duplicate is not None and duplicate.done() and
+                duplicate.exception() is None):
+            return duplicate.result()
+        return result
+    if duplicate is None:
+        raise first_error
+    try:
+        return duplicate.result(timeout=remaining(end))
+    except FuturesTimeout:
+        raise socket.timeout('SBA API deadline exceeded')
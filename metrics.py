@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Latency, size and decode time instrumentation for call_api.
+
+Every network call is recorded per endpoint family (license_permit,
+loans_grants, rec_sites, geodata) and wrapper method: connect time, time to
+first byte, body transfer time, bytes received and json.loads time.
+
+>>> import api, metrics
+>>> api.SBA_API.metrics = metrics.Metrics()
+>>> api.SBA_API.metrics.add_hook(lambda span: print(span.as_dict()))
+>>> api.Loans_And_Grants().federal()
+>>> api.SBA_API.metrics.histogram('loans_grants', 'federal',
+...                               'first_byte').percentile(99)
+>>> api.SBA_API.metrics.export()
+"""
+
+import json
+import threading
+import time
+
+
+class Histogram(object):
+    """HDR style histogram: values are bucketed with a fixed number of
+    significant bits, so memory stays small while every recorded value is
+    kept to about 1% relative precision.
+
+    @param unit [Number] Resolution of recorded values; latencies in
+    seconds are kept in microseconds.
+    @param significant_bits [Integer] Sub-buckets per power of two, as bits.
+    """
+
+    def __init__(self, unit=1e-6, significant_bits=7):
+        self.unit = unit
+        self.significant_bits = significant_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, units):
+        shift = max(0, units.bit_length() - self.significant_bits)
+        return shift, units >> shift
+
+    def record(self, value):
+        units = max(0, int(round(value / self.unit)))
+        bucket = self._bucket(units)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return the value at percent (0-100), or None when empty."""
+        if not self.count:
+            return None
+        rank = max(1, int(round(percent / 100.0 * self.count)))
+        seen = 0
+        for shift, sub in sorted(self.counts, key=lambda b: b[1] << b[0]):
+            seen += self.counts[(shift, sub)]
+            if seen >= rank:
+                # Report the top of the bucket, like HdrHistogram.
+                return min(self.max, (((sub + 1) << shift) - 1) * self.unit)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def as_dict(self):
+        return {'count': self.count, 'min': self.min, 'max': self.max,
+                'mean': self.mean(), 'p50': self.percentile(50),
+                'p90': self.percentile(90), 'p99': self.percentile(99),
+                'p999': self.percentile(99.9)}
+
+
+class Span(object):
+    """Timings for one network call, handed to Metrics hooks on finish."""
+
+    def __init__(self, metrics, family, method, url):
+        self.metrics = metrics
+        self.family = family
+        self.method = method
+        self.url = url
+        self.start = time.time()
+        self.end = None
+        self.phases = {}
+        self.bytes = None
+        self.error = None
+
+    def record(self, phase, seconds):
+        self.phases[phase] = seconds
+
+    def finish(self, error=None):
+        self.end = time.time()
+        self.error = error
+        self.phases['total'] = self.end - self.start
+        self.metrics.finish(self)
+
+    def as_dict(self):
+        return {'family': self.family, 'method': self.method,
+                'url': self.url, 'start': self.start, 'end': self.end,
+                'phases': dict(self.phases), 'bytes': self.bytes,
+                'error': None if self.error is None else repr(self.error)}
+
+
+class Metrics(object):
+    """Histograms and counters keyed by (family, method), plus hooks called
+    with every finished Span for tracing."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def start(self, family, method, url):
+        return Span(self, family, method, url)
+
+    def histogram(self, family, method, name):
+        """Return the histogram for a phase or 'bytes' of a method."""
+        key = (family, method, name)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                unit = 1 if name == 'bytes' else 1e-6
+                histogram = self.histograms[key] = Histogram(unit)
+            return histogram
+
+    def increment(self, family, method, name, amount=1):
+        key = (family, method, name)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def finish(self, span):
+        self.increment(span.family, span.method, 'requests')
+        if span.error is not None:
+            self.increment(span.family, span.method, 'errors')
+        for phase, seconds in span.phases.items():
+            histogram = self.histogram(span.family, span.method, phase)
+            with self._lock:
+                histogram.record(seconds)
+        if span.bytes is not None:
+            self.increment(span.family, span.method, 'bytes', span.bytes)
+            histogram = self.histogram(span.family, span.method, 'bytes')
+            with self._lock:
+                histogram.record(span.bytes)
+        for hook in self.hooks:
+            hook(span)
+
+    def export(self):
+        """Return every histogram summary and counter as a plain dict keyed
+        'family.method.name'."""
+        with self._lock:
+            histograms = dict(('.'.join(key), histogram.as_dict())
+                              for key, histogram in self.histograms.items())
+            counters = dict(('.'.join(key), value)
+                            for key, value in self.counters.items())
+        return {'histograms': histograms, 'counters': counters}
+
+    def to_json(self):
+        return json.dumps(self.export(), sort_keys=True, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
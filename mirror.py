@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+Offline mirror of the SBA datasets.
+
+A Mirror is a SQLite file holding the raw response for every URL in the
+datasets. Once built, set it on SBA_API and the wrapper methods answer
+from it, with the same return values, instead of calling api.sba.gov.
+
+>>> import api, mirror
+>>> snapshot = mirror.Mirror('sba-mirror.db')
+>>> snapshot.build()
+>>> api.SBA_API.mirror = snapshot
+>>> api.Loans_And_Grants().state('ia')
+
+The mirror holds state-level responses. Narrow geodata calls are answered
+by the planners filtering the mirrored state-wide responses, and the
+recommended sites lookups by searching the mirrored all_sites; licenses by
+county, city or zip code cannot be derived and are downloaded, or raise
+LookupError from an offline mirror.
+
+Build from the command line with:
+
+    $ python mirror.py sba-mirror.db
+
+Each entry keeps a SHA-256 digest of its body and the response's
+validators, so sync.py can refresh the mirror incrementally.
+"""
+
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+import api
+from bulk import DEFAULT_WORKERS, fan_out
+from cache import Revalidation
+
+# Scope flags for the state-wide geodata methods: both, counties, cities.
+GEODATA_SCOPES = ((True, True), (True, False), (False, True))
+
+
+def dataset_calls(combinations=False):
+    """
+    Yield (wrapper class, method name, args) for every call making up the
+    full datasets.
+
+    @param combinations [Boolean] Also include
+    Loans_And_Grants.by_state_industry_specialty for every state, industry
+    and specialty (about 4,000 extra calls).
+    """
+    licenses = api.Licenses_And_Permits
+    for category in api.LICENSE_CATEGORIES:
+        yield licenses, 'by_category', (category,)
+    for business in api.BUSINESS_TYPES:
+        yield licenses, 'by_business_type', (business,)
+    for state in api.STATES:
+        yield licenses, 'by_state', (state,)
+        for business in api.BUSINESS_TYPES:
+            yield licenses, 'by_business_type_state', (business, state)
+
+    loans = api.Loans_And_Grants
+    yield loans, 'federal', ()
+    for industry in api.INDUSTRIES:
+        yield loans, 'by_industry', (industry,)
+    for specialty in api.SPECIALTIES:
+        yield loans, 'by_speciality', (specialty,)
+    for industry in api.INDUSTRIES:
+        for specialty in api.SPECIALTIES:
+            yield loans, 'by_industry_specialty', (industry, specialty)
+    for state in api.STATES:
+        yield loans, 'state', (state,)
+        yield loans, 'federal_and_state', (state,)
+        for industry in api.INDUSTRIES:
+            yield loans, 'by_state_industry', (state, industry)
+        for specialty in api.SPECIALTIES:
+            yield loans, 'by_state_specialty', (state, specialty)
+        if combinations:
+            for industry in api.INDUSTRIES:
+                for specialty in api.SPECIALTIES:
+                    yield (loans, 'by_state_industry_specialty',
+                           (state, industry, specialty))
+
+    yield api.Recommended_Sites, 'all_sites', ()
+
+    geodata = api.City_And_County_Web_Data
+    for state in api.STATES:
+        for method in ('all_urls_by_state', 'primary_urls_by_state',
+                       'all_data_by_state'):
+            for show_county, show_city in GEODATA_SCOPES:
+                yield geodata, method, (state, show_county, show_city)
+
+
+def digest(body):
+    """SHA-256 hex digest of a raw response body."""
+    return hashlib.sha256(body).hexdigest()
+
+
+class Mirror(object):
+    """Local store of raw SBA responses, indexed by URL and by the wrapper
+    call that produced them.
+
+    @param path [String] SQLite database file, created if needed.
+    @param offline [Boolean] Raise LookupError for URLs missing from the
+    mirror instead of letting call_api download them.
+    """
+
+    def __init__(self, path, offline=False):
+        self.path = path
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS mirror ('
+                         'url TEXT PRIMARY KEY, wrapper TEXT, method TEXT, '
+                         'args TEXT, body BLOB, fetched REAL, '
+                         'digest TEXT, validators TEXT)')
+        for column in ('digest', 'validators'):
+            try:
+                # Mirrors built before digests and validators were stored.
+                self._db.execute('ALTER TABLE mirror ADD COLUMN %s TEXT' %
+                                 column)
+            except sqlite3.OperationalError:
+                pass
+        self._db.execute('CREATE INDEX IF NOT EXISTS mirror_call '
+                         'ON mirror (wrapper, method)')
+        self._db.commit()
+
+    def get(self, url):
+        """Return the stored body for url, or None when it is missing."""
+        with self._lock:
+            row = self._db.execute('SELECT body FROM mirror WHERE url = ?',
+                                   (url,)).fetchone()
+        if row is not None:
+            return bytes(row[0])
+        if self.offline:
+            raise LookupError('%s is not in the mirror' % url)
+        return None
+
+    def add(self, url, body, wrapper=None, method=None, args=(),
+            validators=None):
+        if validators is not None:
+            validators = json.dumps(validators)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO mirror '
+                             '(url, wrapper, method, args, body, fetched, '
+                             'digest, validators) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (url, wrapper, method, json.dumps(list(args)),
+                              sqlite3.Binary(body), time.time(),
+                              digest(body), validators))
+            self._db.commit()
+
+    def fingerprint(self, url):
+        """Return (digest, validators) of the stored entry for url, or
+        (None, None) when it is missing or predates digests."""
+        with self._lock:
+            row = self._db.execute('SELECT digest, validators FROM mirror '
+                                   'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], None if row[1] is None else json.loads(row[1])
+
+    def touch(self, url, validators=None):
+        """Record that url was found unchanged upstream, keeping its body
+        and replacing its validators when new ones are given."""
+        with self._lock:
+            if validators is None:
+                self._db.execute('UPDATE mirror SET fetched = ? '
+                                 'WHERE url = ?', (time.time(), url))
+            else:
+                self._db.execute('UPDATE mirror SET fetched = ?, '
+                                 'validators = ? WHERE url = ?',
+                                 (time.time(), json.dumps(validators), url))
+            self._db.commit()
+
+    def calls(self, wrapper=None, method=None):
+        """Yield (wrapper name, method, args, url) for the stored entries."""
+        query = 'SELECT wrapper, method, args, url FROM mirror'
+        clauses, params = [], []
+        if wrapper is not None:
+            clauses.append('wrapper = ?')
+            params.append(wrapper)
+        if method is not None:
+            clauses.append('method = ?')
+            params.append(method)
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        for wrapper, method, args, url in rows:
+            yield wrapper, method, tuple(json.loads(args)), url
+
+    def build(self, calls=None, max_workers=DEFAULT_WORKERS, progress=None):
+        """
+        Download every call (dataset_calls() by default) into the mirror and
+        return the list of bulk.BulkResult failures.
+
+        @param progress [Function] Called as progress(done, total) after
+        each call.
+        """
+        calls = list(dataset_calls() if calls is None else calls)
+        clients = {}
+        for wrapper, method, args in calls:
+            if wrapper not in clients:
+                client = clients[wrapper] = wrapper()
+                client.mirror = None
+
+        def download(call):
+            wrapper, method, args = call
+            client = clients[wrapper]
+            url = client.url_for(method, *args)
+            revalidation = Revalidation()
+            body = client.fetch(url, revalidation=revalidation)
+            self.add(url, body, wrapper.__name__, method, args,
+                     revalidation.validators)
+
+        failures = []
+        for done, result in enumerate(fan_out(download, calls, max_workers)):
+            if result.error is not None:
+                failures.append(result)
+            if progress is not None:
+                progress(done + 1, len(calls))
+        return failures
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM mirror').fetchone()[0]
+
+    def __contains__(self, url):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM mirror WHERE url = ?',
+                                    (url,)).fetchone() is not None
+
+
+def main(argv):
+    if len(argv) != 2:
+        sys.stderr.write('usage: python mirror.py MIRROR_DB\n')
+        return 2
+
+    def progress(done, total):
+        sys.stderr.write('\r%d/%d' % (done, total))
+
+    failures = Mirror(argv[1]).build(progress=progress)
+    sys.stderr.write('\n')
+    for failure in failures:
+        sys.stderr.write('failed: %s %s %r: %s\n' % (
+            failure.key[0].__name__, failure.key[1], failure.key[2],
+            failure.error))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+Query planning: answering some calls from other, cached or mirrored
+responses.
+
+The geodata city and county methods return subsets of what the state-wide
+methods already return, so when a state-wide response is cached or in the
+SBA_API.mirror, narrow queries for that state are answered by filtering it
+locally instead of being sent upstream.
+
+>>> import api, cache
+>>> api.SBA_API.cache = cache.MemoryCache(ttl=86400)
+>>> geodata = api.City_And_County_Web_Data()
+>>> geodata.all_urls_by_state('tx', True, True)       # one request
+>>> geodata.all_urls_by_city('tx', 'dallas')           # answered locally
+>>> geodata.primary_urls_by_county('tx', 'dallas county')   # one request
+>>> geodata.planner.derived
+1
+
+A planner with upgrade_after set also fetches the state-wide response itself
+once that many narrow lookups in one state have missed within window
+seconds, so a burst of lookups costs one request:
+
+>>> api.City_And_County_Web_Data.planner = planner.GeodataPlanner(
+...     upgrade_after=3)
+
+Loans_And_Grants.federal_and_state is the union of federal() and state(),
+the state industry and specialty searches are subsets of state(), and the
+nationwide industry and specialty search is a subset of either nationwide
+search alone. A LoansPlanner composes them from cached pieces, so a sweep of
+all states downloads the federal programs once:
+
+>>> api.Loans_And_Grants.planner = planner.LoansPlanner(fetch_pieces=True)
+>>> for state in api.STATES:
+...     api.Loans_And_Grants().federal_and_state(state)
+
+The Recommended_Sites keyword, category, master term and domain lookups
+select from all_sites, so a SitesPlanner answers them from a cached or
+mirrored all_sites response through a site_index.SiteIndex.
+"""
+
+import re
+import threading
+import time
+
+from cache import MISSING
+from endpoints import clean
+from site_index import SiteIndex
+
+# all_links_for_city_of/dallas/tx, primary_links_for_county_of/king county/wa
+NARROW = re.compile(r'^(all|primary)_(links|data)_for_(city|county)_of/'
+                    r'(.+)/([a-z]{2})$')
+# federal_and_state_financing_for/me, me/for_profit/manufacturing/woman and
+# nil/for_profit/manufacturing/woman
+FEDERAL_AND_STATE = re.compile(
+    r'^federal_and_state_financing_for/([a-z]{2})$')
+PROGRAM_SEARCH = re.compile(r'^([a-z]{2}|nil)/for_profit/([^/]+)/([^/]+)$')
+ALL_SITES = 'all_sites/keywords'
+# Recommended_Sites directory prefix to SiteIndex lookup, most specific
+# first.
+SITE_LOOKUPS = (('keywords/master_term/', 'by_master_term'),
+                ('keywords/domain/', 'by_domain'),
+                ('keywords/', 'by_keyword'),
+                ('category/', 'by_category'))
+_SEPARATORS = re.compile(r'\s*[-,;]\s*')
+
+
+def plan(directory):
+    """
+    Return (sources, name) for a narrow geodata directory: the state-wide
+    directories containing its answer, smallest first, and the normalized
+    city or county name to select from them. Returns None for any other
+    directory.
+    """
+    match = NARROW.match(directory)
+    if match is None:
+        return None
+    which, kind, place, name, state = match.groups()
+    if which == 'primary' and kind == 'data':
+        return None
+    prefix = 'primary_' if which == 'primary' else ''
+    sources = tuple('%s%s_%s_for_state_of/%s' % (prefix, scope, kind, state)
+                    for scope in (place, 'city_county'))
+    return sources, clean(name)
+
+
+def select(records, name):
+    """Records from a state-wide response whose name is name, or MISSING
+    when the response is not a list of records."""
+    if not isinstance(records, list):
+        return MISSING
+    selected = []
+    for record in records:
+        try:
+            record_name = record.get('name')
+        except AttributeError:
+            return MISSING
+        if isinstance(record_name, str) and clean(record_name) == name:
+            selected.append(record)
+    return selected
+
+
+class GeodataPlanner(object):
+    """Answers narrow geodata queries from cached or mirrored state-wide
+    responses.
+
+    @param upgrade_after [Integer] Narrow misses in one state after which the
+    state-wide response is fetched instead, or None to never fetch it.
+    @param window [Number] Seconds over which misses are counted.
+    """
+
+    def __init__(self, upgrade_after=None, window=60):
+        self.upgrade_after = upgrade_after
+        self.window = window
+        self.derived = 0
+        self.upgrades = 0
+        self._misses = {}
+        self._lock = threading.Lock()
+
+    def answer(self, client, directory, upgrade=True):
+        """
+        Return the response for directory computed locally, or MISSING.
+        client is the wrapper instance whose cache and mirror are consulted
+        (SBA_API.stored) and, when upgrading, whose call_api fetches the
+        state-wide response.
+        """
+        planned = plan(directory)
+        if planned is None or (client.cache is None and
+                               client.mirror is None):
+            return MISSING
+        sources, name = planned
+        for source in sources:
+            records = client.stored(source)
+            if records is not MISSING:
+                value = select(records, name)
+                if value is not MISSING:
+                    with self._lock:
+                        self.derived += 1
+                    return value
+        if upgrade and self._upgrade(sources[0]):
+            value = select(client.call_api(sources[0]), name)
+            if value is not MISSING:
+                with self._lock:
+                    self.derived += 1
+            return value
+        return MISSING
+
+    def _upgrade(self, source):
+        """Count a miss against source and say whether to fetch it now."""
+        if self.upgrade_after is None:
+            return False
+        now = time.time()
+        with self._lock:
+            misses = [seen for seen in self._misses.get(source, ())
+                      if now - seen < self.window]
+            misses.append(now)
+            if len(misses) < self.upgrade_after:
+                self._misses[source] = misses
+                return False
+            self._misses.pop(source, None)
+            self.upgrades += 1
+            return True
+
+
+def program_key(record):
+    """Identity of a loan or grant program, for de-duplication."""
+    url = record.get('url')
+    if url:
+        return url
+    return repr(sorted((key, repr(value)) for key, value in record.items()))
+
+
+def merge(*responses):
+    """Concatenate program lists, keeping the first copy of each program."""
+    seen = set()
+    merged = []
+    for records in responses:
+        for record in records:
+            key = program_key(record)
+            if key not in seen:
+                seen.add(key)
+                merged.append(record)
+    return merged
+
+
+def _terms(value):
+    if isinstance(value, (list, tuple)):
+        value = ','.join(str(item) for item in value)
+    if not isinstance(value, str) or not value.strip():
+        return set()
+    return set(clean(term).replace(' ', '_')
+               for term in _SEPARATORS.split(value) if term.strip())
+
+
+def _specialties(record):
+    terms = _terms(record.get('specialty'))
+    if record.get('is_general_purpose') is True:
+        terms.add('general_purpose')
+    return terms
+
+
+def search_programs(records, industry, specialty):
+    """
+    Programs from records in industry with any of the '-' separated
+    specialties, like the server's state search; 'nil' matches anything.
+    Compared on the programs' industry, specialty and is_general_purpose
+    fields.
+    """
+    industry = None if industry == 'nil' else clean(industry)
+    specialties = None if specialty == 'nil' else _terms(specialty)
+    return [record for record in records
+            if (industry is None or
+                clean(record.get('industry') or '-') == industry) and
+            (specialties is None or _specialties(record) & specialties)]
+
+
+class LoansPlanner(object):
+    """Composes Loans_And_Grants responses from cached pieces: a
+    federal_and_state call from federal() and state(state), state
+    industry/specialty searches by filtering state(state), and a nationwide
+    industry and specialty search by filtering the cached by_industry or
+    by_speciality result. The server's own ordering of the merged list is
+    not reproduced.
+
+    @param fetch_pieces [Boolean] Fetch (and cache) missing federal() and
+    state() pieces instead of sending the composite request, which makes
+    sense for sweeps where federal() is shared by every state.
+    """
+
+    def __init__(self, fetch_pieces=False):
+        self.fetch_pieces = fetch_pieces
+        self.derived = 0
+        self._lock = threading.Lock()
+
+    def answer(self, client, directory, upgrade=True):
+        """Return the response for directory composed locally, or MISSING.
+        Pieces are only fetched when upgrade and fetch_pieces are set."""
+        if client.cache is None and client.mirror is None:
+            return MISSING
+        fetch = upgrade and self.fetch_pieces
+        value = MISSING
+        match = FEDERAL_AND_STATE.match(directory)
+        if match is not None:
+            value = self._federal_and_state(client, match.group(1), fetch)
+        else:
+            match = PROGRAM_SEARCH.match(directory)
+            if match is None:
+                return MISSING
+            state, industry, specialty = match.groups()
+            if state != 'nil':
+                programs = self._piece(
+                    client, 'state_financing_for/%s' % state, fetch)
+                if programs is not MISSING:
+                    value = search_programs(programs, industry, specialty)
+            elif industry != 'nil' and specialty != 'nil':
+                value = self._nationwide(client, industry, specialty)
+        if value is not MISSING:
+            with self._lock:
+                self.derived += 1
+        return value
+
+    def _federal_and_state(self, client, state, fetch):
+        federal = self._piece(client, 'federal', fetch)
+        if federal is MISSING:
+            return MISSING
+        programs = self._piece(client, 'state_financing_for/%s' % state,
+                               fetch)
+        if programs is MISSING:
+            return MISSING
+        return merge(federal, programs)
+
+    def _nationwide(self, client, industry, specialty):
+        """Filter a cached nationwide search for the industry alone or the
+        specialties alone; neither is worth fetching for this."""
+        for directory in ('nil/for_profit/%s/nil' % industry,
+                          'nil/for_profit/nil/%s' % specialty):
+            programs = self._piece(client, directory, False)
+            if programs is not MISSING:
+                return search_programs(programs, industry, specialty)
+        return MISSING
+
+    def _piece(self, client, directory, fetch):
+        value = client.stored(directory)
+        if value is MISSING and fetch:
+            value = client.call_api(directory)
+        if not isinstance(value, list):
+            return MISSING
+        return value
+
+
+class SitesPlanner(object):
+    """Answers the Recommended_Sites keyword, category, master term and
+    domain lookups from a cached or mirrored all_sites response. The index
+    built over it is kept until all_sites changes."""
+
+    def __init__(self):
+        self.derived = 0
+        self._indexed = None
+        self._lock = threading.Lock()
+
+    def answer(self, client, directory, upgrade=True):
+        """Return the sites matching directory, or MISSING."""
+        for prefix, lookup in SITE_LOOKUPS:
+            if directory.startswith(prefix):
+                break
+        else:
+            return MISSING
+        if client.cache is None and client.mirror is None:
+            return MISSING
+        sites = client.stored(ALL_SITES)
+        if sites is MISSING:
+            return MISSING
+        index = self._index(sites)
+        value = getattr(index, lookup)(directory[len(prefix):])
+        with self._lock:
+            self.derived += 1
+        return value
+
+    def _index(self, sites):
+        with self._lock:
+            indexed = self._indexed
+        # A SQLite cache or the mirror decode a new, equal, response.
+        if indexed is not None and (indexed[0] is sites or
+                                    indexed[0] == sites):
+            return indexed[1]
+        index = SiteIndex(sites)
+        with self._lock:
+            self._indexed = (sites, index)
+        return index
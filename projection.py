@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""
+Field projection: keeping only some fields of each decoded record.
+
+Every wrapper method takes an optional fields argument, and SBA_API.fields
+sets a default per class. Responses are decoded one record at a time and
+each record is cut down to the projected fields before the next is parsed,
+so the unused fields of a large state-wide response never exist all at
+once, and only the small projected records are kept.
+
+>>> import api
+>>> api.City_And_County_Web_Data().all_urls_by_state('tx', True, True,
+...                                                  fields=('name', 'url'))
+[{'name': 'Dallas', 'url': 'http://www.dallascityhall.com/'}, ...]
+>>> api.City_And_County_Web_Data.fields = 'name,url'
+"""
+
+import io
+import re
+
+import records
+from streaming import iter_json_array
+
+_ARRAY = re.compile(br'\s*\[')
+
+
+def normalize(fields):
+    """
+    Return fields as a tuple of unique field names, or None for no
+    projection. Accepts a comma separated string or an iterable of names.
+    Raises ValueError for anything else.
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    names = []
+    for name in fields:
+        if not isinstance(name, str):
+            raise ValueError('expected field names')
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    if not names:
+        raise ValueError('expected at least one field name')
+    return tuple(names)
+
+
+def project_record(record, fields, typed=False):
+    """Keep only fields of a dict or Record; fields it does not have are
+    left out. Other values are returned as they are."""
+    if not isinstance(record, (dict, records.Record)):
+        return record
+    pairs = [(name, record[name]) for name in fields if name in record]
+    if typed:
+        return records.from_pairs(pairs)
+    return dict(pairs)
+
+
+def wraps_records(value, fields):
+    """Whether value is an object wrapping the record list, such as
+    {"sites": [...]}, rather than a record: it has a list and none of
+    fields."""
+    return (isinstance(value, (dict, records.Record)) and
+            not any(name in value for name in fields) and
+            any(isinstance(value[name], list) for name in value))
+
+
+def project(value, fields, typed=False):
+    """Project each record of a decoded response, a list of records, an
+    object wrapping one or a single record, onto fields. A None projection
+    returns value itself."""
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [project_record(record, fields, typed) for record in value]
+    if wraps_records(value, fields):
+        pairs = [(name, project(value[name], fields, typed)
+                  if isinstance(value[name], list) else value[name])
+                 for name in value]
+        return records.from_pairs(pairs) if typed else dict(pairs)
+    return project_record(value, fields, typed)
+
+
+def loads(data, fields, typed=False):
+    """
+    Decode a JSON response body, str or UTF-8 bytes, projecting each
+    element of a top-level array as soon as it is parsed. Records are
+    Record instances when typed.
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    decoder = records.decoder() if typed else None
+    values = iter_json_array(io.BytesIO(data), decoder=decoder)
+    if _ARRAY.match(data) is None:
+        # A single record or an object wrapping the records.
+        return project(next(values, None), fields, typed)
+    return [project_record(value, fields, typed) for value in values]
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Compact record types for decoded SBA responses.
+
+JSON objects decode into instances of __slots__ classes generated once per
+distinct set of keys, instead of dicts, and short repeated strings (state
+names, county names, feature classes...) are interned, so large
+geodata and license results take several times less memory. Records still
+support the read-only dict interface: record['name'], record.get('url'),
+keys(), items(), 'url' in record, and attribute access (record.name).
+
+>>> import api
+>>> api.City_And_County_Web_Data.typed = True
+>>> api.City_And_County_Web_Data().all_data_by_state('tx', True, True)[0]
+Record(county_name='Dallas', ...)
+"""
+
+import json
+import sys
+import threading
+
+import decoding
+
+try:
+    intern = sys.intern
+except AttributeError:  # pragma: no cover
+    # For older versions of Python.
+    pass
+
+# Strings up to this many characters are interned; longer values such as
+# descriptions and URLs are rarely repeated.
+INTERN_MAX_LENGTH = 32
+
+_classes = {}
+_classes_lock = threading.Lock()
+
+
+class Record(object):
+    """Base class for generated record types. Subclasses set keys_, the
+    field names in order, and __slots__ with one slot per key."""
+
+    __slots__ = ()
+    keys_ = ()
+    index_ = {}
+    setters_ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.index_[key])
+        except KeyError:
+            raise KeyError(key)
+
+    def __getattr__(self, name):
+        slot = self.index_.get(name)
+        if slot is None:
+            raise AttributeError(name)
+        return getattr(self, slot)
+
+    def get(self, key, default=None):
+        slot = self.index_.get(key)
+        if slot is None:
+            return default
+        return getattr(self, slot)
+
+    def keys(self):
+        return list(self.keys_)
+
+    def values(self):
+        return [getattr(self, slot) for slot in self.__slots__]
+
+    def items(self):
+        return list(zip(self.keys_, self.values()))
+
+    def __contains__(self, key):
+        return key in self.index_
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def to_dict(self):
+        """Return a plain dict copy, converting nested records too."""
+        return dict((key, _plain(value)) for key, value in self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.to_dict() == _plain(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join('%s=%r' % item
+                                        for item in self.items())
+
+    def __reduce__(self):
+        return make_record, (self.keys_, tuple(self.values()))
+
+
+def _plain(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return dict((key, _plain(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+
+def record_class(keys):
+    """Return the Record subclass for an ordered tuple of keys."""
+    cls = _classes.get(keys)
+    if cls is None:
+        with _classes_lock:
+            cls = _classes.get(keys)
+            if cls is None:
+                slots = tuple('f%d' % position
+                              for position in range(len(keys)))
+                cls = type('Record', (Record,), {
+                    '__slots__': slots,
+                    'keys_': keys,
+                    'index_': dict(zip(keys, slots)),
+                })
+                cls.setters_ = tuple(getattr(cls, slot).__set__
+                                     for slot in slots)
+                _classes[keys] = cls
+    return cls
+
+
+def make_record(keys, values):
+    """Build a record from parallel keys and values tuples."""
+    cls = _classes.get(keys) or record_class(tuple(keys))
+    record = cls.__new__(cls)
+    for setter, value in zip(cls.setters_, values):
+        setter(record, value)
+    return record
+
+
+def _intern_value(value):
+    if type(value) is str and len(value) <= INTERN_MAX_LENGTH:
+        return intern(value)
+    return value
+
+
+def from_pairs(pairs):
+    """object_pairs_hook building a Record from decoded key/value pairs."""
+    keys = tuple(intern(key) if type(key) is str else key
+                 for key, value in pairs)
+    return make_record(keys, [_intern_value(value) for key, value in pairs])
+
+
+def from_value(value):
+    """Convert decoded JSON, replacing dicts with records. Lists are
+    converted in place so each dict can be freed as soon as it is
+    replaced."""
+    kind = type(value)
+    if kind is dict:
+        keys = tuple(value)
+        cls = _classes.get(keys) or record_class(keys)
+        record = cls.__new__(cls)
+        for setter, item in zip(cls.setters_, value.values()):
+            kind = type(item)
+            if kind is str:
+                if len(item) <= INTERN_MAX_LENGTH:
+                    item = intern(item)
+            elif kind is dict or kind is list:
+                item = from_value(item)
+            setter(record, item)
+        return record
+    if kind is list:
+        for position, item in enumerate(value):
+            kind = type(item)
+            if kind is dict or kind is list:
+                value[position] = from_value(item)
+            elif kind is str and len(item) <= INTERN_MAX_LENGTH:
+                value[position] = intern(item)
+    return value
+
+
+def decoder():
+    """JSONDecoder producing records, for incremental decoding."""
+    return json.JSONDecoder(object_pairs_hook=from_pairs)
+
+
+def loads(data, backend=None):
+    """Decode a JSON document, str or UTF-8 bytes, with objects as records,
+    using the named decoding backend or decoding.DEFAULT."""
+    return from_value(decoding.loads(data, backend))
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+In-memory inverted indexes over the recommended sites corpus, answering
+Recommended_Sites queries without a network call.
+
+>>> import api, site_index
+>>> api.Recommended_Sites.index = site_index.SiteIndex(
+...     api.Recommended_Sites().all_sites())
+>>> api.Recommended_Sites().by_keyword('contracting')
+>>> api.Recommended_Sites().search('export loans')
+>>> api.Recommended_Sites().suggest('expo')
+"""
+
+import bisect
+import re
+from urllib.parse import urlsplit
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+# Weight of a query term matching each field in SiteIndex.search.
+WEIGHTS = {'keyword': 4, 'master_term': 4, 'category': 2, 'domain': 2,
+           'word': 1}
+
+
+def normalize(term):
+    return ' '.join(term.lower().split())
+
+
+def site_records(response):
+    """Return the list of sites in an all_sites response, which may be the
+    list itself or an object wrapping it."""
+    if isinstance(response, dict):
+        for value in response.values():
+            if isinstance(value, list):
+                return value
+        return []
+    return list(response)
+
+
+def site_domain(site):
+    """Domain of a site as by_domain expects it: no www or top level
+    domain, e.g. 'irs' for http://www.irs.gov/."""
+    domain = site.get('domain')
+    if not domain:
+        host = urlsplit(site.get('url') or '').hostname or ''
+        parts = host.split('.')
+        if parts and parts[0] == 'www':
+            parts = parts[1:]
+        domain = parts[-2] if len(parts) > 1 else ''.join(parts)
+    return normalize(domain)
+
+
+def site_keywords(site):
+    keywords = site.get('keywords') or []
+    if not isinstance(keywords, list):
+        keywords = keywords.split(',')
+    return set(normalize(keyword) for keyword in keywords if keyword.strip())
+
+
+class SiteIndex(object):
+    """Inverted indexes on keyword, category, master term and domain.
+
+    @param sites The all_sites response, or a list of site records.
+    """
+
+    fields = ('keyword', 'category', 'master_term', 'domain')
+
+    def __init__(self, sites):
+        self.sites = site_records(sites)
+        self.postings = dict((field, {}) for field in self.fields + ('word',))
+        for position, site in enumerate(self.sites):
+            terms = {
+                'keyword': site_keywords(site),
+                'category': set([normalize(site.get('category') or '')]),
+                'master_term': set([normalize(site.get('master_term') or '')]),
+                'domain': set([site_domain(site)]),
+            }
+            text = ' '.join([site.get('title') or '',
+                             site.get('description') or ''] +
+                            list(terms['keyword']))
+            terms['word'] = set(WORD.findall(text.lower()))
+            for field, values in terms.items():
+                postings = self.postings[field]
+                for value in values:
+                    if value:
+                        postings.setdefault(value, []).append(position)
+        self.sorted_terms = dict((field, sorted(postings))
+                                 for field, postings in self.postings.items())
+
+    def lookup(self, field, term):
+        """Return the sites whose field exactly matches term."""
+        positions = self.postings[field].get(normalize(term), [])
+        return [self.sites[position] for position in positions]
+
+    def by_keyword(self, keyword):
+        return self.lookup('keyword', keyword)
+
+    def by_category(self, category):
+        return self.lookup('category', category)
+
+    def by_master_term(self, term):
+        return self.lookup('master_term', term)
+
+    def by_domain(self, domain):
+        return self.lookup('domain', domain)
+
+    def prefix(self, prefix, field='keyword', limit=None):
+        """Return the indexed terms of field starting with prefix, sorted."""
+        prefix = normalize(prefix)
+        terms = self.sorted_terms[field]
+        matches = []
+        for term in terms[bisect.bisect_left(terms, prefix):]:
+            if not term.startswith(prefix) or len(matches) == limit:
+                break
+            matches.append(term)
+        return matches
+
+    def search(self, query, limit=10):
+        """
+        Rank sites for a free text query. Each query word scores by the
+        fields it matches (see WEIGHTS); the last word also matches as a
+        prefix so results update while the user types.
+        """
+        words = WORD.findall(query.lower())
+        if not words:
+            return []
+        scores = {}
+        phrase = normalize(query)
+        for field in self.fields:
+            for position in self.postings[field].get(phrase, []):
+                scores[position] = scores.get(position, 0) + WEIGHTS[field]
+        for index, word in enumerate(words):
+            terms = [word]
+            if index == len(words) - 1:
+                terms = self.prefix(word, 'word')
+            matched = {}
+            for term in terms:
+                weight = WEIGHTS['word'] if term == word else 0.5
+                for position in self.postings['word'].get(term, []):
+                    matched[position] = max(matched.get(position, 0), weight)
+            for position, weight in matched.items():
+                scores[position] = scores.get(position, 0) + weight
+        ranked = sorted(scores, key=lambda position: (-scores[position],
+                                                      position))
+        return [self.sites[position] for position in ranked[:limit]]
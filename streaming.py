@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+Incremental parsing of JSON array responses, one element at a time.
+
+>>> import streaming
+>>> for record in streaming.iter_json_array(urlopen(url)):
+...     print(record['name'])
+"""
+
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = ' \t\n\r'
+# Characters that can continue a number after a prefix that already parses,
+# such as the '.' of "1." or the 'e' of "1e".
+NUMBER_TAIL = '.eE+-'
+
+
+def _chunks(fileobj, chunk_size):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        data = fileobj.read(chunk_size)
+        if not data:
+            tail = decoder.decode(b'', True)
+            if tail:
+                yield tail
+            return
+        text = decoder.decode(data)
+        if text:
+            yield text
+
+
+def iter_json_array(fileobj, chunk_size=CHUNK_SIZE, decoder=None):
+    """
+    Yield the elements of the JSON array read from fileobj as they arrive,
+    keeping only the unparsed remainder (about one element) in memory. A
+    response that is not an array is yielded whole as a single value.
+
+    @param fileobj File-like object returning bytes from read(size).
+    @param chunk_size [Integer] Bytes requested per read.
+    """
+    decoder = decoder or json.JSONDecoder()
+    chunks = _chunks(fileobj, chunk_size)
+    buffer = ''
+    position = 0
+    done = False
+
+    def fill():
+        # Append the next chunk, dropping what has already been parsed.
+        for chunk in chunks:
+            return buffer[position:] + chunk, 0, False
+        return buffer[position:], 0, True
+
+    def skip(buffer, position):
+        while position < len(buffer) and buffer[position] in WHITESPACE:
+            position += 1
+        return position
+
+    # Find the opening bracket.
+    while True:
+        position = skip(buffer, position)
+        if position < len(buffer) or done:
+            break
+        buffer, position, done = fill()
+    if position == len(buffer):
+        return
+    if buffer[position] != '[':
+        while not done:
+            buffer, position, done = fill()
+        yield decoder.decode(buffer[position:])
+        return
+    position += 1
+    expect_value = True
+    while True:
+        position = skip(buffer, position)
+        if position == len(buffer):
+            if done:
+                raise ValueError('Unterminated JSON array')
+            buffer, position, done = fill()
+            continue
+        char = buffer[position]
+        if char == ']':
+            return
+        if not expect_value:
+            if char != ',':
+                raise ValueError('Expected , or ] at position %d' % position)
+            position += 1
+            expect_value = True
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if done:
+                raise
+            buffer, position, done = fill()
+            continue
+        # A number may continue in the next chunk; only trust a value that
+        # is followed by more input than whitespace or a partial number.
+        if not done and all(char in WHITESPACE or char in NUMBER_TAIL
+                            for char in buffer[end:]):
+            buffer, position, done = fill()
+            continue
+        position = end
+        expect_value = False
+        yield value
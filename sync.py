@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Incremental refresh of an offline mirror, emitting per-record deltas.
+
+Every entry of a mirror.Mirror is re-requested conditionally with the
+validators it was stored with. A 304 Not Modified response, or a body with
+the same SHA-256 digest as the stored one, costs nothing more. A changed
+body is compared record by record with the stored one and yields a Delta
+for each added, removed and changed record before the mirror is updated,
+so a downstream index can be maintained without rebuilding it.
+
+>>> import mirror, sync
+>>> synchronizer = sync.Sync(mirror.Mirror('sba-mirror.db'))
+>>> for delta in synchronizer.run():
+...     print(delta.kind, delta.url, delta.key)
+changed http://api.sba.gov/loans_grants/state_financing_for/ia.json (...)
+>>> synchronizer.stats()
+{'checked': 3184, 'not_modified': 3101, 'unchanged': 82, 'changed': 1, ...}
+
+From the command line, writing the deltas as JSON lines:
+
+    $ python sync.py sba-mirror.db > deltas.jsonl
+"""
+
+import argparse
+import json
+import sys
+from collections import namedtuple
+
+import api
+import decoding
+from bulk import DEFAULT_WORKERS, fan_out
+from cache import Revalidation
+from mirror import Mirror, dataset_calls, digest
+
+# kind is 'added', 'removed' or 'changed'; key identifies the record within
+# the response at url; old and new are the record before and after (None
+# for an added or removed record respectively).
+Delta = namedtuple('Delta', 'kind url key old new')
+
+# Fields identifying a record within a response, in order. Geodata records
+# repeat a feature once per URL, so both are used when present.
+IDENTITY = ('feature_id', 'url')
+
+WRAPPERS = dict((wrapper.__name__, wrapper) for wrapper in (
+    api.Licenses_And_Permits, api.Loans_And_Grants, api.Recommended_Sites,
+    api.City_And_County_Web_Data))
+
+
+def record_key(record):
+    """Identity of a record: its IDENTITY fields, or its whole content when
+    it has none of them."""
+    if isinstance(record, dict):
+        key = tuple(record[name] for name in IDENTITY
+                    if record.get(name) is not None)
+        if key:
+            return key
+    return (json.dumps(record, sort_keys=True),)
+
+
+def _keyed(value):
+    """Map each record of a decoded response to its key. Repeated keys get
+    an occurrence number so no record is lost."""
+    if not isinstance(value, list):
+        value = [] if value is None else [value]
+    keyed = {}
+    for record in value:
+        key = record_key(record)
+        unique, occurrence = key, 1
+        while unique in keyed:
+            occurrence += 1
+            unique = key + (occurrence,)
+        keyed[unique] = record
+    return keyed
+
+
+def diff(url, old, new):
+    """Yield the Deltas turning the decoded response old into new."""
+    before = _keyed(old)
+    after = _keyed(new)
+    for key, record in before.items():
+        if key not in after:
+            yield Delta('removed', url, key, record, None)
+        elif after[key] != record:
+            yield Delta('changed', url, key, record, after[key])
+    for key, record in after.items():
+        if key not in before:
+            yield Delta('added', url, key, None, record)
+
+
+class Sync(object):
+    """Refreshes a mirror, yielding Deltas for the records that changed.
+
+    @param mirror [Mirror] The snapshot to compare against and update.
+    @param max_workers [Integer] Most conditional requests in flight.
+    Downloaded bodies wait for the deltas of earlier calls to be consumed,
+    at most twice max_workers of them (see bulk.fan_out), so memory does
+    not grow with the size of the mirror.
+    """
+
+    def __init__(self, mirror, max_workers=DEFAULT_WORKERS):
+        self.mirror = mirror
+        self.max_workers = max_workers
+        self.checked = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        self.changed = 0
+        self.failures = []
+
+    def stats(self):
+        return {'checked': self.checked, 'not_modified': self.not_modified,
+                'unchanged': self.unchanged, 'changed': self.changed,
+                'failed': len(self.failures)}
+
+    def calls(self):
+        """The mirror's stored calls, or dataset_calls() for an empty
+        mirror."""
+        calls = [(WRAPPERS[wrapper], method, args)
+                 for wrapper, method, args, url in self.mirror.calls()
+                 if wrapper in WRAPPERS]
+        return calls or list(dataset_calls())
+
+    def run(self, calls=None):
+        """
+        Conditionally refetch every (wrapper class, method name, args) call,
+        self.calls() by default, and yield the Deltas of those that changed.
+        The mirror entry of a call is only replaced once all of its deltas
+        have been consumed, so an interrupted sync repeats them next time.
+        Failed calls are collected in self.failures.
+        """
+        calls = self.calls() if calls is None else list(calls)
+        clients = {}
+        for wrapper, method, args in calls:
+            if wrapper not in clients:
+                client = clients[wrapper] = wrapper()
+                client.mirror = None
+
+        def fetch(call):
+            wrapper, method, args = call
+            client = clients[wrapper]
+            url = client.url_for(method, *args)
+            stored, validators = self.mirror.fingerprint(url)
+            revalidation = Revalidation(validators)
+            body = client.fetch(url, revalidation=revalidation)
+            return url, stored, body, revalidation
+
+        for result in fan_out(fetch, calls, self.max_workers):
+            self.checked += 1
+            if result.error is not None:
+                self.failures.append(result)
+                continue
+            wrapper, method, args = result.key
+            url, stored, body, revalidation = result.value
+            if revalidation.not_modified:
+                self.not_modified += 1
+                self.mirror.touch(url, revalidation.validators)
+                continue
+            if stored == digest(body):
+                self.unchanged += 1
+                self.mirror.touch(url, revalidation.validators)
+                continue
+            old = None
+            if url in self.mirror:
+                old = decoding.loads(self.mirror.get(url))
+            for delta in diff(url, old, decoding.loads(body)):
+                yield delta
+            self.changed += 1
+            self.mirror.add(url, body, wrapper.__name__, method, args,
+                            revalidation.validators)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('mirror', help='mirror database to refresh')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='most requests in flight at once')
+    options = parser.parse_args(argv)
+    snapshot = Mirror(options.mirror)
+    synchronizer = Sync(snapshot, options.workers)
+    try:
+        for delta in synchronizer.run():
+            sys.stdout.write(json.dumps({
+                'kind': delta.kind, 'url': delta.url,
+                'key': list(delta.key), 'old': delta.old,
+                'new': delta.new}) + '\n')
+    finally:
+        snapshot.close()
+    stats = synchronizer.stats()
+    sys.stderr.write('checked %(checked)d: %(not_modified)d not modified, '
+                     '%(unchanged)d unchanged, %(changed)d changed, '
+                     '%(failed)d failed\n' % stats)
+    for failure in synchronizer.failures:
+        sys.stderr.write('failed: %s %s %r: %s\n' % (
+            failure.key[0].__name__, failure.key[1], failure.key[2],
+            failure.error))
+    return 1 if synchronizer.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,11 +2,48 @@
 
 """Unit tests for Python API wrapper."""
 
+import asyncio
+import concurrent.futures
+import errno
+import gzip
+import io
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from urllib.request import urlopen
 
-from mock import Mock
+from mock import Mock, patch
 
 import api
+import async_api
+import benchmark
+import bulk
+import cache
+import crawler
+import decoding
+import endpoints
+import gateway
+import hedging
+import metrics
+import mirror
+import planner
+import projection
+import records
+import singleflight
+import site_index
+import streaming
+import sync
+import throttle
+import transport
+import warmup
 from api import (SBA_API, Licenses_And_Permits, Loans_And_Grants,
                  Recommended_Sites, City_And_County_Web_Data)
 
@@ -14,13 +51,13 @@ from api import (SBA_API, Licenses_And_Permits, Loans_And_Grants,
 def set_up_tests():
     """Cut down on boilerplate setup testing code."""
     api.urlopen = Mock()
-    api.json = Mock()
+    api.decoding = Mock()
 
 
 def called_url():
     """Test what URL was called through the mocked urlopen."""
-    url = api.urlopen.call_args[0][0]
-    return url
+    request = api.urlopen.call_args[0][0]
+    return request.get_full_url()
 
 
 class Test_SBA_API(unittest.TestCase):
@@ -64,8 +101,9 @@ class TestMethod_Licenses_And_Permits(unittest.TestCase):
     def testmethod_by_business_type(self):
         api.Licenses_And_Permits().by_business_type('general business license')
         url = called_url()
+        # The singular is normalized to the documented business type.
         expected_url = ('http://api.sba.gov/license_permit/by_business_type/'
-                        'general%20business%20license.json')
+                        'general%20business%20licenses.json')
         self.assertEquals(url, expected_url)
 
     def testmethod_by_business_type_state(self):
@@ -104,6 +142,9 @@ class TestMethod_Licenses_And_Permits(unittest.TestCase):
 
 class TestMethod_Loans_And_Grants(unittest.TestCase):
 
+    def setUp(self):
+        set_up_tests()
+
     def testmethod_federal(self):
         api.Loans_And_Grants().federal()
         url = called_url()
@@ -201,6 +242,9 @@ class TestMethod_Loans_And_Grants(unittest.TestCase):
 
 class TestMethod_Recommended_Sites(unittest.TestCase):
 
+    def setUp(self):
+        set_up_tests()
+
     def testmethod_all_sites(self):
         api.Recommended_Sites().all_sites()
         url = called_url()
@@ -238,6 +282,9 @@ class TestMethod_Recommended_Sites(unittest.TestCase):
 
 class TestMethod_City_And_County_Web_Data(unittest.TestCase):
 
+    def setUp(self):
+        set_up_tests()
+
     def testmethod_all_urls_by_state_citycountyurls(self):
         api.City_And_County_Web_Data().all_urls_by_state('tx', True, True)
         url = called_url()
@@ -370,5 +417,2245 @@ class TestMethod_City_And_County_Web_Data(unittest.TestCase):
         self.assertEquals(url, expected_url)
 
 
+def mock_connection(status=200, body='[]', will_close=False):
+    """A stand-in for an HTTPConnection that answers every request."""
+    conn = Mock()
+    conn.getresponse.return_value.status = status
+    conn.getresponse.return_value.read.return_value = body
+    conn.getresponse.return_value.will_close = will_close
+    conn.getresponse.return_value.msg = {}
+    conn.getresponse.return_value.isclosed.return_value = False
+    return conn
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        self.pool = transport.ConnectionPool(maxsize=2, idle_timeout=60)
+        self.pool._new_connection = Mock(
+            side_effect=lambda *args: mock_connection())
+
+    def tearDown(self):
+        SBA_API.transport = None
+
+    def test_connection_reused_per_host(self):
+        self.pool.urlopen('http://api.sba.gov/a.json')
+        self.pool.urlopen('http://api.sba.gov/b.json')
+        self.assertEqual(self.pool._new_connection.call_count, 1)
+
+    def test_separate_hosts_separate_connections(self):
+        self.pool.urlopen('http://api.sba.gov/a.json')
+        self.pool.urlopen('http://localhost:8000/a.json')
+        self.assertEqual(self.pool._new_connection.call_count, 2)
+
+    def test_idle_timeout_discards_connection(self):
+        self.pool.idle_timeout = -1
+        self.pool.urlopen('http://api.sba.gov/a.json')
+        self.pool.urlopen('http://api.sba.gov/a.json')
+        self.assertEqual(self.pool._new_connection.call_count, 2)
+
+    def test_will_close_not_pooled(self):
+        self.pool._new_connection.side_effect = (
+            lambda *args: mock_connection(will_close=True))
+        self.pool.urlopen('http://api.sba.gov/a.json')
+        self.pool.urlopen('http://api.sba.gov/a.json')
+        self.assertEqual(self.pool._new_connection.call_count, 2)
+
+    def test_stale_connection_retried(self):
+        stale = mock_connection()
+        stale.request.side_effect = transport.http_client.BadStatusLine('')
+        self.pool._put(('http', 'api.sba.gov'), stale)
+        response = self.pool.urlopen('http://api.sba.gov/a.json')
+        self.assertEqual(response.read(), '[]')
+        self.assertTrue(stale.close.called)
+
+    def test_reset_connection_retried(self):
+        stale = mock_connection()
+        stale.getresponse.side_effect = socket.error(errno.ECONNRESET,
+                                                     'reset')
+        self.pool._put(('http', 'api.sba.gov'), stale)
+        response = self.pool.urlopen('http://api.sba.gov/a.json')
+        self.assertEqual(response.read(), '[]')
+
+    def test_timeout_not_retried(self):
+        slow = mock_connection()
+        slow.getresponse.side_effect = socket.timeout('timed out')
+        self.pool._put(('http', 'api.sba.gov'), slow)
+        self.assertRaises(socket.timeout, self.pool.urlopen,
+                          'http://api.sba.gov/a.json')
+        self.assertFalse(self.pool._new_connection.called)
+
+    def test_partial_status_line_not_retried(self):
+        garbled = mock_connection()
+        garbled.getresponse.side_effect = \
+            transport.http_client.BadStatusLine('HTT')
+        self.pool._put(('http', 'api.sba.gov'), garbled)
+        self.assertRaises(transport.http_client.BadStatusLine,
+                          self.pool.urlopen, 'http://api.sba.gov/a.json')
+        self.assertFalse(self.pool._new_connection.called)
+
+    def test_error_status_raises(self):
+        self.pool._new_connection.side_effect = (
+            lambda *args: mock_connection(status=404))
+        self.assertRaises(transport.HTTPError, self.pool.urlopen,
+                          'http://api.sba.gov/a.json')
+
+    def test_reused_socket_timeout_reset(self):
+        self.pool.timeout = 30
+        self.pool.urlopen('http://api.sba.gov/a.json', timeout=0.5)
+        self.pool.urlopen('http://api.sba.gov/b.json')
+        conn = self.pool._get(('http', 'api.sba.gov'))
+        conn.sock.settimeout.assert_called_with(30)
+
+    def test_redirect_followed(self):
+        conn = mock_connection(status=301)
+        redirect = conn.getresponse.return_value
+        redirect.msg = {'Location': '/b.json'}
+        target = mock_connection(body='[1]').getresponse.return_value
+        conn.getresponse.side_effect = [redirect, target]
+        self.pool._put(('http', 'api.sba.gov'), conn)
+        response = self.pool.urlopen('http://api.sba.gov/a.json')
+        self.assertEqual(response.read(), '[1]')
+        self.assertEqual(response.geturl(), 'http://api.sba.gov/b.json')
+
+    def test_unfollowed_redirect_raises(self):
+        self.pool._new_connection.side_effect = (
+            lambda *args: mock_connection(status=302))
+        self.assertRaises(transport.HTTPError, self.pool.urlopen,
+                          'http://api.sba.gov/a.json')
+
+    def test_stream_returns_connection(self):
+        server = benchmark.start_server()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        pool = transport.ConnectionPool()
+        self.addCleanup(pool.clear)
+        SBA_API.transport = pool
+        geodata = benchmark.client(City_And_County_Web_Data, server)
+        for encoding in (None, 'gzip'):
+            with patch.object(SBA_API, 'accept_encoding', encoding):
+                self.assertTrue(list(geodata.iter_all_data_by_state(
+                    'ri', False, True)))
+            key = ('http', '127.0.0.1:%d' % server.server_port)
+            self.assertEqual(len(pool._idle[key]), 1)
+
+    def test_wrappers_share_transport(self):
+        SBA_API.transport = self.pool
+        api.Loans_And_Grants().federal()
+        api.Recommended_Sites().all_sites()
+        self.assertEqual(self.pool._new_connection.call_count, 1)
+        self.assertFalse(api.urlopen.called)
+        path = self.pool._get(('http', 'api.sba.gov')).request.call_args[0][1]
+        self.assertEqual(path, '/rec_sites/all_sites/keywords.json')
+
+
+class TestAsyncWrappers(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        self.transport = Mock()
+        self.transport.urlopen = Mock(side_effect=self.urlopen)
+        async_api.SBA_API.transport = self.transport
+
+    def tearDown(self):
+        async_api.SBA_API.transport = None
+
+    async def urlopen(self, url, headers=None, timeout=None):
+        return Mock()
+
+    def called_url(self):
+        return self.transport.urlopen.call_args[0][0]
+
+    def test_call_api_is_awaitable(self):
+        result = asyncio.run(async_api.Loans_And_Grants().federal())
+        self.assertEqual(result, api.decoding.loads.return_value)
+        self.assertEqual(self.called_url(),
+                         'http://api.sba.gov/loans_grants/federal.json')
+
+    def test_same_urls_as_blocking_wrappers(self):
+        asyncio.run(async_api.City_And_County_Web_Data().all_urls_by_county(
+            'ca', 'orange county'))
+        self.assertEqual(self.called_url(),
+                         'http://api.sba.gov/geodata/all_links_for_county_of/'
+                         'orange%20county/ca.json')
+        asyncio.run(async_api.Licenses_And_Permits().by_business_type_state(
+            'child care services', 'va'))
+        self.assertEqual(self.called_url(),
+                         'http://api.sba.gov/license_permit/state_only/'
+                         'child%20care%20services/va.json')
+        asyncio.run(async_api.Recommended_Sites().by_domain('irs'))
+        self.assertEqual(self.called_url(),
+                         'http://api.sba.gov/rec_sites/keywords/domain/'
+                         'irs.json')
+
+    def test_default_pool_per_loop(self):
+        async def pool():
+            return async_api.default_pool()
+        loop = asyncio.new_event_loop()
+        try:
+            first = loop.run_until_complete(pool())
+            self.assertTrue(first is loop.run_until_complete(pool()))
+        finally:
+            loop.close()
+
+    def test_iter_all_urls_by_state_is_async_iterator(self):
+        async def urlopen(url, headers=None, timeout=None):
+            return transport.Response(url, 200, 'OK', {}, json.dumps(
+                [{'name': 'Dallas', 'url': 'http://dallas'},
+                 {'name': 'Austin', 'url': 'http://austin'}]).encode())
+        self.transport.urlopen.side_effect = urlopen
+
+        async def run():
+            web_data = async_api.City_And_County_Web_Data()
+            return [record['name'] async for record in
+                    web_data.iter_all_urls_by_state('tx', True, True,
+                                                    fields='name')]
+        self.assertEqual(asyncio.run(run()), ['Dallas', 'Austin'])
+        self.assertEqual(self.called_url(),
+                         'http://api.sba.gov/geodata/'
+                         'city_county_links_for_state_of/tx.json')
+
+    def test_bulk_licenses_are_awaited(self):
+        async def run():
+            licenses = async_api.Licenses_And_Permits()
+            return [result async for result in
+                    licenses.by_business_type_states(
+                        'restaurant', ['va', 'ca', 'tx'], max_workers=2,
+                        ordered=True)]
+        results = asyncio.run(run())
+        self.assertEqual([result.key for result in results],
+                         ['va', 'ca', 'tx'])
+        self.assertEqual([result.value for result in results],
+                         [api.decoding.loads.return_value] * 3)
+        self.assertEqual([result.error for result in results], [None] * 3)
+        self.assertEqual(self.transport.urlopen.call_count, 3)
+
+    def test_fan_out_bounded_and_errors_captured(self):
+        running = []
+        peak = []
+
+        async def lookup(key):
+            running.append(key)
+            peak.append(len(running))
+            await asyncio.sleep(0)
+            running.remove(key)
+            if key == 'bad':
+                raise ValueError(key)
+            return key.upper()
+
+        async def run():
+            return [result async for result in async_api.fan_out(
+                lookup, ['a', 'bad', 'c', 'd'], max_workers=2)]
+        results = dict((result.key, result) for result in asyncio.run(run()))
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(results['c'].value, 'C')
+        self.assertTrue(isinstance(results['bad'].error, ValueError))
+
+    def test_fan_out_reads_keys_as_calls_finish(self):
+        read = []
+
+        def keys():
+            for key in range(100):
+                read.append(key)
+                yield key
+
+        async def double(key):
+            await asyncio.sleep(0)
+            return key * 2
+
+        async def run(ordered):
+            results = async_api.fan_out(double, keys(), max_workers=3,
+                                        ordered=ordered)
+            first = await results.__anext__()
+            self.assertEqual(len(read), 3)
+            return [first.value] + [result.value async for result in results]
+
+        for ordered in (False, True):
+            del read[:]
+            values = asyncio.run(run(ordered))
+            self.assertEqual(sorted(values), list(range(0, 200, 2)))
+            if ordered:
+                self.assertEqual(values, list(range(0, 200, 2)))
+
+    def test_coalesced_lookup_survives_leader_cancellation(self):
+        flight = async_api.AsyncSingleFlight()
+        calls = []
+
+        async def lookup():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return [1, 2]
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do('url', lookup))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(flight.do('url', lookup))
+            await asyncio.sleep(0)
+            leader.cancel()
+            value = await follower
+            self.assertTrue(leader.cancelled())
+            return value
+
+        self.assertEqual(asyncio.run(run()), [1, 2])
+        self.assertEqual(calls, [1])
+        self.assertEqual(flight.coalesced, 1)
+        self.assertEqual(flight._calls, {})
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def make_cache(self, **kwargs):
+        return cache.MemoryCache(**kwargs)
+
+    def test_miss_then_hit(self):
+        store = self.make_cache()
+        url = 'http://api.sba.gov/loans_grants/federal.json'
+        self.assertTrue(store.get(url) is cache.MISSING)
+        store.set(url, b'[1]', [1])
+        self.assertEqual(store.get(url), [1])
+        self.assertEqual(store.stats(),
+                         {'hits': 1, 'misses': 1, 'evictions': 0,
+                          'revalidations': 0})
+
+    def test_peek_not_counted(self):
+        store = self.make_cache()
+        url = 'http://api.sba.gov/loans_grants/federal.json'
+        self.assertTrue(store.peek(url) is cache.MISSING)
+        store.set(url, b'[1]', [1])
+        self.assertEqual(store.peek(url), [1])
+        self.assertEqual((store.hits, store.misses), (0, 0))
+        expired = self.make_cache(ttl=-1)
+        expired.set(url, b'[1]', [1], {'ETag': '"abc"'})
+        self.assertTrue(expired.peek(url) is cache.MISSING)
+
+    def test_expired_entry_misses(self):
+        store = self.make_cache(ttl=-1)
+        store.set('http://api.sba.gov/a.json', b'[1]', [1])
+        self.assertTrue(store.get('http://api.sba.gov/a.json') is
+                        cache.MISSING)
+
+    def test_expired_entry_kept_for_revalidation(self):
+        store = self.make_cache(ttl=-1)
+        url = 'http://api.sba.gov/a.json'
+        store.set(url, b'[1]', [1], {'ETag': '"abc"'})
+        self.assertTrue(store.get(url) is cache.MISSING)
+        self.assertEqual(store.validators(url), {'ETag': '"abc"'})
+        store.ttl = 60
+        self.assertEqual(store.refresh(url), [1])
+        self.assertEqual(store.get(url), [1])
+        self.assertEqual(store.revalidations, 1)
+        self.assertTrue(store.refresh('http://api.sba.gov/b.json') is
+                        cache.MISSING)
+
+    def test_longest_prefix_ttl(self):
+        store = self.make_cache(ttl=10, ttls={'geodata': 20,
+                                              'geodata/city_links': 30})
+        self.assertEqual(store.ttl_for('http://api.sba.gov/rec_sites/x.json'),
+                         10)
+        self.assertEqual(store.ttl_for(
+            'http://api.sba.gov/geodata/county_links_for_state_of/ca.json'),
+            20)
+        self.assertEqual(store.ttl_for(
+            'http://api.sba.gov/geodata/city_links_for_state_of/ca.json'), 30)
+
+    def test_lru_eviction_by_entries(self):
+        store = self.make_cache(max_entries=2)
+        store.set('http://api.sba.gov/a.json', b'[1]', [1])
+        store.set('http://api.sba.gov/b.json', b'[2]', [2])
+        store.get('http://api.sba.gov/a.json')
+        store.set('http://api.sba.gov/c.json', b'[3]', [3])
+        self.assertEqual(store.get('http://api.sba.gov/a.json'), [1])
+        self.assertTrue(store.get('http://api.sba.gov/b.json') is
+                        cache.MISSING)
+        self.assertEqual(store.evictions, 1)
+
+    def test_eviction_by_bytes(self):
+        store = self.make_cache(max_bytes=10)
+        store.set('http://api.sba.gov/a.json', b'[1, 2, 3]', [1, 2, 3])
+        store.set('http://api.sba.gov/b.json', b'[4, 5]', [4, 5])
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get('http://api.sba.gov/b.json'), [4, 5])
+
+
+class TestSQLiteCache(TestMemoryCache):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_cache(self, **kwargs):
+        path = os.path.join(self.directory, 'cache.db')
+        kwargs.setdefault('access_resolution', 0)
+        return cache.SQLiteCache(path, **kwargs)
+
+    def test_survives_reopen(self):
+        self.make_cache().set('http://api.sba.gov/a.json', b'[1]', [1])
+        self.assertEqual(self.make_cache().get('http://api.sba.gov/a.json'),
+                         [1])
+
+    def test_hits_rarely_write(self):
+        store = self.make_cache(access_resolution=60)
+        store.set('http://api.sba.gov/a.json', b'[1]', [1])
+        changes = store._db.total_changes
+        for i in range(10):
+            self.assertEqual(store.get('http://api.sba.gov/a.json'), [1])
+        self.assertEqual(store._db.total_changes, changes)
+
+
+class TestWALCache(TestMemoryCache):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.caches = []
+
+    def tearDown(self):
+        for store in self.caches:
+            store.close()
+        shutil.rmtree(self.directory)
+
+    def make_cache(self, **kwargs):
+        kwargs.setdefault('vacuum_interval', None)
+        kwargs.setdefault('access_resolution', 0)
+        store = cache.WALCache(self.path, **kwargs)
+        self.caches.append(store)
+        return store
+
+    def test_bodies_compressed_and_shared(self):
+        body = json.dumps([{'name': 'Dallas %d' % i}
+                           for i in range(500)]).encode('utf-8')
+        url = 'http://api.sba.gov/geodata/all_links_for_state_of/tx.json'
+        self.make_cache().set(url, body, None)
+        self.assertEqual(self.make_cache().get(url), json.loads(body))
+        db = sqlite3.connect(self.path)
+        try:
+            self.assertEqual(db.execute('PRAGMA journal_mode').fetchone(),
+                             ('wal',))
+            size, compressed = db.execute(
+                'SELECT size, compressed FROM compressed_responses').fetchone()
+        finally:
+            db.close()
+        self.assertEqual(compressed, 1)
+        self.assertTrue(size < len(body) / 4)
+
+    def test_shared_between_processes(self):
+        url = 'http://api.sba.gov/loans_grants/federal.json'
+        store = self.make_cache()
+        with concurrent.futures.ProcessPoolExecutor(1) as pool:
+            pool.submit(_fill_wal_cache, self.path, url).result()
+        self.assertEqual(store.get(url), [{'title': 'From a worker'}])
+
+    def test_concurrent_readers(self):
+        store = self.make_cache()
+        url = 'http://api.sba.gov/rec_sites/all_sites.json'
+        store.set(url, b'[1, 2, 3]', None)
+        results = []
+        threads = [threading.Thread(target=lambda: results.extend(
+            store.get(url) for i in range(50))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [[1, 2, 3]] * 200)
+        self.assertEqual(store.hits, 200)
+
+    def test_thread_connections_closed_on_exit(self):
+        store = self.make_cache()
+        store.set('http://api.sba.gov/a.json', b'[1]', None)
+        connections = []
+
+        def lookup():
+            store.get('http://api.sba.gov/a.json')
+            connections.append(store._connection())
+
+        for i in range(5):
+            thread = threading.Thread(target=lookup)
+            thread.start()
+            thread.join()
+        self.assertEqual(len([closer for closer in store._closers
+                              if closer.alive]), 1)
+        self.assertRaises(sqlite3.ProgrammingError, connections[0].execute,
+                          'SELECT 1')
+
+    def test_vacuum(self):
+        store = self.make_cache(ttl=-1)
+        store.set('http://api.sba.gov/a.json', b'[1]', None)
+        store.set('http://api.sba.gov/b.json', b'[2]', None, {'ETag': '"b"'})
+        store.vacuum()
+        self.assertEqual(len(store), 1)
+        self.assertEqual(os.path.getsize(self.path + '-wal'), 0)
+        background = self.make_cache(vacuum_interval=0.01)
+        while background.vacuums == 0:
+            threading.Event().wait(0.01)
+
+
+def _fill_wal_cache(path, url):
+    store = cache.WALCache(path, vacuum_interval=None)
+    try:
+        store.set(url, b'[{"title": "From a worker"}]', None)
+    finally:
+        store.close()
+
+
+class TestCallApiCache(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        api.urlopen.return_value.read.return_value = b'{"programs": []}'
+        SBA_API.cache = cache.MemoryCache()
+
+    def tearDown(self):
+        SBA_API.cache = None
+
+    def test_second_call_served_from_cache(self):
+        first = api.Loans_And_Grants().federal()
+        second = api.Loans_And_Grants().federal()
+        self.assertEqual(first, {'programs': []})
+        self.assertTrue(first is second)
+        self.assertEqual(api.urlopen.call_count, 1)
+
+    def test_keyed_on_quoted_url(self):
+        api.Recommended_Sites().by_category('managing a business')
+        self.assertFalse(SBA_API.cache.get(
+            'http://api.sba.gov/rec_sites/category/'
+            'managing%20a%20business.json') is cache.MISSING)
+
+
+class TestRevalidation(unittest.TestCase):
+
+    url = 'http://api.sba.gov/loans_grants/federal.json'
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        SBA_API.cache = cache.MemoryCache(ttl=-1)
+
+    def tearDown(self):
+        SBA_API.cache = None
+        SBA_API.transport = None
+
+    def test_not_modified_reuses_cached_value(self):
+        response = Mock()
+        response.read.return_value = b'{"programs": []}'
+        response.info.return_value = {'ETag': '"v1"'}
+        api.urlopen.return_value = response
+        first = Loans_And_Grants().federal()
+        self.assertEqual(SBA_API.cache.validators(self.url),
+                         {'ETag': '"v1"'})
+        api.urlopen.side_effect = api.HTTPError(
+            self.url, 304, 'Not Modified', {}, None)
+        api.decoding = Mock()
+        self.assertTrue(Loans_And_Grants().federal() is first)
+        request = api.urlopen.call_args[0][0]
+        self.assertEqual(request.get_full_url(), self.url)
+        self.assertEqual(request.get_header('If-none-match'), '"v1"')
+        self.assertFalse(api.decoding.loads.called)
+        self.assertEqual(SBA_API.cache.revalidations, 1)
+
+    def test_changed_response_replaces_entry(self):
+        SBA_API.transport = Mock()
+        SBA_API.transport.urlopen.return_value.read.return_value = b'[1]'
+        SBA_API.transport.urlopen.return_value.info.return_value = {
+            'Last-Modified': 'Tue, 01 Jan 2013 00:00:00 GMT'}
+        Loans_And_Grants().federal()
+        SBA_API.transport.urlopen.return_value.read.return_value = b'[2]'
+        SBA_API.transport.urlopen.return_value.getcode.return_value = 200
+        self.assertEqual(Loans_And_Grants().federal(), [2])
+        self.assertEqual(
+            SBA_API.transport.urlopen.call_args[1]['headers'],
+            {'Accept-Encoding': 'gzip, deflate',
+             'If-Modified-Since': 'Tue, 01 Jan 2013 00:00:00 GMT'})
+
+    def test_against_stub_server(self):
+        server = benchmark.start_server()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        async def twice():
+            loans = benchmark.client(async_api.Loans_And_Grants, server)
+            results = [await loans.federal(), await loans.federal()]
+            async_api.default_pool().clear()
+            return results
+
+        with patch.object(api, 'urlopen', urlopen):
+            for transport_name in ('sequential', 'pooled'):
+                if transport_name == 'pooled':
+                    SBA_API.transport = transport.ConnectionPool()
+                loans = benchmark.client(Loans_And_Grants, server)
+                first = loans.federal()
+                self.assertTrue(loans.federal() is first)
+            SBA_API.transport.clear()
+            SBA_API.transport = None
+            first, second = asyncio.run(twice())
+            self.assertTrue(first is second)
+        # Every call after the very first one was answered with a 304.
+        self.assertEqual(SBA_API.cache.revalidations, 5)
+
+
+class TestCompression(unittest.TestCase):
+
+    body = json.dumps([{'name': 'Dallas %d' % i} for i in range(500)])
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+
+    def tearDown(self):
+        SBA_API.transport = None
+
+    def test_decompress_encodings(self):
+        data = self.body.encode('utf-8')
+        deflate = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw = deflate.compress(data) + deflate.flush()
+        for body, encoding in ((gzip.compress(data), 'gzip'),
+                               (zlib.compress(data), 'deflate'),
+                               (raw, 'deflate'), (data, None)):
+            self.assertEqual(transport.decompress(body, encoding), data)
+            response = Mock()
+            response.read.side_effect = io.BytesIO(body).read
+            response.info.return_value = {'Content-Encoding': encoding}
+            reader = transport.decompressed(response)
+            self.assertEqual(b''.join(iter(lambda: reader.read(7), b'')),
+                             data)
+
+    def test_accept_encoding_sent_and_body_inflated(self):
+        response = Mock()
+        response.read.side_effect = io.BytesIO(
+            gzip.compress(self.body.encode('utf-8'))).read
+        response.info.return_value = {'Content-Encoding': 'gzip'}
+        api.urlopen.return_value = response
+        self.assertEqual(Loans_And_Grants().federal(), json.loads(self.body))
+        request = api.urlopen.call_args[0][0]
+        self.assertEqual(request.get_header('Accept-encoding'),
+                         'gzip, deflate')
+
+    def test_disabled(self):
+        api.urlopen.return_value.read.return_value = b'[]'
+        with patch.object(SBA_API, 'accept_encoding', None):
+            Loans_And_Grants().federal()
+        request = api.urlopen.call_args[0][0]
+        self.assertFalse(request.has_header('Accept-encoding'))
+
+    def test_against_stub_server(self):
+        server = benchmark.start_server()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        path = '/geodata/city_data_for_state_of/ri.json'
+        expected = benchmark.fixture(path)
+
+        async def fetch():
+            geodata = benchmark.client(async_api.City_And_County_Web_Data,
+                                       server)
+            result = await geodata.all_data_by_state('ri', False, True)
+            async_api.default_pool().clear()
+            return result
+
+        with patch.object(api, 'urlopen', urlopen):
+            for pool in (None, transport.ConnectionPool()):
+                SBA_API.transport = pool
+                geodata = benchmark.client(City_And_County_Web_Data, server)
+                self.assertEqual(geodata.all_data_by_state('ri', False, True),
+                                 expected)
+                self.assertEqual(list(geodata.iter_all_data_by_state(
+                    'ri', False, True)), expected)
+                if pool is not None:
+                    pool.clear()
+            SBA_API.transport = None
+            self.assertEqual(asyncio.run(fetch()), expected)
+        self.assertTrue(all(gzipped for path, gzipped
+                            in benchmark.FixtureHandler.payloads))
+
+
+class TestBulkLicenses(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding.loads = lambda data, backend=None: data
+        api.urlopen.side_effect = self.urlopen
+
+    def urlopen(self, request):
+        url = request.get_full_url()
+        if '/tx.json' in url:
+            raise IOError('upstream failed')
+        response = Mock()
+        response.read.return_value = url
+        return response
+
+    def test_all_states_by_default(self):
+        results = list(api.Licenses_And_Permits().by_business_type_states(
+            'restaurant'))
+        self.assertEqual(len(results), 54)
+        self.assertEqual(set(result.key for result in results),
+                         set(api.STATES))
+
+    def test_errors_reported_per_state(self):
+        results = dict((result.key, result) for result in
+                       api.Licenses_And_Permits().by_business_type_states(
+                           'restaurant', ['ca', 'tx', 'ny']))
+        self.assertTrue(isinstance(results['tx'].error, IOError))
+        self.assertEqual(results['ca'].value,
+                         'http://api.sba.gov/license_permit/state_only/'
+                         'restaurant/ca.json')
+        self.assertEqual(results['ny'].error, None)
+
+    def test_ordered(self):
+        states = ['wy', 'ak', 'ca', 'dc', 'ny', 'vi']
+        results = api.Licenses_And_Permits().by_business_type_states(
+            'plumber', states, max_workers=3, ordered=True)
+        self.assertEqual([result.key for result in results], states)
+
+    def test_fan_out_window_bounds_keys_read(self):
+        read = []
+
+        def keys():
+            for key in range(100):
+                read.append(key)
+                yield key
+
+        for ordered in (False, True):
+            del read[:]
+            results = bulk.fan_out(lambda key: key * 2, keys(), max_workers=2,
+                                   ordered=ordered, window=3)
+            first = next(results)
+            self.assertEqual(len(read), 3)
+            values = [first.value] + [result.value for result in results]
+            self.assertEqual(sorted(values), list(range(0, 200, 2)))
+            if ordered:
+                self.assertEqual(values, list(range(0, 200, 2)))
+
+    def test_counties_and_cities(self):
+        counties = list(api.Licenses_And_Permits().by_business_type_counties(
+            'restaurant', [('ca', 'orange county')]))
+        self.assertEqual(counties[0].key, ('ca', 'orange county'))
+        self.assertEqual(counties[0].value,
+                         'http://api.sba.gov/license_permit/state_and_county/'
+                         'restaurant/ca/orange%20county.json')
+        cities = list(api.Licenses_And_Permits().by_business_type_cities(
+            'restaurant', [('ny', 'albany')]))
+        self.assertEqual(cities[0].value,
+                         'http://api.sba.gov/license_permit/state_and_city/'
+                         'restaurant/ny/albany.json')
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        self.release = threading.Event()
+        api.urlopen.side_effect = self.urlopen
+
+    def urlopen(self, request):
+        self.release.wait(5)
+        return Mock()
+
+    def test_concurrent_identical_calls_fetch_once(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            api.Loans_And_Grants().by_state_industry('ca', 'tourism')))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        while SBA_API.coalesce.coalesced < 4:
+            threading.Event().wait(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(api.urlopen.call_count, 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_error_shared_with_waiters(self):
+        flight = singleflight.SingleFlight()
+        self.assertRaises(ValueError, flight.do, 'key', lambda: int('x'))
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+
+    def test_async_concurrent_identical_calls_fetch_once(self):
+        calls = []
+
+        async def urlopen(url, headers=None, timeout=None):
+            calls.append(url)
+            await asyncio.sleep(0.01)
+            return Mock()
+
+        async def lookups():
+            loans = async_api.Loans_And_Grants()
+            return await asyncio.gather(*[loans.federal() for i in range(5)])
+
+        async_api.SBA_API.transport = Mock()
+        async_api.SBA_API.transport.urlopen = urlopen
+        try:
+            results = asyncio.run(lookups())
+        finally:
+            async_api.SBA_API.transport = None
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(result is results[0] for result in results))
+
+
+class TestStreaming(unittest.TestCase):
+
+    records = [{'name': 'Dallas', 'url': 'http://dallascityhall.com',
+                'feature_class': 'Populated Place'},
+               {'name': 'Dallas County', 'url': None, 'population': 12.5},
+               {'name': 'Fort Worth ]', 'tags': ['a,b', '}']}]
+
+    def setUp(self):
+        set_up_tests()
+        api.urlopen.return_value = io.BytesIO(
+            json.dumps(self.records).encode('utf-8'))
+
+    def test_small_chunks(self):
+        body = json.dumps(self.records + [1234567, 'last']).encode('utf-8')
+        for size in (1, 2, 5, 1000):
+            self.assertEqual(list(streaming.iter_json_array(io.BytesIO(body),
+                                                            size)),
+                             self.records + [1234567, 'last'])
+
+    def test_number_split_at_chunk_boundary(self):
+        for body in (b'[1.5, 2]', b'[1e5, 2]', b'[1E-5, 2]', b'[1e+5, 2]'):
+            expected = json.loads(body.decode('utf-8'))
+            for size in range(1, len(body) + 1):
+                self.assertEqual(list(streaming.iter_json_array(
+                    io.BytesIO(body), size)), expected)
+
+    def test_non_array_yielded_whole(self):
+        self.assertEqual(list(streaming.iter_json_array(
+            io.BytesIO(b'{"error": "bad state"}'), 3)),
+            [{'error': 'bad state'}])
+
+    def test_unterminated_array(self):
+        self.assertRaises(ValueError, list, streaming.iter_json_array(
+            io.BytesIO(b'[{"a": 1}, '), 4))
+
+    def test_iter_all_data_by_state(self):
+        records = api.City_And_County_Web_Data().iter_all_data_by_state(
+            'tx', False, True)
+        self.assertEqual(next(records), self.records[0])
+        self.assertEqual(called_url(),
+                         'http://api.sba.gov/geodata/'
+                         'city_data_for_state_of/tx.json')
+        self.assertEqual(list(records), self.records[1:])
+
+    def test_iter_all_urls_by_state(self):
+        records = list(api.City_And_County_Web_Data().iter_all_urls_by_state(
+            'tx', True, True))
+        self.assertEqual(records, self.records)
+        self.assertEqual(called_url(),
+                         'http://api.sba.gov/geodata/'
+                         'city_county_links_for_state_of/tx.json')
+
+
+class TestMirror(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        api.urlopen.side_effect = self.urlopen
+        self.directory = tempfile.mkdtemp()
+        self.mirror = mirror.Mirror(os.path.join(self.directory, 'mirror.db'))
+
+    def tearDown(self):
+        SBA_API.mirror = None
+        self.mirror.close()
+        shutil.rmtree(self.directory)
+
+    def urlopen(self, request):
+        response = Mock()
+        response.read.return_value = json.dumps(
+            {'url': request.get_full_url()}).encode('utf-8')
+        return response
+
+    def test_url_for(self):
+        self.assertEqual(api.Licenses_And_Permits().url_for(
+            'by_business_type_state', 'child care services', 'va'),
+            'http://api.sba.gov/license_permit/state_only/'
+            'child%20care%20services/va.json')
+        self.assertFalse(api.urlopen.called)
+
+    def test_dataset_calls_cover_every_state(self):
+        calls = list(mirror.dataset_calls())
+        states = set(args[0] for wrapper, method, args in calls
+                     if method == 'all_data_by_state')
+        self.assertEqual(states, set(api.STATES))
+        self.assertFalse(any(method == 'by_state_industry_specialty'
+                             for wrapper, method, args in calls))
+
+    def test_build_then_answer_locally(self):
+        failures = self.mirror.build([
+            (api.Loans_And_Grants, 'state', ('ia',)),
+            (api.City_And_County_Web_Data, 'all_data_by_state',
+             ('ca', True, True))])
+        self.assertEqual(failures, [])
+        self.assertEqual(len(self.mirror), 2)
+        api.urlopen.reset_mock()
+        SBA_API.mirror = self.mirror
+        self.assertEqual(api.Loans_And_Grants().state('ia'), {
+            'url': 'http://api.sba.gov/loans_grants/state_financing_for/'
+                   'ia.json'})
+        self.assertFalse(api.urlopen.called)
+        self.assertEqual(list(self.mirror.calls(method='state')), [
+            ('Loans_And_Grants', 'state', ('ia',),
+             'http://api.sba.gov/loans_grants/state_financing_for/ia.json')])
+
+    def test_missing_url_downloaded_unless_offline(self):
+        SBA_API.mirror = self.mirror
+        api.Loans_And_Grants().federal()
+        self.assertTrue(api.urlopen.called)
+        self.mirror.offline = True
+        self.assertRaises(LookupError, api.Loans_And_Grants().state, 'ia')
+
+    def test_build_reports_failures(self):
+        api.urlopen.side_effect = IOError('down')
+        failures = self.mirror.build([(api.Loans_And_Grants, 'federal', ())])
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(len(self.mirror), 0)
+
+    def test_narrow_geodata_answered_from_mirrored_state(self):
+        cities = [{'name': 'Dallas', 'url': 'http://dallas'},
+                  {'name': 'Austin', 'url': 'http://austin'}]
+        self.mirror.add('http://api.sba.gov/geodata/'
+                        'city_county_data_for_state_of/tx.json',
+                        json.dumps(cities).encode('utf-8'))
+        self.mirror.add('http://api.sba.gov/geodata/'
+                        'all_data_for_city_of/austin/tx.json',
+                        b'[{"name": "Austin", "exact": true}]')
+        self.mirror.offline = True
+        SBA_API.mirror = self.mirror
+        geodata = api.City_And_County_Web_Data()
+        self.assertEqual(geodata.all_data_by_city('tx', 'Dallas'),
+                         [cities[0]])
+        self.assertEqual(geodata.all_data_by_city('tx', 'austin'),
+                         [{'name': 'Austin', 'exact': True}])
+        self.assertFalse(api.urlopen.called)
+        # Licenses below the state level cannot be derived.
+        self.assertRaises(LookupError,
+                          api.Licenses_And_Permits().by_business_type_zipcode,
+                          'restaurant', '49684')
+
+    def test_site_lookups_answered_from_mirrored_all_sites(self):
+        sites = TestSiteIndex.sites
+        self.mirror.add('http://api.sba.gov/rec_sites/all_sites/'
+                        'keywords.json',
+                        json.dumps({'sites': sites}).encode('utf-8'))
+        self.mirror.offline = True
+        SBA_API.mirror = self.mirror
+        recommended = api.Recommended_Sites()
+        self.assertEqual(recommended.by_keyword('Export'),
+                         [sites[0], sites[2]])
+        self.assertEqual(recommended.by_category('managing'), [sites[1]])
+        self.assertEqual(recommended.by_master_term('taxes'), [sites[1]])
+        self.assertEqual(recommended.by_domain('www.irs.gov'), [sites[1]])
+        self.assertEqual(recommended.by_domain('irs', fields='title'),
+                         [{'title': 'Tax Information'}])
+        self.assertFalse(api.urlopen.called)
+
+    def test_stream_from_mirror(self):
+        self.mirror.add('http://api.sba.gov/geodata/'
+                        'city_county_links_for_state_of/tx.json',
+                        b'[{"name": "Dallas"}, {"name": "Austin"}]')
+        SBA_API.mirror = self.mirror
+        streamed = api.City_And_County_Web_Data().iter_all_urls_by_state(
+            'tx', True, True)
+        self.assertEqual([record['name'] for record in streamed],
+                         ['Dallas', 'Austin'])
+        self.assertFalse(api.urlopen.called)
+
+
+class TestSiteIndex(unittest.TestCase):
+
+    sites = [
+        {'title': 'Exporting Basics', 'url': 'http://www.export.gov/basics',
+         'description': 'How to start exporting', 'category': 'Growing',
+         'master_term': 'export', 'keywords': 'export, trade, exporting'},
+        {'title': 'Tax Information', 'url': 'http://www.irs.gov/business',
+         'description': 'Federal tax filing', 'category': 'Managing',
+         'master_term': 'taxes', 'keywords': 'tax, irs, EIN'},
+        {'title': 'Export Loans', 'url': 'http://www.sba.gov/export',
+         'description': 'Financing for exporters', 'category': 'Growing',
+         'master_term': 'export', 'keywords': ['export', 'loans']},
+    ]
+
+    def setUp(self):
+        set_up_tests()
+        self.index = site_index.SiteIndex({'sites': self.sites})
+
+    def tearDown(self):
+        api.Recommended_Sites.index = None
+        async_api.Recommended_Sites.index = None
+        async_api.SBA_API.transport = None
+
+    def test_exact_field_lookups(self):
+        self.assertEqual(self.index.by_keyword('Export'),
+                         [self.sites[0], self.sites[2]])
+        self.assertEqual(self.index.by_category('managing'), [self.sites[1]])
+        self.assertEqual(self.index.by_master_term('taxes'), [self.sites[1]])
+        self.assertEqual(self.index.by_domain('irs'), [self.sites[1]])
+        self.assertEqual(self.index.by_domain('sba'), [self.sites[2]])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.prefix('ex'), ['export', 'exporting'])
+        self.assertEqual(self.index.prefix('ex', limit=1), ['export'])
+
+    def test_ranked_search(self):
+        results = self.index.search('export lo')
+        self.assertEqual(results[0], self.sites[2])
+        self.assertFalse(self.sites[1] in results)
+
+    def test_wrapper_answers_from_index(self):
+        api.Recommended_Sites.index = self.index
+        self.assertEqual(api.Recommended_Sites().by_keyword('tax'),
+                         [self.sites[1]])
+        self.assertEqual(api.Recommended_Sites().by_domain('export'),
+                         [self.sites[0]])
+        self.assertFalse(api.urlopen.called)
+
+    def test_index_answers_projected(self):
+        api.decoding.loads.return_value = self.sites
+        sites = api.Recommended_Sites()
+        self.assertEqual(sites.search('irs', fields='title'),
+                         [{'title': 'Tax Information'}])
+        self.assertEqual(sites.by_keyword('tax', fields=('url',)),
+                         [{'url': 'http://www.irs.gov/business'}])
+        self.assertEqual(sites.suggest('ta', fields='title'), ['tax'])
+        self.assertEqual(api.Recommended_Sites.index.by_keyword('tax'),
+                         [self.sites[1]])
+
+    def test_index_loaded_whole_when_projected(self):
+        api.decoding.loads.return_value = self.sites
+        api.Recommended_Sites.fields = ('title',)
+        try:
+            self.assertEqual(api.Recommended_Sites().search('irs'),
+                             [{'title': 'Tax Information'}])
+        finally:
+            del api.Recommended_Sites.fields
+        self.assertEqual(api.Recommended_Sites().search('irs'),
+                         [self.sites[1]])
+
+    def test_search_loads_index_once(self):
+        api.decoding.loads.return_value = self.sites
+        self.assertEqual(api.Recommended_Sites().suggest('t'),
+                         ['tax', 'trade'])
+        api.Recommended_Sites().search('irs')
+        self.assertEqual(api.urlopen.call_count, 1)
+        self.assertEqual(called_url(),
+                         'http://api.sba.gov/rec_sites/all_sites/'
+                         'keywords.json')
+
+
+    def test_async_index(self):
+        async def urlopen(url, headers=None, timeout=None):
+            return Mock()
+        async_api.SBA_API.transport = Mock()
+        async_api.SBA_API.transport.urlopen = Mock(side_effect=urlopen)
+        api.decoding.loads.return_value = self.sites
+
+        async def run():
+            sites = async_api.Recommended_Sites()
+            return (await sites.suggest('t'), await sites.search('irs'),
+                    await sites.by_keyword('tax', fields='title'))
+        suggestions, results, by_keyword = asyncio.run(run())
+        self.assertEqual(suggestions, ['tax', 'trade'])
+        self.assertEqual(results, [self.sites[1]])
+        self.assertEqual(by_keyword, [{'title': 'Tax Information'}])
+        self.assertEqual(async_api.SBA_API.transport.urlopen.call_count, 1)
+        self.assertTrue(api.Recommended_Sites.index is None)
+
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+
+    def tearDown(self):
+        SBA_API.rate_limiter = None
+        SBA_API.concurrency = None
+
+    def test_token_bucket_burst_then_waits(self):
+        limiter = throttle.RateLimiter(rate=10, burst=2)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertEqual(limiter.reserve(), 0)
+        self.assertAlmostEqual(limiter.reserve(), 0.1, places=2)
+        self.assertAlmostEqual(limiter.reserve(), 0.2, places=2)
+
+    def test_waits_bounded_by_deadline(self):
+        limiter = throttle.RateLimiter(rate=1, burst=1)
+        limiter.acquire()
+        self.assertRaises(socket.timeout, limiter.acquire, 0.01)
+        # The refused caller's token is handed back.
+        self.assertTrue(limiter.reserve() < 1.1)
+        limit = throttle.AdaptiveConcurrency(initial=1)
+        limit.acquire()
+        self.assertRaises(socket.timeout, limit.acquire, 0.01)
+        self.assertEqual(limit.in_flight, 1)
+
+    def test_throttle_wait_counts_against_call_deadline(self):
+        SBA_API.concurrency = throttle.AdaptiveConcurrency(initial=1)
+        SBA_API.concurrency.acquire()
+        with hedging.deadline(0.05):
+            self.assertRaises(socket.timeout, api.Loans_And_Grants().federal)
+        self.assertFalse(api.urlopen.called)
+
+    def test_additive_increase(self):
+        limit = throttle.AdaptiveConcurrency(initial=2, maximum=3)
+        for i in range(10):
+            limit.acquire()
+            limit.release(0.01)
+        self.assertEqual(limit.limit, 3)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_multiplicative_decrease_once_per_window(self):
+        limit = throttle.AdaptiveConcurrency(initial=8, target_latency=60)
+        limit.acquire()
+        limit.acquire()
+        limit.release(0.01, error=True)
+        limit.release(120)
+        self.assertEqual(limit.limit, 4)
+
+    def test_minimum(self):
+        limit = throttle.AdaptiveConcurrency(initial=1, minimum=1,
+                                             target_latency=0)
+        limit.acquire()
+        limit.release(1, error=True)
+        self.assertEqual(limit.limit, 1)
+
+    def test_only_retryable_errors_are_congestion(self):
+        limit = throttle.AdaptiveConcurrency(initial=8, target_latency=60)
+        for error in (api.HTTPError('http://api.sba.gov/a.json', 404,
+                                    'Not Found', {}, None), ValueError()):
+            try:
+                with limit.slot():
+                    raise error
+            except Exception:
+                pass
+        self.assertTrue(limit.limit > 8)
+        try:
+            with limit.slot():
+                raise api.HTTPError('http://api.sba.gov/a.json', 503,
+                                    'Unavailable', {}, None)
+        except api.HTTPError:
+            pass
+        self.assertTrue(limit.limit < 8)
+
+    def test_wrappers_share_throttles(self):
+        SBA_API.rate_limiter = Mock()
+        SBA_API.concurrency = throttle.AdaptiveConcurrency(initial=1)
+        api.Loans_And_Grants().federal()
+        api.City_And_County_Web_Data().all_data_by_city('wa', 'seattle')
+        self.assertEqual(SBA_API.rate_limiter.acquire.call_count, 2)
+        self.assertEqual(SBA_API.concurrency.in_flight, 0)
+
+    def test_error_counts_as_congestion(self):
+        SBA_API.concurrency = throttle.AdaptiveConcurrency(initial=4)
+        api.urlopen.side_effect = IOError('throttled')
+        self.assertRaises(IOError, api.Loans_And_Grants().federal)
+        self.assertEqual(SBA_API.concurrency.limit, 2)
+
+
+class TestDeadlinesAndHedging(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+
+    def tearDown(self):
+        SBA_API.timeout = None
+        SBA_API.retries = 0
+        SBA_API.hedge = None
+        SBA_API.latencies = hedging.LatencyWindow()
+
+    def test_timeout_passed_to_urlopen(self):
+        SBA_API.timeout = 5
+        api.Loans_And_Grants().federal()
+        self.assertEqual(called_url(),
+                         'http://api.sba.gov/loans_grants/federal.json')
+        self.assertTrue(0 < api.urlopen.call_args[1]['timeout'] <= 5)
+
+    def test_deadline_context(self):
+        with hedging.deadline(3):
+            with hedging.deadline(60):
+                api.Loans_And_Grants().federal()
+        self.assertTrue(api.urlopen.call_args[1]['timeout'] <= 3)
+        api.Loans_And_Grants().federal()
+        self.assertEqual(api.urlopen.call_args[1], {})
+
+    def test_expired_deadline(self):
+        with hedging.deadline(-1):
+            self.assertRaises(socket.timeout, api.Loans_And_Grants().federal)
+        self.assertFalse(api.urlopen.called)
+
+    def test_retries_transient_errors(self):
+        SBA_API.retries = 2
+        api.urlopen.side_effect = [IOError('reset'), IOError('reset'),
+                                   Mock()]
+        with patch('time.sleep') as sleep:
+            api.Loans_And_Grants().federal()
+        self.assertEqual(api.urlopen.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_no_retry_on_client_error(self):
+        SBA_API.retries = 2
+        api.urlopen.side_effect = hedging.HTTPError('url', 404, 'Not Found',
+                                                    {}, None)
+        self.assertRaises(hedging.HTTPError, api.Loans_And_Grants().federal)
+        self.assertEqual(api.urlopen.call_count, 1)
+
+    def test_retry_respects_deadline(self):
+        SBA_API.retries = 5
+        api.urlopen.side_effect = IOError('reset')
+        with hedging.deadline(0.5):
+            with patch('random.uniform', return_value=99):
+                self.assertRaises(IOError, api.Loans_And_Grants().federal)
+        self.assertEqual(api.urlopen.call_count, 1)
+
+    def test_open_timeout(self):
+        SBA_API.timeout = 5
+        client = api.City_And_County_Web_Data()
+        client.open('http://api.sba.gov/geodata/all_links_for_state_of/'
+                    'tx.json')
+        self.assertTrue(0 < api.urlopen.call_args[1]['timeout'] <= 5)
+        client.open('http://api.sba.gov/geodata/all_links_for_state_of/'
+                    'tx.json', timeout=1)
+        self.assertEqual(api.urlopen.call_args[1]['timeout'], 1)
+
+    def test_hedged_attempts_throttled_and_separate(self):
+        release = threading.Event()
+        client = api.Loans_And_Grants()
+        client.hedge = 0.5
+        client.latencies = Mock()
+        client.latencies.percentile.return_value = 0.01
+        client.rate_limiter = Mock()
+        attempts = []
+
+        def download(url, timeout=None, span=None, revalidation=None):
+            attempts.append(revalidation)
+            if len(attempts) == 1:
+                release.wait(5)
+                revalidation.validators = {'ETag': '"slow"'}
+                return b'slow'
+            revalidation.validators = {'ETag': '"fast"'}
+            # The first attempt ends once the duplicate has answered.
+            threading.Timer(0.01, release.set).start()
+            return b'fast'
+
+        client.download = download
+        revalidation = cache.Revalidation({'ETag': '"old"'})
+        self.assertEqual(client.request('http://api.sba.gov/a.json',
+                                        revalidation=revalidation), b'fast')
+        self.assertEqual(revalidation.validators, {'ETag': '"fast"'})
+        self.assertFalse(attempts[0] is attempts[1])
+        self.assertFalse(revalidation in attempts)
+        self.assertEqual(client.rate_limiter.acquire.call_count, 2)
+
+    def test_percentile_needs_samples(self):
+        window = hedging.LatencyWindow()
+        window.record('a', 0)
+        self.assertEqual(window.percentile('a', 0.9), None)
+        for i in range(1, 100):
+            window.record('a', i)
+        self.assertEqual(window.percentile('a', 0.9), 90)
+
+    def test_hedge_returns_first_success(self):
+        threads = []
+
+        def failing_then_fast():
+            threads.append(threading.current_thread())
+            if len(threads) == 1:
+                time.sleep(0.05)
+                raise IOError('reset')
+            return 'fast'
+
+        self.assertEqual(hedging.hedged(failing_then_fast, 0.01, 5), 'fast')
+        self.assertEqual(len(threads), 2)
+        # Only the duplicate is handed to a worker thread.
+        self.assertTrue(threads[0] is threading.current_thread())
+        self.assertFalse(threads[1] is threading.current_thread())
+
+    def test_no_duplicate_after_early_failure(self):
+        function = Mock(side_effect=IOError('reset'))
+        self.assertRaises(IOError, hedging.hedged, function, 5)
+        self.assertEqual(function.call_count, 1)
+
+    def test_no_hedge_when_fast(self):
+        function = Mock(return_value='data')
+        self.assertEqual(hedging.hedged(function, 5), 'data')
+        self.assertEqual(function.call_count, 1)
+
+    def test_hedge_timeout(self):
+        release = threading.Event()
+        calls = []
+
+        def failing_then_hanging():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.03)
+                raise IOError('reset')
+            release.wait(5)
+
+        self.assertRaises(socket.timeout, hedging.hedged,
+                          failing_then_hanging, 0.01, 0.1)
+        release.set()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        api.urlopen.return_value.read.return_value = b'[{"name": "x"}]'
+        SBA_API.metrics = metrics.Metrics()
+
+    def tearDown(self):
+        SBA_API.metrics = None
+        SBA_API.cache = None
+
+    def test_histogram_percentiles(self):
+        histogram = metrics.Histogram()
+        for value in range(1, 1001):
+            histogram.record(value / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.5, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(99), 0.99, delta=0.01)
+        self.assertEqual(histogram.percentile(100), 1.0)
+        self.assertTrue(len(histogram.counts) < 1000)
+        self.assertEqual(metrics.Histogram().percentile(50), None)
+
+    def test_records_per_family_and_method(self):
+        api.Loans_And_Grants().state('ia')
+        api.Loans_And_Grants().state('ca')
+        api.City_And_County_Web_Data().all_data_by_city('wa', 'seattle')
+        exported = SBA_API.metrics.export()
+        self.assertEqual(exported['counters']['loans_grants.state.requests'],
+                         2)
+        self.assertEqual(exported['counters']['loans_grants.state.bytes'],
+                         30)
+        for phase in ('first_byte', 'transfer', 'decode', 'total', 'bytes'):
+            self.assertEqual(exported['histograms'][
+                'geodata.all_data_by_city.%s' % phase]['count'], 1)
+
+    def test_hooks_receive_spans(self):
+        spans = []
+        SBA_API.metrics.add_hook(spans.append)
+        api.urlopen.side_effect = IOError('down')
+        self.assertRaises(IOError, api.Recommended_Sites().by_domain, 'irs')
+        self.assertEqual(spans[0].family, 'rec_sites')
+        self.assertEqual(spans[0].method, 'by_domain')
+        self.assertTrue(isinstance(spans[0].error, IOError))
+        self.assertEqual(SBA_API.metrics.counters[
+            ('rec_sites', 'by_domain', 'errors')], 1)
+
+    def test_cache_hits_counted(self):
+        SBA_API.cache = cache.MemoryCache()
+        api.Licenses_And_Permits().by_state('ca')
+        api.Licenses_And_Permits().by_state('ca')
+        self.assertEqual(SBA_API.metrics.counters[
+            ('license_permit', 'by_state', 'cache_hits')], 1)
+        self.assertEqual(SBA_API.metrics.counters[
+            ('license_permit', 'by_state', 'requests')], 1)
+
+    def test_pool_records_connect(self):
+        pool = transport.ConnectionPool()
+        pool._new_connection = Mock(
+            side_effect=lambda *args: mock_connection(body=b'[]'))
+        SBA_API.transport = pool
+        try:
+            api.Loans_And_Grants().federal()
+            api.Loans_And_Grants().by_industry('tourism')
+        finally:
+            SBA_API.transport = None
+        counts = SBA_API.metrics.export()['histograms']
+        self.assertEqual(counts['loans_grants.federal.connect']['count'], 1)
+        self.assertFalse('loans_grants.by_industry.connect' in counts)
+        self.assertEqual(
+            counts['loans_grants.by_industry.first_byte']['count'], 1)
+
+    def test_to_json(self):
+        api.Loans_And_Grants().federal()
+        self.assertTrue('loans_grants.federal.requests' in
+                        json.loads(SBA_API.metrics.to_json())['counters'])
+
+
+class TestRecords(unittest.TestCase):
+
+    body = (b'[{"county_name": "Dallas", "name": "Dallas", '
+            b'"url": "http://dallascityhall.com", "tags": [{"a": 1}]}, '
+            b'{"county_name": "Dallas", "name": "Irving", "url": null, '
+            b'"tags": []}]')
+
+    def setUp(self):
+        set_up_tests()
+        api.urlopen.return_value = io.BytesIO(self.body)
+        City_And_County_Web_Data.typed = True
+
+    def tearDown(self):
+        City_And_County_Web_Data.typed = False
+
+    def test_dict_interface(self):
+        record = records.loads(self.body)[0]
+        self.assertEqual(record['name'], 'Dallas')
+        self.assertEqual(record.url, 'http://dallascityhall.com')
+        self.assertEqual(record.get('missing', 1), 1)
+        self.assertTrue('county_name' in record)
+        self.assertEqual(list(record), ['county_name', 'name', 'url',
+                                        'tags'])
+        self.assertEqual(record, json.loads(self.body.decode('utf-8'))[0])
+        self.assertRaises(KeyError, lambda: record['missing'])
+        self.assertRaises(AttributeError, lambda: record.missing)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_shared_class_and_interned_values(self):
+        first, second = records.loads(self.body)
+        self.assertTrue(type(first) is type(second))
+        self.assertTrue(first.county_name is second.county_name)
+
+    def test_pickle_round_trip(self):
+        import pickle
+        record = records.loads(self.body)[0]
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+        self.assertEqual(record.to_dict()['tags'], [{'a': 1}])
+
+    def test_typed_call_api(self):
+        result = City_And_County_Web_Data().all_data_by_state('tx', True,
+                                                           True)
+        self.assertTrue(isinstance(result[0], records.Record))
+        self.assertEqual(result[1].name, 'Irving')
+
+    def test_typed_stream_api(self):
+        result = list(City_And_County_Web_Data().iter_all_data_by_state(
+            'tx', False, True))
+        self.assertTrue(all(isinstance(record, records.Record)
+                            for record in result))
+
+    def test_untyped_wrappers_unaffected(self):
+        api.decoding = decoding
+        api.urlopen.return_value = io.BytesIO(self.body)
+        result = Loans_And_Grants().federal()
+        self.assertTrue(isinstance(result[0], dict))
+
+
+class TestDecoding(unittest.TestCase):
+
+    body = b'[{"name": "Dallas", "population": 1.5, "tags": [null, true]}]'
+
+    def setUp(self):
+        set_up_tests()
+
+    def test_backends_agree_on_every_input_type(self):
+        expected = json.loads(self.body.decode('utf-8'))
+        self.assertTrue('json' in decoding.available())
+        for name in decoding.available():
+            for data in (self.body, bytearray(self.body),
+                         memoryview(self.body), self.body.decode('utf-8')):
+                self.assertEqual(decoding.loads(data, name), expected)
+            self.assertEqual(records.loads(self.body, name), expected)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, decoding.get, 'yaml')
+
+    def test_default_from_environment(self):
+        with patch.dict(os.environ, {'SBA_JSON_BACKEND': 'json'}):
+            self.assertEqual(decoding._default(), 'json')
+        with patch.dict(os.environ, {'SBA_JSON_BACKEND': ''}):
+            self.assertEqual(decoding._default(), decoding.available()[0])
+
+    def test_forced_backend_used_by_call_api(self):
+        api.urlopen.return_value.read.return_value = self.body
+        with patch.object(SBA_API, 'json_backend', 'json'):
+            Loans_And_Grants().federal()
+        api.decoding.loads.assert_called_with(self.body, 'json')
+
+
+class TestEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+
+    def tearDown(self):
+        SBA_API.validate = True
+
+    def test_equivalent_arguments_share_one_url(self):
+        licenses = Licenses_And_Permits()
+        self.assertEqual(
+            licenses.url_for('by_business_type_state_county',
+                             ' Child  Care Services', 'CA', 'Los Angeles'),
+            licenses.url_for('by_business_type_state_county',
+                             'child care services', 'ca',
+                             'los angeles county'))
+        self.assertEqual(
+            City_And_County_Web_Data().url_for('all_urls_by_county', 'LA',
+                                               'Orleans'),
+            'http://api.sba.gov/geodata/all_links_for_county_of/'
+            'orleans%20parish/la.json')
+        self.assertEqual(
+            Licenses_And_Permits().url_for('by_business_type_zipcode',
+                                           'restaurant', '49684-1234'),
+            Licenses_And_Permits().url_for('by_business_type_zipcode',
+                                           'restaurant', 49684))
+
+    def test_combinations_and_domains(self):
+        loans = Loans_And_Grants()
+        self.assertEqual(loans.url_for('by_speciality', 'Woman - General '
+                                       'Purpose'),
+                         'http://api.sba.gov/loans_grants/nil/for_profit/nil/'
+                         'woman-general_purpose.json')
+        Recommended_Sites().by_domain('https://www.IRS.gov/')
+        self.assertEqual(called_url(), 'http://api.sba.gov/rec_sites/'
+                         'keywords/domain/irs.json')
+
+    def test_invalid_values_rejected_locally(self):
+        self.assertRaises(api.InvalidParameter,
+                          Licenses_And_Permits().by_state, 'xx')
+        self.assertRaises(api.InvalidParameter,
+                          Loans_And_Grants().by_speciality, 'woman-pirate')
+        self.assertRaises(api.InvalidParameter,
+                          Licenses_And_Permits().by_business_type_zipcode,
+                          'restaurant', '4968')
+        self.assertRaises(api.InvalidParameter,
+                          City_And_County_Web_Data().all_urls_by_city,
+                          state='tx', city='  ')
+        self.assertFalse(api.urlopen.called)
+
+    def test_error_message_suggests_a_value(self):
+        try:
+            Licenses_And_Permits().by_business_type_state('resturant', 'ny')
+        except api.InvalidParameter as error:
+            self.assertEqual(error.name, 'business')
+            self.assertTrue("did you mean 'restaurant'" in str(error))
+            self.assertTrue(str(error).startswith(
+                'Licenses_And_Permits.by_business_type_state:'))
+        else:
+            self.fail('InvalidParameter not raised')
+
+    def test_validation_can_be_disabled(self):
+        SBA_API.validate = False
+        Licenses_And_Permits().by_state('XX')
+        self.assertEqual(called_url(), 'http://api.sba.gov/license_permit/'
+                         'all_by_state/XX.json')
+
+    def test_registry(self):
+        endpoint = endpoints.REGISTRY['Loans_And_Grants.by_state_industry']
+        self.assertEqual(endpoint.parameters, ('state', 'industry'))
+        self.assertTrue(endpoint.describe()['industry'].startswith(
+            'one of agriculture'))
+
+
+class TestGeodataPlanner(unittest.TestCase):
+
+    records = [{'name': 'Dallas', 'full_county_name': 'Dallas County',
+                'url': 'http://dallascityhall.com'},
+               {'name': 'Dallas County', 'full_county_name': 'Dallas County',
+                'url': 'http://dallascounty.org'},
+               {'name': 'Irving', 'full_county_name': 'Dallas County',
+                'url': None}]
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        api.urlopen.return_value.read.return_value = json.dumps(
+            self.records).encode('utf-8')
+        SBA_API.cache = cache.MemoryCache()
+        City_And_County_Web_Data.planner = planner.GeodataPlanner()
+
+    def tearDown(self):
+        SBA_API.cache = None
+        City_And_County_Web_Data.planner = planner.GeodataPlanner()
+
+    def cache_state(self, directory):
+        SBA_API.cache.set('http://api.sba.gov/geodata/%s.json' % directory,
+                          b'[]', self.records)
+
+    def test_plan(self):
+        self.assertEqual(planner.plan('primary_links_for_county_of/'
+                                      'King  County/wa'),
+                         (('primary_county_links_for_state_of/wa',
+                           'primary_city_county_links_for_state_of/wa'),
+                          'king county'))
+        self.assertEqual(planner.plan('city_links_for_state_of/wa'), None)
+
+    def test_narrow_queries_answered_from_state_response(self):
+        self.cache_state('city_county_links_for_state_of/tx')
+        geodata = City_And_County_Web_Data()
+        self.assertEqual(geodata.all_urls_by_city('tx', 'dallas'),
+                         self.records[:1])
+        self.assertEqual(geodata.all_urls_by_county('TX', 'Dallas'),
+                         self.records[1:2])
+        self.assertFalse(api.urlopen.called)
+        self.assertEqual(geodata.planner.derived, 2)
+
+    def test_only_matching_kind_of_response_used(self):
+        self.cache_state('city_county_links_for_state_of/tx')
+        self.cache_state('city_links_for_state_of/ca')
+        geodata = City_And_County_Web_Data()
+        geodata.all_data_by_city('tx', 'irving')
+        geodata.primary_url_for_city('tx', 'irving')
+        geodata.all_urls_by_county('ca', 'orange county')
+        self.assertEqual(api.urlopen.call_count, 3)
+
+    def test_upgrade_to_state_response(self):
+        City_And_County_Web_Data.planner = planner.GeodataPlanner(
+            upgrade_after=2)
+        geodata = City_And_County_Web_Data()
+        geodata.all_data_by_city('tx', 'dallas')
+        self.assertEqual(geodata.all_data_by_city('tx', 'irving'),
+                         self.records[2:])
+        self.assertEqual(called_url(), 'http://api.sba.gov/geodata/'
+                         'city_data_for_state_of/tx.json')
+        geodata.all_data_by_city('tx', 'plano')
+        self.assertEqual(api.urlopen.call_count, 2)
+        self.assertEqual(geodata.planner.upgrades, 1)
+
+    def test_async_answered_from_cache(self):
+        self.cache_state('primary_city_links_for_state_of/tx')
+        self.assertEqual(asyncio.run(async_api.City_And_County_Web_Data()
+                                     .primary_url_for_city('tx', 'Dallas')),
+                         self.records[:1])
+
+
+class TestLoansPlanner(unittest.TestCase):
+
+    federal = [{'url': 'http://sba.gov/7a', 'industry': 'manufacturing',
+                'specialty': 'woman', 'is_general_purpose': False},
+               {'url': 'http://sba.gov/504', 'industry': 'tourism',
+                'specialty': 'rural', 'is_general_purpose': True}]
+    state = [{'url': 'http://sba.gov/7a', 'industry': 'manufacturing',
+              'specialty': 'woman', 'is_general_purpose': False},
+             {'url': 'http://maine.gov/grow', 'industry': 'manufacturing',
+              'specialty': 'minority, veteran', 'is_general_purpose': False}]
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        self.responses = {'federal': self.federal,
+                          'state_financing_for/me': self.state,
+                          'state_financing_for/ia': []}
+        api.urlopen.side_effect = self.urlopen
+        SBA_API.cache = cache.MemoryCache()
+        Loans_And_Grants.planner = planner.LoansPlanner()
+
+    def tearDown(self):
+        SBA_API.cache = None
+        Loans_And_Grants.planner = None
+
+    def urlopen(self, request):
+        directory = request.get_full_url().split('/loans_grants/')[1][:-5]
+        response = Mock()
+        response.read.return_value = json.dumps(
+            self.responses.get(directory, [])).encode('utf-8')
+        return response
+
+    def test_merge_deduplicates(self):
+        merged = planner.merge(self.federal, self.state)
+        self.assertEqual([record['url'] for record in merged],
+                         ['http://sba.gov/7a', 'http://sba.gov/504',
+                          'http://maine.gov/grow'])
+
+    def test_composed_from_cached_pieces_only(self):
+        loans = Loans_And_Grants()
+        loans.federal_and_state('me')
+        self.assertEqual(called_url(), 'http://api.sba.gov/loans_grants/'
+                         'federal_and_state_financing_for/me.json')
+        loans.federal()
+        loans.state('me')
+        api.urlopen.reset_mock()
+        SBA_API.cache.clear()
+        loans.federal()
+        loans.state('me')
+        self.assertEqual(len(loans.federal_and_state('me')), 3)
+        self.assertEqual(api.urlopen.call_count, 2)
+
+    def test_piece_probes_not_counted(self):
+        loans = Loans_And_Grants()
+        loans.federal()
+        # Only the state piece is missing, so the call goes to the API.
+        self.assertEqual(loans.federal_and_state('me'), [])
+        self.assertEqual((SBA_API.cache.hits, SBA_API.cache.misses), (0, 2))
+        loans.federal_and_state('me')
+        self.assertEqual((SBA_API.cache.hits, SBA_API.cache.misses), (1, 2))
+
+    def test_sweep_fetches_federal_once(self):
+        Loans_And_Grants.planner = planner.LoansPlanner(fetch_pieces=True)
+        loans = Loans_And_Grants()
+        self.assertEqual(len(loans.federal_and_state('me')), 3)
+        self.assertEqual(loans.federal_and_state('ia'), self.federal)
+        self.assertEqual(api.urlopen.call_count, 3)
+        self.assertEqual(Loans_And_Grants.planner.derived, 2)
+
+    def test_metrics_labelled_by_wrapper_method(self):
+        Loans_And_Grants.planner = planner.LoansPlanner(fetch_pieces=True)
+        SBA_API.metrics = metrics.Metrics()
+        try:
+            Loans_And_Grants().federal_and_state('me')
+        finally:
+            counters, SBA_API.metrics = SBA_API.metrics.counters, None
+        self.assertEqual(counters[
+            ('loans_grants', 'federal_and_state', 'planned')], 1)
+        # The pieces fetched for the planner are not the caller's requests.
+        self.assertEqual(set(method for family, method, name in counters),
+                         set(['federal_and_state', None]))
+
+    def test_state_searches_filter_state_programs(self):
+        Loans_And_Grants.planner = planner.LoansPlanner(fetch_pieces=True)
+        loans = Loans_And_Grants()
+        self.assertEqual(
+            loans.by_state_industry_specialty('me', 'manufacturing',
+                                              'minority-woman'),
+            self.state)
+        self.assertEqual(loans.by_state_specialty('me', 'minority'),
+                         [self.state[1]])
+        self.assertEqual(loans.by_state_industry('me', 'tourism'), [])
+        self.assertEqual(api.urlopen.call_count, 1)
+        self.assertEqual(called_url(), 'http://api.sba.gov/loans_grants/'
+                         'state_financing_for/me.json')
+        loans.by_industry('tourism')
+        self.assertEqual(called_url(), 'http://api.sba.gov/loans_grants/'
+                         'nil/for_profit/tourism/nil.json')
+
+    def test_industry_specialty_from_cached_nationwide_search(self):
+        self.responses['nil/for_profit/nil/woman'] = self.state
+        loans = Loans_And_Grants()
+        loans.by_industry_specialty('tourism', 'woman')
+        self.assertEqual(api.urlopen.call_count, 1)
+        loans.by_speciality('woman')
+        self.assertEqual(loans.by_industry_specialty('manufacturing',
+                                                     'woman'),
+                         [self.state[0]])
+        self.assertEqual(api.urlopen.call_count, 2)
+        self.assertEqual(Loans_And_Grants.planner.derived, 1)
+
+
+class TestWarmup(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        api.urlopen.side_effect = self.urlopen
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'calls.jsonl')
+        SBA_API.cache = cache.MemoryCache()
+
+    def tearDown(self):
+        if SBA_API.query_log is not None:
+            SBA_API.query_log.close()
+        SBA_API.query_log = None
+        SBA_API.cache = None
+        shutil.rmtree(self.directory)
+
+    def urlopen(self, request):
+        response = Mock()
+        response.read.return_value = json.dumps(
+            [{'url': request.get_full_url()}]).encode('utf-8')
+        response.info.return_value = {}
+        return response
+
+    def test_query_log_records_normalized_wrapper_calls(self):
+        SBA_API.query_log = warmup.QueryLog(self.path)
+        Loans_And_Grants().state(' IA ')
+        Loans_And_Grants().federal()
+        Loans_And_Grants().federal()
+        City_And_County_Web_Data().all_data_by_state('tx', True, False)
+        with open(self.path) as lines:
+            entries = [json.loads(line) for line in lines]
+        self.assertEqual([(entry['wrapper'], entry['method'], entry['args'])
+                          for entry in entries], [
+            ('Loans_And_Grants', 'state', ['ia']),
+            ('Loans_And_Grants', 'federal', []),
+            ('Loans_And_Grants', 'federal', []),
+            ('City_And_County_Web_Data', 'all_data_by_state',
+             ['tx', True, False])])
+
+    def test_planner_fetches_not_logged(self):
+        SBA_API.query_log = warmup.QueryLog(self.path)
+        with patch.object(Loans_And_Grants, 'planner',
+                          planner.LoansPlanner(fetch_pieces=True)):
+            Loans_And_Grants().federal_and_state('me')
+        with open(self.path) as lines:
+            methods = [json.loads(line)['method'] for line in lines]
+        self.assertEqual(methods, ['federal_and_state'])
+
+    def test_read_log_skips_bad_lines(self):
+        lines = ['{"wrapper": "Loans_And_Grants", "method": "state", '
+                 '"args": ["ia"]}',
+                 '',
+                 '{"wrapper": "Nope", "method": "state", "args": []}',
+                 '{"wrapper": "Loans_And_Grants", "method": "_private"}',
+                 '{"wrapper": "Loans_And_Grants", "method": "fed']
+        self.assertEqual(list(warmup.read_log(lines)), [
+            (Loans_And_Grants, 'state', ('ia',))])
+
+    def test_unique_calls_most_frequent_first(self):
+        calls = [(Loans_And_Grants, 'state', ('ia',)),
+                 (Loans_And_Grants, 'federal', ()),
+                 (Loans_And_Grants, 'state', ('IA',)),
+                 (Loans_And_Grants, 'state', ('xx',)),
+                 (City_And_County_Web_Data, 'iter_all_data_by_state',
+                  ('tx', True, True))]
+        self.assertEqual(warmup.unique_calls(calls), [
+            (Loans_And_Grants, 'state', ('ia',)),
+            (Loans_And_Grants, 'federal', ())])
+        self.assertFalse(api.urlopen.called)
+
+    def test_warm_fills_cache(self):
+        calls = [(Loans_And_Grants, 'state', ('ia',)),
+                 (Loans_And_Grants, 'federal', ())]
+        progress = Mock()
+        summary = warmup.warm(calls, max_workers=2, progress=progress)
+        self.assertEqual(summary, warmup.Summary(2, 0, []))
+        self.assertEqual(progress.call_args[0], (2, 2))
+        self.assertEqual(len(SBA_API.cache), 2)
+        api.urlopen.reset_mock()
+        Loans_And_Grants().state('ia')
+        self.assertFalse(api.urlopen.called)
+
+    def test_warm_budget_and_failures(self):
+        calls = [(Loans_And_Grants, 'state', ('ia',))]
+        self.assertEqual(warmup.warm(calls, budget=0),
+                         warmup.Summary(0, 1, []))
+        api.urlopen.side_effect = IOError('down')
+        summary = warmup.warm(calls)
+        self.assertEqual(summary.warmed, 0)
+        self.assertEqual(summary.failures[0].key, calls[0])
+
+    def test_main_replays_log_into_sqlite_cache(self):
+        SBA_API.query_log = warmup.QueryLog(self.path)
+        Loans_And_Grants().state('ia')
+        Loans_And_Grants().state('ia')
+        SBA_API.query_log.close()
+        SBA_API.query_log = None
+        database = os.path.join(self.directory, 'cache.db')
+        with patch.object(sys, 'stderr', io.StringIO()):
+            self.assertEqual(warmup.main([self.path, '--cache', database]),
+                             0)
+        warmed = cache.SQLiteCache(database)
+        try:
+            self.assertEqual(len(warmed), 1)
+        finally:
+            warmed.close()
+        database = os.path.join(self.directory, 'shared.db')
+        with patch.object(sys, 'stderr', io.StringIO()):
+            self.assertEqual(warmup.main([self.path, '--cache', database,
+                                          '--wal']), 0)
+        warmed = cache.WALCache(database, vacuum_interval=None)
+        try:
+            self.assertEqual(len(warmed), 1)
+        finally:
+            warmed.close()
+
+
+class TestCrawler(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        # Forked workers inherit the module state.
+        api.decoding = decoding
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'programs.db')
+        self.server = benchmark.start_server()
+        self.root = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_combinations(self):
+        space = list(crawler.combinations())
+        self.assertEqual(len(space), len(api.STATES) * len(api.INDUSTRIES) *
+                         len(api.SPECIALTIES))
+        self.assertEqual(space[0], ('al', 'agriculture', 'general_purpose'))
+
+    def test_run_then_resume(self):
+        space = list(crawler.combinations(('me', 'ia'), ('manufacturing',),
+                                          ('woman', 'rural')))
+        crawl = crawler.Crawler(self.path, self.root)
+        try:
+            progress = Mock()
+            summary = crawl.run(space[:3], processes=2, progress=progress)
+            self.assertEqual(summary, crawler.Summary(3, 0, []))
+            self.assertEqual(progress.call_args[0], (3, 3))
+            summary = crawl.run(space + [('xx', 'manufacturing', 'woman')],
+                                processes=2)
+        finally:
+            crawl.close()
+        self.assertEqual(summary.fetched, 1)
+        self.assertEqual(summary.skipped, 3)
+        self.assertEqual(summary.failures[0][0],
+                         ('xx', 'manufacturing', 'woman'))
+        self.assertTrue('InvalidParameter' in summary.failures[0][1])
+        crawl = crawler.Crawler(self.path)
+        try:
+            self.assertEqual(len(crawl), 4)
+            with patch.object(crawler.decoding, 'loads') as loads:
+                results = list(crawl.results())
+            # Decoded once, by the workers.
+            self.assertFalse(loads.called)
+            self.assertEqual(results[0][:3], ('ia', 'manufacturing', 'rural'))
+            self.assertEqual(len(results[0][3]), 60)
+            programs = crawl.programs()
+            self.assertEqual(len(programs), len(set(
+                program['url'] for program in programs)))
+        finally:
+            crawl.close()
+
+
+class TestSync(unittest.TestCase):
+
+    state_url = 'http://api.sba.gov/loans_grants/state_financing_for/ia.json'
+    federal_url = 'http://api.sba.gov/loans_grants/federal.json'
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        api.urlopen.side_effect = self.urlopen
+        self.directory = tempfile.mkdtemp()
+        self.mirror = mirror.Mirror(os.path.join(self.directory, 'mirror.db'))
+        self.calls = [(Loans_And_Grants, 'state', ('ia',)),
+                      (Loans_And_Grants, 'federal', ())]
+        self.bodies = {
+            self.state_url: [{'url': 'http://ia.gov/1', 'title': 'One'},
+                             {'url': 'http://ia.gov/2', 'title': 'Two'}],
+            self.federal_url: [{'url': 'http://sba.gov/7a', 'title': '7(a)'}]}
+        self.requests = []
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.directory)
+
+    def urlopen(self, request):
+        url = request.get_full_url()
+        body = json.dumps(self.bodies[url]).encode('utf-8')
+        etag = '"%s"' % mirror.digest(body)[:8]
+        self.requests.append((url, request.get_header('If-none-match')))
+        if request.get_header('If-none-match') == etag:
+            raise api.HTTPError(url, 304, 'Not Modified', {}, None)
+        response = Mock()
+        response.read.return_value = body
+        response.info.return_value = {'ETag': etag}
+        response.getcode.return_value = 200
+        return response
+
+    def test_diff(self):
+        old = [{'url': 'a', 'v': 1}, {'url': 'b', 'v': 1}, {'name': 'x'}]
+        new = [{'url': 'a', 'v': 2}, {'url': 'c', 'v': 1}, {'name': 'x'}]
+        self.assertEqual(sorted(sync.diff('u', old, new)), [
+            sync.Delta('added', 'u', ('c',), None, {'url': 'c', 'v': 1}),
+            sync.Delta('changed', 'u', ('a',), {'url': 'a', 'v': 1},
+                       {'url': 'a', 'v': 2}),
+            sync.Delta('removed', 'u', ('b',), {'url': 'b', 'v': 1}, None)])
+        self.assertEqual(sync.record_key({'feature_id': '7', 'url': None}),
+                         ('7',))
+        repeated = [{'url': 'a'}, {'url': 'a'}]
+        self.assertEqual([delta.key for delta in
+                          sync.diff('u', repeated[:1], repeated)],
+                         [('a', 2)])
+
+    def test_only_changed_entries_emit_deltas(self):
+        self.assertEqual(self.mirror.build(self.calls), [])
+        digest, validators = self.mirror.fingerprint(self.federal_url)
+        self.assertEqual(len(digest), 64)
+        self.assertEqual(list(validators), ['ETag'])
+        self.bodies[self.state_url] = [
+            {'url': 'http://ia.gov/1', 'title': 'One, renamed'},
+            {'url': 'http://ia.gov/3', 'title': 'Three'}]
+        del self.requests[:]
+        synchronizer = sync.Sync(self.mirror, max_workers=1)
+        deltas = sorted(synchronizer.run())
+        self.assertEqual([(delta.kind, delta.url, delta.key)
+                          for delta in deltas], [
+            ('added', self.state_url, ('http://ia.gov/3',)),
+            ('changed', self.state_url, ('http://ia.gov/1',)),
+            ('removed', self.state_url, ('http://ia.gov/2',))])
+        # Both were requested conditionally; federal answered 304.
+        self.assertTrue(all(etag for url, etag in self.requests))
+        self.assertEqual(synchronizer.stats(), {
+            'checked': 2, 'not_modified': 1, 'unchanged': 0, 'changed': 1,
+            'failed': 0})
+        self.assertEqual(json.loads(self.mirror.get(self.state_url)),
+                         self.bodies[self.state_url])
+        second = sync.Sync(self.mirror)
+        self.assertEqual(list(second.run()), [])
+        self.assertEqual(second.not_modified, 2)
+
+    def test_same_digest_without_validators_is_unchanged(self):
+        body = json.dumps(self.bodies[self.federal_url]).encode('utf-8')
+        self.mirror.add(self.federal_url, body, 'Loans_And_Grants',
+                        'federal', ())
+        synchronizer = sync.Sync(self.mirror)
+        self.assertEqual(list(synchronizer.run()), [])
+        self.assertEqual(synchronizer.unchanged, 1)
+        self.assertEqual(len(self.mirror), 1)
+        self.assertTrue(self.mirror.fingerprint(self.federal_url)[1])
+
+    def test_new_call_and_failures(self):
+        synchronizer = sync.Sync(self.mirror)
+        self.bodies[self.federal_url] = [{'title': 'No URL'}]
+        deltas = list(synchronizer.run(self.calls[1:] + [
+            (Loans_And_Grants, 'state', ('ny',))]))
+        self.assertEqual([delta.kind for delta in deltas], ['added'])
+        self.assertEqual(len(synchronizer.failures), 1)
+        self.assertEqual(len(self.mirror), 1)
+
+
+class TestGateway(unittest.TestCase):
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        self.upstream = benchmark.start_server()
+        self.gateway = gateway.Gateway(
+            cache.MemoryCache(ttl=3600),
+            upstream='http://127.0.0.1:%d' % self.upstream.server_port,
+            port=0).start()
+
+    def tearDown(self):
+        self.gateway.close()
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        SBA_API.cache = None
+
+    def test_api_root_points_wrappers_at_gateway(self):
+        with patch.object(SBA_API, 'api_root', self.gateway.url):
+            loans = Loans_And_Grants()
+            self.assertEqual(loans.base_url,
+                             self.gateway.url + '/loans_grants')
+            with patch.object(api, 'urlopen', urlopen):
+                first = loans.state('me')
+                second = Loans_And_Grants().state('me')
+        self.assertEqual(first, benchmark.loan_records('me'))
+        self.assertEqual(first, second)
+        self.assertEqual(Loans_And_Grants().base_url,
+                         'http://api.sba.gov/loans_grants')
+        stats = self.gateway.stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_concurrent_requests_share_one_download(self):
+        release = threading.Event()
+        started = threading.Event()
+        original = self.gateway.upstream.fetch
+
+        def slow_fetch(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return original(*args, **kwargs)
+        self.gateway.upstream.fetch = Mock(side_effect=slow_fetch)
+        url = self.gateway.url + '/rec_sites/all_sites.json'
+        bodies = []
+        threads = [threading.Thread(
+            target=lambda: bodies.append(urlopen(url).read()))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        started.wait(5)
+        while self.gateway.stats()['coalesced'] < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.gateway.upstream.fetch.call_count, 1)
+        self.assertEqual(len(set(bodies)), 1)
+        self.assertEqual(json.loads(bodies[0]), benchmark.site_records())
+
+    def test_revalidation_and_errors(self):
+        SBA_API.cache = cache.MemoryCache(ttl=-1)
+        with patch.object(SBA_API, 'api_root', self.gateway.url):
+            with patch.object(api, 'urlopen', urlopen):
+                loans = Loans_And_Grants()
+                first = loans.federal()
+                self.assertTrue(loans.federal() is first)
+        self.assertEqual(SBA_API.cache.revalidations, 1)
+        try:
+            urlopen(self.gateway.url + '/nowhere')
+        except api.HTTPError as error:
+            self.assertEqual(error.code, 404)
+        else:
+            self.fail('expected a 404')
+        self.gateway.upstream.fetch = Mock(side_effect=IOError('down'))
+        try:
+            urlopen(self.gateway.url + '/loans_grants/state_financing_for/'
+                    'ny.json')
+        except api.HTTPError as error:
+            self.assertEqual(error.code, 502)
+            self.assertTrue(b'down' in error.read())
+        else:
+            self.fail('expected a 502')
+
+
+class TestProjection(unittest.TestCase):
+
+    records = [{'name': 'Dallas', 'url': 'http://dallascityhall.com',
+                'state_abbreviation': 'TX', 'description': 'x' * 100},
+               {'name': 'Dallas County', 'url': None,
+                'state_abbreviation': 'TX', 'feature_id': '1'}]
+
+    def setUp(self):
+        set_up_tests()
+        api.decoding = decoding
+        api.urlopen.side_effect = lambda request: io.BytesIO(
+            json.dumps(self.records).encode('utf-8'))
+
+    def tearDown(self):
+        SBA_API.cache = None
+        City_And_County_Web_Data.typed = False
+
+    def test_normalize(self):
+        self.assertEqual(projection.normalize(' name, url,name'),
+                         ('name', 'url'))
+        self.assertEqual(projection.normalize(['url']), ('url',))
+        self.assertTrue(projection.normalize(None) is None)
+        self.assertRaises(ValueError, projection.normalize, ',')
+        self.assertRaises(ValueError, projection.normalize, [1])
+        self.assertRaises(endpoints.InvalidParameter,
+                          City_And_County_Web_Data().all_urls_by_state,
+                          'tx', True, True, fields='')
+
+    def test_loads_projects_each_element(self):
+        body = json.dumps(self.records).encode('utf-8')
+        self.assertEqual(projection.loads(memoryview(body),
+                                          ('name', 'feature_id')),
+                         [{'name': 'Dallas'},
+                          {'name': 'Dallas County', 'feature_id': '1'}])
+        self.assertEqual(projection.loads(b' {"a": 1, "b": 2}', ('b',)),
+                         {'b': 2})
+        self.assertEqual(projection.loads('[1, "x"]', ('b',)), [1, 'x'])
+
+    def test_wrapped_records_projected(self):
+        body = (b'{"count": 2, "sites": [{"title": "IRS", "url": "irs"}, '
+                b'{"title": "SBA", "url": "sba"}]}')
+        expected = {'count': 2, 'sites': [{'title': 'IRS'}, {'title': 'SBA'}]}
+        self.assertEqual(projection.loads(body, ('title',)), expected)
+        self.assertEqual(projection.project(json.loads(body.decode('utf-8')),
+                                            ('title',)), expected)
+        typed = projection.loads(body, ('title',), typed=True)
+        self.assertEqual(typed['sites'][1]['title'], 'SBA')
+        self.assertEqual(typed['sites'][1].keys(), ['title'])
+        # A record with a list field is still projected as a record.
+        self.assertEqual(projection.loads(b'{"b": 2, "tags": [{"a": 1}]}',
+                                          ('b',)), {'b': 2})
+
+    def test_projected_without_cache(self):
+        geodata = City_And_County_Web_Data()
+        self.assertEqual(geodata.all_urls_by_state('tx', True, True,
+                                                   fields='name,url'), [
+            {'name': 'Dallas', 'url': 'http://dallascityhall.com'},
+            {'name': 'Dallas County', 'url': None}])
+        self.assertEqual(called_url(), 'http://api.sba.gov/geodata/'
+                         'city_county_links_for_state_of/tx.json')
+        self.assertEqual(geodata.fields, None)
+        self.assertEqual(Loans_And_Grants().federal(fields=['url']),
+                         [{'url': 'http://dallascityhall.com'},
+                          {'url': None}])
+
+    def test_class_setting_and_typed_records(self):
+        City_And_County_Web_Data.typed = True
+        with patch.object(City_And_County_Web_Data, 'fields', ('name',)):
+            projected = City_And_County_Web_Data().all_data_by_state(
+                'tx', True, True)
+            streamed = list(City_And_County_Web_Data().iter_all_data_by_state(
+                'tx', True, True))
+        self.assertTrue(isinstance(projected[0], records.Record))
+        self.assertEqual(projected[0].keys(), ['name'])
+        self.assertEqual(streamed, projected)
+        self.assertTrue(isinstance(streamed[1], records.Record))
+
+    def test_streaming(self):
+        records = list(City_And_County_Web_Data().iter_all_urls_by_state(
+            'tx', True, True, fields=('url', 'missing')))
+        self.assertEqual(records, [{'url': 'http://dallascityhall.com'},
+                                   {'url': None}])
+
+    def test_memory_cache_keeps_whole_records(self):
+        SBA_API.cache = cache.MemoryCache()
+        geodata = City_And_County_Web_Data()
+        self.assertEqual(geodata.all_urls_by_state('tx', True, True,
+                                                   fields='name'),
+                         [{'name': 'Dallas'}, {'name': 'Dallas County'}])
+        self.assertEqual(geodata.all_urls_by_state('tx', True, True),
+                         self.records)
+        self.assertEqual(geodata.all_urls_by_state('tx', True, True,
+                                                   fields='feature_id'),
+                         [{}, {'feature_id': '1'}])
+        self.assertEqual(api.urlopen.call_count, 1)
+
+    def test_body_cache_decodes_projected(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        SBA_API.cache = cache.SQLiteCache(os.path.join(directory, 'c.db'))
+        self.addCleanup(SBA_API.cache.close)
+        geodata = City_And_County_Web_Data()
+        for i in range(2):
+            self.assertEqual(geodata.all_urls_by_state('tx', True, True,
+                                                       fields='name'),
+                             [{'name': 'Dallas'}, {'name': 'Dallas County'}])
+        self.assertEqual(SBA_API.cache.hits, 1)
+        self.assertEqual(geodata.all_urls_by_state('tx', True, True),
+                         self.records)
+
+    def test_bulk_methods_and_planner(self):
+        results = dict(
+            (result.key, result.value) for result in
+            Licenses_And_Permits().by_business_type_states(
+                'restaurant', ['ca', 'tx'], fields='name'))
+        self.assertEqual(results['ca'], [{'name': 'Dallas'},
+                                         {'name': 'Dallas County'}])
+        SBA_API.cache = cache.MemoryCache()
+        geodata = City_And_County_Web_Data()
+        geodata.all_urls_by_state('tx', True, True)
+        self.assertEqual(geodata.all_urls_by_city('tx', 'dallas',
+                                                  fields='url'),
+                         [{'url': 'http://dallascityhall.com'}])
+        self.assertEqual(api.urlopen.call_count, 3)
+
+    def test_async(self):
+        async def lookup():
+            loans = async_api.Loans_And_Grants()
+            loans.transport = Mock()
+            response = Mock()
+            response.read.return_value = json.dumps(
+                self.records).encode('utf-8')
+            response.info.return_value = {}
+
+            async def urlopen(url, headers=None, timeout=None):
+                return response
+            loans.transport.urlopen = urlopen
+            return await loans.state('tx', fields=('name',))
+        self.assertEqual(asyncio.run(lookup()),
+                         [{'name': 'Dallas'}, {'name': 'Dallas County'}])
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_fixture_shapes(self):
+        records = benchmark.fixture('/geodata/city_county_data_for_state_of/'
+                                    'tx.json')
+        self.assertEqual(len(records), benchmark.CITIES_PER_STATE['tx'])
+        self.assertEqual(records[0]['state_abbreviation'], 'TX')
+        self.assertTrue(len(json.dumps(records)) > 2 * 1024 * 1024)
+        self.assertEqual(benchmark.fixture('/geodata/all_links_for_city_of/'
+                                           'nowhere/ri.json'),
+                         benchmark.geodata_records('ri')[:3])
+
+    def test_run_against_stub_server(self):
+        server = benchmark.start_server()
+        try:
+            with patch.object(api, 'urlopen', urlopen):
+                with patch.object(api, 'decoding', decoding):
+                    results = benchmark.run(
+                        requests=2, concurrency=(1, 2),
+                        scenarios=benchmark.SCENARIOS[2:3],
+                        transports=('sequential', 'pooled', 'async'),
+                        server=server)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(len(results), 10)
+        self.assertEqual(set(result['cache'] for result in results),
+                         set(['cold', 'warm']))
+        for result in results:
+            self.assertEqual(result['requests'], 2)
+            self.assertTrue(result['p99'] >= result['p50'] > 0)
+            self.assertEqual(result['scenario'], 'loans.federal')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Client side throttling shared by every SBA_API instance: a token bucket
+rate limit and an adaptive (AIMD) limit on requests in flight.
+
+>>> import api, throttle
+>>> api.SBA_API.rate_limiter = throttle.RateLimiter(rate=20, burst=40)
+>>> api.SBA_API.concurrency = throttle.AdaptiveConcurrency(
+...     target_latency=1.0, maximum=32)
+"""
+
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from hedging import retryable
+
+
+class RateLimiter(object):
+    """Token bucket allowing rate requests per second on average and bursts
+    of up to burst requests.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how many seconds to wait before using
+        it. Waiting callers queue behind each other."""
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self, timeout=None):
+        """Block until a request may be sent. Raises socket.timeout, without
+        taking a token, when that is more than timeout seconds away."""
+        delay = self.reserve()
+        if timeout is not None and delay > timeout:
+            with self._lock:
+                self._tokens += 1
+            raise socket.timeout('SBA API deadline exceeded')
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveConcurrency(object):
+    """Additive increase, multiplicative decrease limit on requests in
+    flight. Each success below target_latency grows the limit by about one
+    per limit's worth of requests; a retryable error or slow response
+    multiplies it by backoff, at most once per target_latency.
+
+    @param initial [Integer] Starting limit.
+    @param minimum [Integer] Lowest the limit may fall.
+    @param maximum [Integer] Highest the limit may grow.
+    @param target_latency [Number] Seconds above which a response counts as
+    a congestion signal.
+    @param backoff [Number] Factor applied to the limit on congestion.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, target_latency=2.0,
+                 backoff=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Block until a request may be started, at most timeout seconds.
+        Raises socket.timeout."""
+        end = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                left = None if end is None else end - time.time()
+                if left is not None and left <= 0:
+                    raise socket.timeout('SBA API deadline exceeded')
+                self._condition.wait(left)
+            self.in_flight += 1
+
+    def release(self, latency, error=False):
+        """Record the outcome of a request started with acquire."""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.time()
+            if error or latency > self.target_latency:
+                if now - self._last_decrease >= self.target_latency:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """Hold one in flight slot for the duration of the block, waiting at
+        most timeout seconds for it. Only errors worth retrying
+        (hedging.retryable) signal congestion; a 404 or an invalid request
+        does not."""
+        self.acquire(timeout)
+        started = time.time()
+        try:
+            yield
+        except Exception as error:
+            self.release(time.time() - started, error=retryable(error))
+            raise
+        self.release(time.time() - started)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+"""
+Keep-alive HTTP transport for the SBA API wrappers.
+
+A ConnectionPool keeps idle connections open per host so that consecutive
+calls skip the TCP (and TLS) handshake. Bodies sent with a gzip or deflate
+Content-Encoding are decompressed as they are read.
+
+>>> import api, transport
+>>> api.SBA_API.transport = transport.ConnectionPool(maxsize=8)
+"""
+
+import errno
+import http.client as http_client
+import socket
+import threading
+import time
+import zlib
+from collections import deque
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+
+# Compressed bytes read at a time when decompressing a whole body.
+CHUNK_SIZE = 64 * 1024
+
+# Redirects are followed, like urlopen does, at most MAX_REDIRECTS times.
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# Socket errors raised when a kept-alive connection was closed by the server
+# while it sat in the pool.
+STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+
+def stale(error):
+    """
+    True when error shows that a kept-alive connection was closed before
+    any byte of the response arrived, so the request can be sent again on a
+    fresh connection. Timeouts and partly received responses are not
+    stale: the server may still be working on the request.
+    """
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, http_client.BadStatusLine):
+        # An empty status line: the connection closed without a response.
+        return error.line in ('', "''")
+    if isinstance(error, (http_client.CannotSendRequest,
+                          http_client.ResponseNotReady)):
+        return True
+    return isinstance(error, socket.error) and error.errno in STALE_ERRNOS
+
+
+class Response(object):
+    """Fully read HTTP response, shaped like the object urlopen returns."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+
+class _Deflate(object):
+    """Decompressor for Content-Encoding: deflate, which servers send either
+    zlib wrapped, as the HTTP spec says, or as a raw deflate stream."""
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+        self._started = False
+
+    def decompress(self, data):
+        if not self._started and data:
+            self._started = True
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+def decompressor(encoding):
+    """Return a zlib style decompressor for a Content-Encoding header, or
+    None when the body is not compressed."""
+    if not isinstance(encoding, str):
+        return None
+    encoding = encoding.strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return _Deflate()
+    return None
+
+
+def decompress(body, encoding):
+    """Decompress a whole body sent with the given Content-Encoding."""
+    decoder = decompressor(encoding)
+    if decoder is None:
+        return body
+    return decoder.decompress(body) + decoder.flush()
+
+
+class DecompressedResponse(object):
+    """Wraps a response with a compressed body so that read() returns the
+    decompressed bytes, inflating each chunk as it arrives."""
+
+    def __init__(self, response, decoder):
+        self.response = response
+        self.url = getattr(response, 'url', None)
+        self.status = getattr(response, 'status', None)
+        self.reason = getattr(response, 'reason', None)
+        self.headers = getattr(response, 'headers', None)
+        self._decoder = decoder
+        self._pending = b''
+        self._done = False
+
+    def read(self, amt=None):
+        if amt is None:
+            chunks = [self._pending]
+            while not self._done:
+                chunks.append(self._inflate())
+            self._pending = b''
+            return b''.join(chunks)
+        while len(self._pending) < amt and not self._done:
+            self._pending += self._inflate(amt)
+        data, self._pending = self._pending[:amt], self._pending[amt:]
+        return data
+
+    def _inflate(self, amt=CHUNK_SIZE):
+        data = self.response.read(amt)
+        if not data:
+            self._done = True
+            return self._decoder.flush()
+        return self._decoder.decompress(data)
+
+    def close(self):
+        self.response.close()
+
+    def info(self):
+        return self.response.info()
+
+    def getcode(self):
+        return self.response.getcode()
+
+    def geturl(self):
+        return self.response.geturl()
+
+    def __iter__(self):
+        return iter(lambda: self.read(CHUNK_SIZE), b'')
+
+
+def decompressed(response):
+    """Return response, wrapped to decompress its body if the server sent
+    it gzip or deflate encoded."""
+    try:
+        encoding = response.info().get('Content-Encoding')
+    except AttributeError:
+        return response
+    decoder = decompressor(encoding)
+    if decoder is None:
+        return response
+    return DecompressedResponse(response, decoder)
+
+
+class StreamResponse(object):
+    """Response whose body is read from the connection on demand. release
+    is called once: release(True) when the body has been read to the end,
+    even if the caller stops before the empty read that signals it,
+    release(False) when it is closed early."""
+
+    def __init__(self, url, raw, release):
+        self.url = url
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.msg
+        self._raw = raw
+        self._release = release
+
+    def read(self, amt=None):
+        if self._release is None:
+            return b''
+        data = self._raw.read(amt)
+        if amt is None or not data or self._raw.isclosed():
+            self._release(True)
+            self._release = None
+        return data
+
+    def close(self):
+        """Give up on the rest of the body; the connection is not reused."""
+        if self._release is not None:
+            self._raw.close()
+            self._release(False)
+            self._release = None
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def __iter__(self):
+        return iter(lambda: self.read(65536), b'')
+
+
+class ConnectionPool(object):
+    """Thread safe pool of keep-alive connections, keyed per host.
+
+    @param maxsize [Integer] Idle connections kept per host. Requests beyond
+    this many in flight still run, their connections are just closed after.
+    @param idle_timeout [Number] Seconds an idle connection may sit in the
+    pool before it is discarded instead of reused.
+    @param timeout [Number] Socket timeout for new connections, or None.
+    """
+
+    def __init__(self, maxsize=10, idle_timeout=60, timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, scheme, netloc, timeout):
+        if scheme == 'https':
+            return http_client.HTTPSConnection(netloc, timeout=timeout)
+        return http_client.HTTPConnection(netloc, timeout=timeout)
+
+    def _get(self, key):
+        """Pop the most recently used live connection for key, if any."""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key)
+            while idle:
+                conn, released = idle.pop()
+                if now - released <= self.idle_timeout:
+                    return conn
+                conn.close()
+        return None
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def open(self, url, headers=None, timeout=None, span=None):
+        """
+        Send a GET request for url over a pooled connection and return a
+        StreamResponse whose body has not been read yet, decompressing it
+        when it is gzip or deflate encoded. The connection goes back to the
+        pool once the body is read to the end. Redirects are followed, and
+        HTTPError is raised for any other status but 2xx and 304, like
+        urlopen. A new connection's setup time is recorded on span as
+        'connect'.
+        """
+        for redirect in range(MAX_REDIRECTS + 1):
+            response = self._send(url, headers, timeout, span)
+            location = response.headers.get('Location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                break
+            # Read the redirect's body so its connection is reused.
+            response.read()
+            url = urljoin(url, location)
+        if response.status >= 300 and response.status != 304:
+            response.close()
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, None)
+        return decompressed(response)
+
+    def _send(self, url, headers, timeout, span):
+        """Send one GET request and return its StreamResponse."""
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        if timeout is None:
+            timeout = self.timeout
+        conn = self._get(key)
+        while True:
+            reused = conn is not None
+            if not reused:
+                conn = self._new_connection(parts.scheme, parts.netloc,
+                                            timeout)
+                if span is not None:
+                    started = time.time()
+                    conn.connect()
+                    span.record('connect', time.time() - started)
+            elif conn.sock is not None:
+                # Replace whatever timeout the previous request set.
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request('GET', path, headers=headers or {})
+                raw = conn.getresponse()
+                break
+            except Exception as error:
+                conn.close()
+                if not reused or not stale(error):
+                    raise
+                conn = None
+        return StreamResponse(
+            url, raw, lambda reuse: self._release(key, conn, raw, reuse))
+
+    def _release(self, key, conn, raw, reuse):
+        if not reuse or raw.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+
+    def urlopen(self, url, headers=None, timeout=None, span=None):
+        """
+        Perform a GET request for url over a pooled connection and return a
+        fully read Response, following redirects. Raises HTTPError for
+        other statuses but 2xx and 304.
+        """
+        started = time.time()
+        response = self.open(url, headers, timeout, span)
+        first_byte = time.time()
+        body = response.read()
+        if span is not None:
+            span.record('first_byte', first_byte - started -
+                        span.phases.get('connect', 0))
+            span.record('transfer', time.time() - first_byte)
+        return Response(response.url, response.status, response.reason,
+                        response.headers, body)
+
+    def clear(self):
+        """Close every idle connection held by the pool."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, released in connections:
+                conn.close()
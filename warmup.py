@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+Cache warm-up from a log of past wrapper calls.
+
+A QueryLog set on SBA_API appends one JSON line per wrapper call, e.g.
+{"wrapper": "Loans_And_Grants", "method": "state", "args": ["ia"]}. After a
+deploy, replay it into the configured cache before traffic arrives: calls
+are de-duplicated by URL and the most frequent are made first, so a time
+budget spends itself on what matters most.
+
+>>> import api, cache, warmup
+>>> api.SBA_API.query_log = warmup.QueryLog('sba-calls.jsonl')
+>>> api.Loans_And_Grants().state('ia')          # logged
+>>> api.SBA_API.cache = cache.SQLiteCache('sba-cache.db', ttl=86400)
+>>> warmup.warm(warmup.read_calls('sba-calls.jsonl'), budget=60)
+Summary(warmed=1, skipped=0, failures=[])
+
+From the command line:
+
+    $ python warmup.py sba-calls.jsonl --cache sba-cache.db --budget 60
+    $ python warmup.py sba-calls.jsonl --cache sba-shared.db --wal
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import namedtuple
+
+import api
+from bulk import DEFAULT_WORKERS, fan_out
+from cache import SQLiteCache, WALCache
+
+# warmed is the number of calls made, skipped the number left when the time
+# budget ran out, and failures the bulk.BulkResult of each failed call.
+Summary = namedtuple('Summary', 'warmed skipped failures')
+
+WRAPPERS = dict((wrapper.__name__, wrapper) for wrapper in (
+    api.Licenses_And_Permits, api.Loans_And_Grants, api.Recommended_Sites,
+    api.City_And_County_Web_Data))
+
+
+class QueryLog(object):
+    """Appends wrapper calls to a JSON lines file. Safe to share between
+    threads; each line is flushed as it is written.
+
+    @param path [String] Log file, created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, wrapper, method, args):
+        line = json.dumps({'wrapper': wrapper, 'method': method,
+                           'args': list(args), 'time': time.time()})
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_log(lines):
+    """
+    Yield (wrapper class, method name, args) for each call in an iterable of
+    JSON lines. Blank, malformed and unknown entries are skipped, since a
+    log may end in a partly written line.
+    """
+    for line in lines:
+        try:
+            entry = json.loads(line)
+            wrapper = WRAPPERS[entry['wrapper']]
+            method = entry['method']
+            args = tuple(entry.get('args') or ())
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+        if isinstance(method, str) and not method.startswith('_') and \
+                callable(getattr(wrapper, method, None)):
+            yield wrapper, method, args
+
+
+def unique_calls(calls):
+    """
+    De-duplicate (wrapper class, method name, args) calls by the URL they
+    request, after argument normalization, and return them most frequent
+    first. Calls raising InvalidParameter, or not requesting a single URL
+    (streaming and bulk methods), are dropped.
+    """
+    clients = {}
+    counts = {}
+    first = {}
+    for position, (wrapper, method, args) in enumerate(calls):
+        client = clients.get(wrapper)
+        if client is None:
+            client = clients[wrapper] = wrapper()
+        try:
+            url = client.url_for(method, *args)
+        except Exception:
+            continue
+        if not isinstance(url, str):
+            continue
+        counts[url] = counts.get(url, 0) + 1
+        if url not in first:
+            first[url] = (position, (wrapper, method, args))
+    return [first[url][1] for url in
+            sorted(first, key=lambda url: (-counts[url], first[url][0]))]
+
+
+def read_calls(path):
+    """unique_calls() from the log file at path."""
+    with open(path) as lines:
+        return unique_calls(read_log(lines))
+
+
+def warm(calls, max_workers=DEFAULT_WORKERS, budget=None, progress=None):
+    """
+    Make every (wrapper class, method name, args) call on at most
+    max_workers threads, filling SBA_API.cache, and return a Summary.
+
+    @param budget [Number] Seconds after which no new call is started;
+    calls in flight are allowed to finish.
+    @param progress [Function] Called as progress(done, total) after
+    each call.
+    """
+    calls = list(calls)
+    end = None if budget is None else time.time() + budget
+    clients = {}
+    for wrapper, method, args in calls:
+        if wrapper not in clients:
+            client = clients[wrapper] = wrapper()
+            # Replaying the log should not append to it.
+            client.query_log = None
+
+    def call(entry):
+        if end is not None and time.time() >= end:
+            return False
+        wrapper, method, args = entry
+        getattr(clients[wrapper], method)(*args)
+        return True
+
+    warmed = skipped = 0
+    failures = []
+    for done, result in enumerate(fan_out(call, calls, max_workers,
+                                          ordered=True)):
+        if result.error is not None:
+            failures.append(result)
+        elif result.value:
+            warmed += 1
+        else:
+            skipped += 1
+        if progress is not None:
+            progress(done + 1, len(calls))
+    return Summary(warmed, skipped, failures)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('log', help='JSON lines log written by QueryLog')
+    parser.add_argument('--cache', required=True,
+                        help='SQLite cache database to fill')
+    parser.add_argument('--wal', action='store_true',
+                        help='fill a WALCache shared by several processes '
+                        'instead of a SQLiteCache')
+    parser.add_argument('--ttl', type=float, default=None,
+                        help='seconds entries stay fresh (default: forever)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='most calls in flight at once')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='seconds after which no new call is started')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='warm only this many of the most frequent calls')
+    options = parser.parse_args(argv)
+
+    calls = read_calls(options.log)[:options.limit]
+    started = time.time()
+
+    def progress(done, total):
+        sys.stderr.write('\r%d/%d %.1fs' % (done, total,
+                                             time.time() - started))
+
+    saved = api.SBA_API.cache
+    if options.wal:
+        api.SBA_API.cache = WALCache(options.cache, ttl=options.ttl,
+                                     vacuum_interval=None)
+    else:
+        api.SBA_API.cache = SQLiteCache(options.cache, ttl=options.ttl)
+    try:
+        summary = warm(calls, options.workers, options.budget, progress)
+    finally:
+        api.SBA_API.cache.close()
+        api.SBA_API.cache = saved
+    sys.stderr.write('\nwarmed %d, skipped %d, failed %d\n' % (
+        summary.warmed, summary.skipped, len(summary.failures)))
+    for failure in summary.failures:
+        sys.stderr.write('failed: %s %s %r: %s\n' % (
+            failure.key[0].__name__, failure.key[1], failure.key[2],
+            failure.error))
+    return 1 if summary.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())